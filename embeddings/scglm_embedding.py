@@ -19,7 +19,7 @@ import torch
 
 from scGraphLLM._globals import * ## these define the indices for the special tokens 
 from scGraphLLM.models import GDTransformer
-from scGraphLLM.infer_graph import infer_cell_edges_, build_class_edge_matrix
+from scGraphLLM.infer_graph import infer_cells_edges, build_class_edge_matrix, build_class_edge_ids
 from scGraphLLM.benchmark import send_to_gpu, random_edge_mask
 from scGraphLLM.config import *
 from scGraphLLM.data import *
@@ -28,6 +28,8 @@ from scGraphLLM._globals import *
 from scGraphLLM.inference import \
     GeneVocab, GraphTokenizer, InferenceDataset, VariableNetworksInferenceDataset
 from scGraphLLM.network import RegulatoryNetwork
+from scGraphLLM.samplers import LengthBucketSampler
+from scGraphLLM.embedding_writer import RaggedEmbeddingWriter
 from utils import (
     mask_values, 
     get_locally_indexed_edges, 
@@ -55,10 +57,10 @@ def main(args):
     if args.infer_network:
         print("Inferring cell networks...")
         class_networks = {
-            name: RegulatoryNetwork.from_csv(path, sep="\t")
+            name: RegulatoryNetwork.from_aracne(path)
             for name, path in args.networks.items()
         }
-        all_edges, edge_ids_list, weights_list = infer_edges(
+        all_edges, edge_ids_list, weights_list, network_ids = infer_edges(
             probs=adata.obsm["class_probs"],
             classes=adata.uns["class_probs_names"],
             class_networks=class_networks,
@@ -72,11 +74,12 @@ def main(args):
             edge_ids_list=edge_ids_list,
             weights_list=weights_list,
             all_edges=all_edges,
+            network_ids=network_ids,
             limit_regulon=args.limit_regulon, 
             limit_graph=args.limit_graph
         )
     else:
-        network = RegulatoryNetwork.from_csv(args.network_path, sep="\t")\
+        network = RegulatoryNetwork.from_aracne(args.network_path)\
             .prune(limit_regulon=args.limit_regulon, limit_graph=args.limit_graph, inplace=True)
         
         dataset = InferenceDataset(
@@ -84,12 +87,30 @@ def main(args):
             tokenizer=GraphTokenizer(vocab=vocab, network=network, n_bins=NUM_BINS)
         )
     
-    dataloader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=args.batch_size,
-        shuffle=False,
-        collate_fn=dataset.collate_fn
-    )
+    if args.max_tokens_per_batch is not None or args.max_edges_per_batch is not None:
+        # pack cells of similar length up to the token/edge budgets, batches are written by obs name
+        if args.max_edges_per_batch is not None:
+            lengths, num_edges = dataset.sequence_lengths(with_edges=True)
+        else:
+            lengths, num_edges = dataset.sequence_lengths(), None
+        dataloader = torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=LengthBucketSampler(
+                lengths, 
+                max_tokens=args.max_tokens_per_batch, 
+                extra_tokens=1,  # CLS token
+                num_edges=num_edges, 
+                max_edges=args.max_edges_per_batch
+            ),
+            collate_fn=dataset.collate_fn
+        )
+    else:
+        dataloader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=args.batch_size,
+            shuffle=False,
+            collate_fn=dataset.collate_fn
+        )
     
     # Load model
     model = GDTransformer.load_from_checkpoint(args.model_path, config=graph_kernel_attn_3L_4096)
@@ -105,6 +126,9 @@ def main(args):
     seq_lengths = []
     input_gene_ids_list = []
     n_obs = 0
+
+    # stream token embeddings to disk batch by batch instead of accumulating them in memory
+    writer = None
     with torch.no_grad():
         for batch in dataloader:
             if args.use_masked_edges:
@@ -127,13 +151,21 @@ def main(args):
             embedding_list_ = [embedding.cpu().numpy()]
             seq_lengths_ = [batch["num_nodes"]]
 
+            if args.stream:
+                if writer is None:
+                    writer = RaggedEmbeddingWriter(args.stream_emb_path, n_dims=embedding_list_[0].shape[-1])
+                # +1 for the CLS token at position 0
+                writer.write(embedding_list_[0], input_gene_ids_list_[0], np.asarray(batch["num_nodes"]) + 1, batch["obs_name"])
+                n_obs += len(batch["num_nodes"])
+                print(f"Processed {n_obs:,} observations")
+                continue
+
             # cache batch embeddings
             if args.cache:
                 seq_lengths, edges, masked_edges, non_masked_edges, x_cls, x, input_genes, expression, metadata = get_scglm_embedding_vars(
                     retain_obs_vars=args.retain_obs_vars, 
                     adata=adata_original[batch["obs_name"],:],
-                    global_gene_to_node=vocab.gene_to_node, 
-                    global_node_to_gene=vocab.node_to_gene,
+                    vocab=vocab,
                     embedding_list=embedding_list_, 
                     edges_list=edges_list_,
                     masked_edges_list=masked_edges_list_,
@@ -176,14 +208,18 @@ def main(args):
     if os.path.isdir(args.cache_dir):
         shutil.rmtree(args.cache_dir)
 
+    if args.stream:
+        if writer is not None:
+            writer.close()
+        return
+
     if args.cache:
         return
 
     seq_lengths, edges, x_cls, x, input_genes, expression, metadata = get_scglm_embedding_vars(
         retain_obs_vars=args.retain_obs_vars, 
         adata=adata_original,
-        global_gene_to_node=vocab.gene_to_node, 
-        global_node_to_gene=vocab.node_to_gene,  
+        vocab=vocab,
         embedding_list=embedding_list, 
         edges_list=edges_list,
         masked_edges_list=masked_edges_list,
@@ -237,31 +273,35 @@ def main(args):
     )
 
 
-def infer_edges(probs, classes, class_networks, hard_assignment, alpha, default_alpha):
+def infer_edges(probs, classes, class_networks, hard_assignment, alpha, default_alpha, chunk_size=1024):
     E, W, all_edges = build_class_edge_matrix(class_networks, classes, default_alpha)
-    all_edges_to_idx = {edge: idx for idx, edge in enumerate(all_edges)}
     edge_ids_list, mis_list = [], []
+    network_ids = np.full(len(probs), -1, dtype=np.int64)  # class index of cells assigned to a class network
+
+    # edge ids and weights of each class network, shared by all cells assigned to the class
+    class_edge_ids = build_class_edge_ids(class_networks, all_edges)
+    class_mis = {c: network.weights.to_numpy() for c, network in class_networks.items()}
+
+    # infer soft-assigned networks of all cells in batches, edges of cell i are at indptr[i]:indptr[i + 1]
+    if not hard_assignment:
+        print(f"Inferring {len(probs):,} cell networks...")
+        indptr, edge_ids, pvals, mis = infer_cells_edges(probs, E, W, alpha=alpha, chunk_size=chunk_size)
 
     for i, probs_i in enumerate(probs):
-        if i % 100 == 0:
-            print(f"Inferred {i:,} cell networks...")
-            
         zero_soft_edges = False
         if not hard_assignment:
-            edge_ids, pvals, mis = infer_cell_edges_(probs_i, E, W, alpha=alpha)
-            zero_soft_edges = len(edge_ids) == 0
+            cell_edge_ids, cell_mis = edge_ids[indptr[i]:indptr[i + 1]], mis[indptr[i]:indptr[i + 1]]
+            zero_soft_edges = len(cell_edge_ids) == 0
 
         if hard_assignment or zero_soft_edges:
-            class_hat = classes[probs_i.argmax()]
-            network = class_networks[class_hat]
-            mis = network.weights
-            edges = network.edges
-            edge_ids = [all_edges_to_idx[edge] for edge in edges]
+            network_ids[i] = probs_i.argmax()
+            class_hat = classes[network_ids[i]]
+            cell_edge_ids, cell_mis = class_edge_ids[class_hat], class_mis[class_hat]
             
-        edge_ids_list.append(edge_ids)
-        mis_list.append(mis)
+        edge_ids_list.append(cell_edge_ids)
+        mis_list.append(cell_mis)
 
-    return all_edges, edge_ids_list, mis_list
+    return all_edges, edge_ids_list, mis_list, network_ids
 
 
 def get_edges_dict(edges_list, base_index=0):
@@ -274,7 +314,7 @@ def get_edges_dict(edges_list, base_index=0):
     return edges
 
 
-def get_scglm_embedding_vars(retain_obs_vars, adata, global_gene_to_node, global_node_to_gene, embedding_list, edges_list, masked_edges_list, non_masked_edges_list, seq_lengths, input_gene_ids_list, base_index=0):
+def get_scglm_embedding_vars(retain_obs_vars, adata, vocab, embedding_list, edges_list, masked_edges_list, non_masked_edges_list, seq_lengths, input_gene_ids_list, base_index=0):
     seq_lengths = np.concatenate(seq_lengths, axis=0) # increment for cls token
     max_seq_length = max(seq_lengths)
     edges = get_edges_dict(edges_list, base_index)
@@ -296,10 +336,10 @@ def get_scglm_embedding_vars(retain_obs_vars, adata, global_gene_to_node, global
 
     input_gene_ids = np.concatenate([
         np.pad(gene_ids, pad_width=((0, 0), (0, max_seq_length + 1 - gene_ids.shape[1])), 
-               mode="constant", constant_values=global_gene_to_node['<PAD>'])
+               mode="constant", constant_values=vocab.pad_node)
         for gene_ids in input_gene_ids_list
     ], axis=0)
-    input_genes = np.vectorize(global_node_to_gene.get)(input_gene_ids)
+    input_genes = vocab.decode(input_gene_ids)
 
     # remove cls token
     input_genes = input_genes[:, 1:]
@@ -342,11 +382,19 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=256)
     parser.add_argument("--skip_preprocess", action="store_true")
     parser.add_argument("--cache", action="store_true")
+    parser.add_argument("--stream", action="store_true", help="Stream token embeddings to embedding.h5 in out_dir")
+    parser.add_argument("--max_tokens_per_batch", type=int, default=None, help="Pack batches up to this many (padded) tokens, CLS included (requires --stream or --cache)")
+    parser.add_argument("--max_edges_per_batch", type=int, default=None, help="Limit batches to this many graph edges (requires --stream or --cache)")
     args = parser.parse_args()
 
+    if (args.max_tokens_per_batch is not None or args.max_edges_per_batch is not None) and not (args.stream or args.cache):
+        # the in-memory outputs are matched to the cells by position
+        parser.error("--max_tokens_per_batch and --max_edges_per_batch require --stream or --cache")
+
     args.cells_path = join(args.data_dir, "cells.h5ad") if args.cells_path is None else args.cells_path
     args.emb_path = join(args.out_dir, "embedding.npz")
     args.emb_cache = join(args.out_dir, "cached_embeddings")
+    args.stream_emb_path = join(args.out_dir, "embedding.h5")
     args.cache_dir = join(args.out_dir, "cache")
     args.emb_cache_dir = join(args.out_dir, "emb_cache")
     args.all_data_dir = join(args.cache_dir, "all")
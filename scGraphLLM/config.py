@@ -62,7 +62,10 @@ graph_kernel_attn_config = Config({
     "use_pe": False,
     "use_attn_mask": True,
     "use_flash_attn": True,
-    "fine_tuning": False
+    "fine_tuning": False,
+    "diffusion_order": 64, # (maximum) Chebyshev order of the diffusion
+    "diffusion_tol": None, # if set, truncate the series once the remaining coefficients sum below this
+    "diffusion_backend": "chebyshev" # one of graph_op.DIFFUSION_BACKENDS
 })
 
 graph_kernel_attn_1DIFF_config = Config({
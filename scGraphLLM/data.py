@@ -7,9 +7,10 @@ import pandas as pd
 import anndata as ad
 
 import os
+import hashlib
 from functools import partial
 from os.path import join
-from typing import List
+from typing import List, Union
 import warnings
 from pathlib import Path
 from multiprocessing import Pool
@@ -26,7 +27,8 @@ SCC_VALS = "scc.values"
 # from scGraphLLM.graph_op import spectral_PE
 from scGraphLLM._globals import *
 from scGraphLLM.network import RegulatoryNetwork
-from scGraphLLM.tokenizer import GraphTokenizer
+from scGraphLLM.graph_op import laplacian_csr
+from scGraphLLM.tokenizer import GraphTokenizer, TokenizedCell, save_tokenized, load_tokenized
 from scGraphLLM.vocab import GeneVocab
 
 
@@ -34,7 +36,7 @@ rng = default_rng(42)
 
 def send_to_gpu(data):
     if isinstance(data, torch.Tensor):
-        return data.to('cuda')  # Send tensor to GPU
+        return data.to('cuda', non_blocking=data.is_pinned())  # Send tensor to GPU
     elif isinstance(data, list):
         return [send_to_gpu(item) for item in data]  # Recursively process lists
     elif isinstance(data, dict):
@@ -43,7 +45,7 @@ def send_to_gpu(data):
         return data  # If not a tensor or list/dict, leave unchanged
 
 
-def scglm_collate_fn(batch, pad_node, inference=False):
+def scglm_collate_fn(batch, pad_node, inference=False, precompute_laplacian=False):
     data = {
         "orig_gene_id": [], 
         "orig_rank_indices": [], 
@@ -56,6 +58,7 @@ def scglm_collate_fn(batch, pad_node, inference=False):
     }
     if inference:
         data["obs_name"] = []
+        data["obs_index"] = []
     
     # Make a dictionary of lists from the list of dictionaries
     for b in batch:
@@ -64,7 +67,7 @@ def scglm_collate_fn(batch, pad_node, inference=False):
 
     # Pad these dictionaries of lists
     for key in data.keys():
-        if key in {"dataset_name", "edge_index", "num_nodes", "obs_name"}:
+        if key in {"dataset_name", "edge_index", "num_nodes", "obs_name", "obs_index"}:
             continue
         elif key == "orig_gene_id":
             pad_value = pad_node
@@ -74,6 +77,10 @@ def scglm_collate_fn(batch, pad_node, inference=False):
             pad_value = False
         data[key] = pad_sequence(data[key], batch_first=True, padding_value=pad_value)
 
+    # build (and validate) the graph Laplacian here, in the DataLoader workers, instead of in the forward pass
+    if precompute_laplacian:
+        data["laplacian"] = laplacian_csr(data["edge_index"], data["num_nodes"])
+
     return data
 
 
@@ -102,10 +109,14 @@ def run_cache(
         min_genes_per_graph=MIN_GENES_PER_GRAPH, 
         skipped=0, 
         ncells=0, 
-        verbose=False
+        verbose=False,
+        batch_size=1024
     ):
     """
     Assign local ARACNe graph to each cell and cache each cell
+
+    Cells are tokenized `batch_size` at a time with `GraphTokenizer.tokenize_batch`. Compact
+    tokenizers write `TokenizedCell` records as `.npz` files, others write `.pt` files.
     """
     os.makedirs(join(cache_dir, msplit), exist_ok=True)
 
@@ -116,45 +127,53 @@ def run_cache(
         expression.columns.isin(tokenizer.gene_to_node) &
         expression.columns.isin(tokenizer.network.genes)
     ]]
+    num_expressed_genes = (expression != ZERO_IDX).sum(axis=1).to_numpy()
 
-    for i in range(expression.shape[0]):
-        if ncells % 1000 == 0:
-            print(f"Processed {ncells} cells", end="\r")
+    for batch_start in range(0, expression.shape[0], batch_size):
+        pending_rows, pending_files = [], []
+        for i in range(batch_start, min(batch_start + batch_size, expression.shape[0])):
+            if ncells % 1000 == 0:
+                print(f"Processed {ncells} cells", end="\r")
 
-        cell_number = expression.index[i]
-        
-        if msplit == "valSG":
-            rand = rng.random()
-            if rand > valsg_split_ratio:
-                split = "train"
+            cell_number = expression.index[i]
+            
+            if msplit == "valSG":
+                rand = rng.random()
+                if rand > valsg_split_ratio:
+                    split = "train"
+                else:
+                    split = msplit
             else:
                 split = msplit
-        else:
-            split = msplit
-        
-        outfile = f"{cache_dir}/{split}/{cell_type}_{cell_number}.pt"
-        if (os.path.exists(outfile)) and (not overwrite):
-            ncells+=1
-            continue
-        
-        cell: pd.Series = expression.iloc[i, :]
-        num_expressed_genes = cell[cell != ZERO_IDX].shape[0]
-        if num_expressed_genes < min_genes_per_graph: # require a minimum number of expressed genes per cell 
-            skipped += 1
-            ncells+=1
+            
+            ext = "npz" if tokenizer.compact else "pt"
+            outfile = f"{cache_dir}/{split}/{cell_type}_{cell_number}.{ext}"
+            if (os.path.exists(outfile)) and (not overwrite):
+                ncells+=1
+                continue
+            
+            if num_expressed_genes[i] < min_genes_per_graph: # require a minimum number of expressed genes per cell 
+                skipped += 1
+                ncells+=1
+                continue
+
+            pending_rows.append(i)
+            pending_files.append(outfile)
+            ncells += 1
+
+        if len(pending_rows) == 0:
             continue
 
-        data = tokenizer(cell)
-        
-        torch.save(data, outfile)
-        ncells += 1
+        cells = expression.iloc[pending_rows]
+        for data, outfile in zip(tokenizer.tokenize_batch(cells.to_numpy(), cells.columns), pending_files):
+            save_tokenized(data, outfile)
         
-        if verbose:
-            try:
-                torch.load(outfile)
-                print(outfile)
-            except:
-                print(outfile, "-------- Failed")
+            if verbose:
+                try:
+                    load_tokenized(outfile)
+                    print(outfile)
+                except:
+                    print(outfile, "-------- Failed")
         
     return (skipped, ncells)
 
@@ -193,7 +212,7 @@ def cache_aracane_and_bins(
             aracne_out = outdir_info[0]
             
             # Get the ARACNe network for this cell-type
-            network = RegulatoryNetwork.from_csv(aracne_out + "/consolidated-net_defaultid.tsv", sep = "\t")
+            network = RegulatoryNetwork.from_aracne(aracne_out + "/consolidated-net_defaultid.tsv")
             
             # initialize graph tokenizer
             tokenizer = GraphTokenizer(
@@ -227,11 +246,44 @@ def cache_aracane_and_bins(
         print(f"loaded {ncells} cells")
 
 
+SEQ_LENGTHS_FILE = "seq_lengths.npy"
+SEQ_LENGTHS_KEY_FILE = "seq_lengths.key"
+
+
+def _files_fingerprint(paths):
+    """Fingerprint of a list of files from their names, sizes and modification times."""
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def _tokenized_size(path):
+    """Number of gene tokens and edges of a cached cell."""
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return len(data["genes"]), data["edge_index"].shape[1]
+    data = load_tokenized(path)
+    return data.x.shape[0], data.edge_index.shape[1]
+
+
 class GraphTransformerDataset(torchDataset):
-    def __init__(self, cache_dir:str, vocab: GeneVocab, dataset_name:str=None, mask_fraction=0.15, debug:bool=False, inference=False):
+    def __init__(
+            self, 
+            cache_dir:str, 
+            vocab: GeneVocab, 
+            dataset_name:str=None, 
+            mask_fraction=0.15, 
+            debug:bool=False, 
+            inference=False, 
+            precompute_laplacian=False
+        ):
         self.debug = debug
         self.inference = inference
-        self.cached_files = sorted([cache_dir+"/" + f for f in os.listdir(cache_dir) if f.endswith(".pt")])
+        self.precompute_laplacian = precompute_laplacian
+        self.cache_dir = cache_dir
+        self.cached_files = sorted([cache_dir+"/" + f for f in os.listdir(cache_dir) if f.endswith((".pt", ".npz"))])
         self.dataset_name = dataset_name
         self.mask_fraction = mask_fraction
         self.vocab = vocab
@@ -244,34 +296,65 @@ class GraphTransformerDataset(torchDataset):
         return len(self.cached_files)
 
     def __getitem__(self, idx):
-        data = torch.load(self.cached_files[idx], weights_only=False)
-        return self._item_from_tokenized_data(data)
+        data = load_tokenized(self.cached_files[idx])
+        item = self._item_from_tokenized_data(data)
+        if self.inference:
+            item["obs_index"] = idx
+        return item
+
+    def sequence_lengths(self, with_edges=False):
+        """
+        Number of gene tokens of each cached cell, used by `LengthBucketSampler` to batch cells
+        of similar length. With `with_edges`, a tuple of the number of tokens and the number of
+        edges of each cell. Sizes are read from `seq_lengths.npy` in the cache directory when it
+        indexes the current files, as recorded by a fingerprint of their names, sizes and
+        modification times in `seq_lengths.key`, and otherwise computed (reading only the gene
+        and edge arrays of `.npz` files) and saved there.
+        """
+        index_path = os.path.join(self.cache_dir, SEQ_LENGTHS_FILE)
+        key_path = os.path.join(self.cache_dir, SEQ_LENGTHS_KEY_FILE)
+        fingerprint = _files_fingerprint(self.cached_files)
+        sizes = None
+        if os.path.exists(index_path) and os.path.exists(key_path):
+            with open(key_path) as f:
+                if f.read().strip() == fingerprint:
+                    sizes = np.load(index_path)
+        if sizes is None or sizes.shape != (len(self), 2):
+            sizes = np.array([_tokenized_size(path) for path in self.cached_files], dtype=np.int64).reshape(-1, 2)
+            try:
+                np.save(index_path, sizes)
+                with open(key_path, "w") as f:
+                    f.write(fingerprint)
+            except OSError:
+                pass  # read-only cache directory
+        return (sizes[:, 0], sizes[:, 1]) if with_edges else sizes[:, 0]
+
+    def _item_from_tokenized_data(self, data: Union[torchGeomData, TokenizedCell]):
+        if isinstance(data, TokenizedCell):
+            gene_indices, rank_indices, edge_index, _ = data.to_tensors()
+        else:
+            gene_indices, rank_indices, edge_index = data.x[:, 0], data.x[:, 1], data.edge_index
 
-    def _item_from_tokenized_data(self, data: torchGeomData):
-        node_indices = data.x
+        num_nodes = gene_indices.shape[0]
         ## for each mask type, create boolean mask of the same shape as node_indices
         if self.mask_fraction == 0:
-            gene_mask = torch.zeros(node_indices.shape[0], dtype=torch.bool)
-            rank_mask = torch.zeros(node_indices.shape[0], dtype=torch.bool)
-            both_mask = torch.zeros(node_indices.shape[0], dtype=torch.bool)
+            gene_mask = torch.zeros(num_nodes, dtype=torch.bool)
+            rank_mask = torch.zeros(num_nodes, dtype=torch.bool)
+            both_mask = torch.zeros(num_nodes, dtype=torch.bool)
         else:
-            gene_mask = torch.rand(node_indices.shape[0]) < self.mask_fraction
-            rank_mask = torch.rand(node_indices.shape[0]) < self.mask_fraction
-            both_mask = torch.rand(node_indices.shape[0]) < self.mask_fraction
-        
-        # add CLS
-        cls_token = torch.tensor([[self.cls_node, CLS_RANK_IDX]], dtype=node_indices.dtype)
-        node_indices = torch.cat([cls_token, node_indices], dim=0)
+            gene_mask = torch.rand(num_nodes) < self.mask_fraction
+            rank_mask = torch.rand(num_nodes) < self.mask_fraction
+            both_mask = torch.rand(num_nodes) < self.mask_fraction
 
         # add False to mask for cls node
         gene_mask = torch.cat([torch.tensor([False]), gene_mask])
         rank_mask = torch.cat([torch.tensor([False]), rank_mask])
         both_mask = torch.cat([torch.tensor([False]), both_mask])
 
-        orig_gene_indices = node_indices[:, 0].clone()
-        orig_rank_indices = node_indices[:, 1].clone()
-        num_nodes = node_indices.shape[0] - 1 # discount the cls node
-        edge_index = data.edge_index # edges index assumes the first gene token's index is 0
+        # add CLS, promoting compact dtypes to long
+        orig_gene_indices = torch.cat([torch.tensor([self.cls_node], dtype=torch.long), gene_indices])
+        orig_rank_indices = torch.cat([torch.tensor([CLS_RANK_IDX], dtype=torch.long), rank_indices])
+        edge_index = edge_index.long() # edges index assumes the first gene token's index is 0
 
         # graph positional encoding
         #spectral_pe = spectral_PE(edge_index=data.edge_index, num_nodes=node_indices.shape[0], k=64)
@@ -295,7 +378,12 @@ class GraphTransformerDataset(torchDataset):
 
     @property
     def collate_fn(self):
-        return partial(scglm_collate_fn, pad_node=self.vocab.pad_node, inference=self.inference)
+        return partial(
+            scglm_collate_fn, 
+            pad_node=self.vocab.pad_node, 
+            inference=self.inference, 
+            precompute_laplacian=self.precompute_laplacian
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+import anndata as ad
+import h5py
+
+
+class EmbeddingWriter(object):
+    """
+    Append-only on-disk store of cell embeddings, written batch by batch.
+
+    The embeddings are written to an `.h5ad` file whose `X` is preallocated as a chunked
+    `[n_obs, n_dims]` HDF5 dataset, so memory use is bounded by one batch regardless of the
+    number of cells. Rows are placed by their position in `obs` (e.g. the dataset index of each
+    cell), so batches may arrive in any order, and observation names are only stored as
+    metadata, so they may repeat. Once closed, the file opens as a regular (or backed) AnnData:
+
+        >>> adata = ad.read_h5ad(path, backed="r")
+
+    Args:
+        path (str): Path of the `.h5ad` file to create (overwritten if it exists).
+        obs (pd.DataFrame or pd.Index): Observations (cells), in the row order of the result.
+            A DataFrame's columns are stored as cell metadata.
+        n_dims (int): Embedding dimension.
+        dtype (np.dtype): Floating point dtype of the stored embeddings.
+        chunk_rows (int): Number of rows per HDF5 chunk.
+    """
+    def __init__(self, path, obs, n_dims, dtype=np.float32, chunk_rows=4096):
+        obs = obs.copy() if isinstance(obs, pd.DataFrame) else pd.DataFrame(index=pd.Index(obs))
+        obs.index = obs.index.astype(str)
+
+        self.path = path
+        self.n_obs = len(obs)
+        self.n_written = 0
+
+        # write obs and var through anndata, then add the preallocated X
+        var = pd.DataFrame(index=pd.Index([str(i) for i in range(n_dims)]))
+        ad.AnnData(obs=obs, var=var).write_h5ad(path)
+        self._file = h5py.File(path, "r+")
+        if "X" in self._file:
+            del self._file["X"]
+        self._x = self._file.create_dataset(
+            "X",
+            shape=(len(obs), n_dims),
+            dtype=dtype,
+            chunks=(max(min(chunk_rows, len(obs)), 1), max(n_dims, 1)) if len(obs) > 0 and n_dims > 0 else None
+        )
+        self._x.attrs["encoding-type"] = "array"
+        self._x.attrs["encoding-version"] = "0.2.0"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def write(self, x, rows=None):
+        """
+        Writes the embeddings of a batch of cells.
+
+        Args:
+            x (np.ndarray): [B, n_dims] embeddings.
+            rows (array-like, optional): Position in `obs` of each row of `x`. Defaults to the
+                rows following the ones written so far, for batches arriving in order.
+        """
+        if self.closed:
+            raise ValueError(f"{self.path} is closed.")
+
+        if rows is None:
+            rows = np.arange(self.n_written, self.n_written + len(x))
+        rows = np.asarray(rows, dtype=np.int64)
+        invalid = (rows < 0) | (rows >= self.n_obs)
+        if invalid.any():
+            raise IndexError(f"Rows out of range for {self.n_obs} observations: {list(rows[invalid][:5])}")
+        if len(rows) == 0:
+            return
+
+        x = np.asarray(x, dtype=self._x.dtype)
+        if np.array_equal(rows, np.arange(rows[0], rows[0] + len(rows))):
+            self._x[rows[0]:rows[0] + len(rows)] = x
+        else:
+            # HDF5 point selections must be increasing
+            order = np.argsort(rows)
+            self._x[rows[order]] = x[order]
+        self.n_written += len(rows)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self._file = None
+
+
+class RaggedEmbeddingWriter(object):
+    """
+    Append-only on-disk store of variable-length token embeddings, written batch by batch.
+
+    Token embeddings of all cells are concatenated into a single `[n_tokens, n_dims]` HDF5
+    dataset that grows as batches are appended, with the gene node id of each token alongside.
+    The tokens of cell `i` are at `offsets[i]:offsets[i + 1]`, and padding is never stored.
+
+    Args:
+        path (str): Path of the `.h5` file to create (overwritten if it exists).
+        n_dims (int): Embedding dimension.
+        dtype (np.dtype): Floating point dtype of the stored embeddings.
+        chunk_rows (int): Number of tokens per HDF5 chunk.
+    """
+    def __init__(self, path, n_dims, dtype=np.float32, chunk_rows=16384):
+        self.path = path
+        self._file = h5py.File(path, "w")
+        self._x = self._file.create_dataset("x", shape=(0, n_dims), maxshape=(None, n_dims), dtype=dtype, chunks=(chunk_rows, n_dims))
+        self._gene_ids = self._file.create_dataset("gene_ids", shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(chunk_rows,))
+        self._offsets = self._file.create_dataset("offsets", shape=(1,), maxshape=(None,), dtype=np.int64, chunks=(chunk_rows,))
+        self._obs_names = self._file.create_dataset("obs_names", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(chunk_rows,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    @property
+    def n_obs(self):
+        return len(self._obs_names)
+
+    @property
+    def n_tokens(self):
+        return len(self._x)
+
+    def write(self, x, gene_ids, seq_lengths, obs_names):
+        """
+        Appends the token embeddings of a batch of cells, dropping padding.
+
+        Args:
+            x (np.ndarray): [B, T, n_dims] padded token embeddings.
+            gene_ids (np.ndarray): [B, T] gene node id of each token.
+            seq_lengths (array-like): Number of (non-padding) tokens of each cell.
+            obs_names (array-like): Observation name of each cell.
+        """
+        if self.closed:
+            raise ValueError(f"{self.path} is closed.")
+
+        seq_lengths = np.asarray(seq_lengths, dtype=np.int64)
+        mask = np.arange(np.shape(x)[1])[None, :] < seq_lengths[:, None]
+        _append(self._x, np.asarray(x)[mask])
+        _append(self._gene_ids, np.asarray(gene_ids)[mask])
+        _append(self._offsets, self._offsets[-1] + np.cumsum(seq_lengths))
+        _append(self._obs_names, np.asarray(obs_names, dtype=object).astype(str))
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self._file = None
+
+
+def read_ragged_embeddings(path):
+    """
+    Reads the index of a file written by `RaggedEmbeddingWriter`.
+
+    Args:
+        path (str): Path of the `.h5` file.
+
+    Returns:
+        Tuple[h5py.File, np.ndarray, pd.Index]: The open file (whose "x" and "gene_ids" datasets
+            are read lazily), the token offsets of each cell and the observation names.
+    """
+    file = h5py.File(path, "r")
+    return file, file["offsets"][:], pd.Index(file["obs_names"].asstr()[:])
+
+
+def _append(dataset, values):
+    start = len(dataset)
+    dataset.resize(start + len(values), axis=0)
+    dataset[start:] = values
@@ -1,3 +1,8 @@
+import hashlib
+import math
+from collections import OrderedDict
+
+import numpy as np
 import torch
 from torch_geometric.utils import scatter, remove_self_loops
 
@@ -20,13 +25,16 @@ def _rescaled_L(edge_index, num_nodes, edge_weight=None):
         idx = torch.arange(num_nodes, device=edge_index.device)
         edge_index = idx.unsqueeze(0).repeat(2, 1)
     # DANGER
-    if edge_weight is None:
-        edge_weight = torch.ones(edge_index.size(1), dtype=torch.float32, device=edge_index.device)
-    row, col = edge_index[0], edge_index[1]
+    return _normalized_L(edge_index, num_nodes, edge_weight)[0]
 
+# Check the edges and weights of every Laplacian built in the forward pass. Each check reads a
+# value back from the device, a host sync per call, so this is meant for debugging only.
+DEBUG_GRAPH_CHECKS = False
+
+def _check_graph(row, edge_weight, num_nodes):
     if row.shape != edge_weight.shape:
         print(f"Shape mismatch: row={row.shape}, edge_weight={edge_weight.shape}")
-    max_index = max_index = row.max().item()
+    max_index = row.max().item() if row.numel() > 0 else -1
     if max_index >= num_nodes:
         print(f"Row index out of bounds! max index = {max_index} >= num_nodes = {num_nodes}")
     if torch.isnan(edge_weight).any():
@@ -34,29 +42,78 @@ def _rescaled_L(edge_index, num_nodes, edge_weight=None):
     if torch.isinf(edge_weight).any():
         print("Inf detected in edge_weight!")
 
+def _normalized_L(edge_index, num_nodes, edge_weight=None):
+    if edge_weight is None:
+        edge_weight = torch.ones(edge_index.size(1), dtype=torch.float32, device=edge_index.device)
+    row, col = edge_index[0], edge_index[1]
+    if DEBUG_GRAPH_CHECKS:
+        _check_graph(row, edge_weight, num_nodes)
+
     deg = scatter(edge_weight, row, 0, dim_size=num_nodes, reduce='sum')
     deg = deg.clamp(min=1e-8)
-    assert not torch.isnan(edge_weight).any(), "NaN values in edge_weight"
-    assert not torch.isnan(deg).any(), "NaN values in degree"
-    deg_inv_sqrt = deg.pow_(-0.5)
+    if DEBUG_GRAPH_CHECKS:
+        assert not torch.isnan(deg).any(), "NaN values in degree"
+    deg_inv_sqrt = deg.pow(-0.5)
     deg_inv_sqrt.masked_fill_(deg_inv_sqrt == float('inf'), 0)
     deg_inv_sqrt.masked_fill_(deg_inv_sqrt.isnan(), 0)
     edge_weight = deg_inv_sqrt[row] * edge_weight * deg_inv_sqrt[col] # D^(-1/2) * A * D^(-1/2)
-    assert not torch.isnan(edge_weight).any(), "NaN values in edge_weight after normalization"
+    if DEBUG_GRAPH_CHECKS:
+        assert not torch.isnan(edge_weight).any(), "NaN values in edge_weight after normalization"
     L_rescaled = torch.sparse_coo_tensor(edge_index, -edge_weight, (num_nodes, num_nodes))
-    return L_rescaled
+    return L_rescaled, deg
 
 def _chebyshev_coeff(L_rescaled, K, func, N=100):
+    return _quadrature_coeff(K, func, N, L_rescaled.device)
+
+def _quadrature_coeff(K, func, N, device, dtype=torch.float32):
     # Gauss-Chebyshev quadrature
-    ind = torch.arange(0, K+1, dtype=torch.float32, device=L_rescaled.device)
-    ratio = torch.pi * (torch.arange(1, N+1, dtype=torch.float32, device=L_rescaled.device) - 0.5) / N
+    ind = torch.arange(0, K+1, dtype=dtype, device=device)
+    ratio = torch.pi * (torch.arange(1, N+1, dtype=dtype, device=device) - 0.5) / N
     x = torch.cos(ratio) # quadrature points
     T_kx = torch.cos(ind.view(-1, 1) * ratio) 
-    w = torch.ones(N, device=L_rescaled.device) * (torch.pi / N)
+    w = torch.ones(N, dtype=dtype, device=device) * (torch.pi / N)
     f_x = func(x)
     c_k = (2 / torch.pi) * torch.matmul(T_kx, w * f_x)
     return c_k
 
+DIFFUSION_BACKENDS = ("chebyshev", "dense", "expm_multiply", "auto")
+
+# "auto" backend policy, see `scripts/benchmark_diffusion.py` for the CPU crossover points
+DENSE_MAX_NODES = 512
+DENSE_MIN_DENSITY = 0.15
+
+# Chebyshev coefficients of the exponential kernel, keyed by (K, beta, N, device)
+_EXP_COEFF_MEMO = {}
+
+@torch.amp.autocast(enabled=False, device_type='cuda')
+def _exp_kernel_coeff(K, beta, N=100, device="cpu"):
+    """Memoized Chebyshev coefficients of `_exp_kernel`, which depend only on (K, beta, N)."""
+    key = (K, beta, N, torch.device(device))
+    if key not in _EXP_COEFF_MEMO:
+        _EXP_COEFF_MEMO[key] = _quadrature_coeff(K, lambda x: _exp_kernel(x, beta), N, device)
+    return _EXP_COEFF_MEMO[key]
+
+# adaptive truncation orders, keyed by (max_k, beta, tol, N)
+_ORDER_MEMO = {}
+
+def _adaptive_order(max_k, beta, tol, N=100):
+    """
+    Smallest order K <= max_k (and at least 1) at which the tail sum_{K < k <= max_k} |c_k| of the
+    Chebyshev coefficients of `_exp_kernel` is below `tol`. For undirected graphs, the rescaled
+    Laplacian is symmetric with spectrum in [-1, 1] where |T_k(x)| <= 1, so truncating the series
+    at K changes the diffused embeddings by at most `tol * ||E||` (per column, in 2-norm) compared
+    to using all max_k terms. Directed graphs carry no such guarantee.
+    """
+    key = (max_k, beta, tol, N)
+    if key not in _ORDER_MEMO:
+        # in double precision, single precision round-off alone sums to ~1e-5 over 64 terms
+        c_k = _quadrature_coeff(max_k, lambda x: _exp_kernel(x, beta), N, "cpu", dtype=torch.float64).abs()
+        # tail[K] = sum of |c_k| for K < k <= max_k
+        tail = torch.flip(torch.cumsum(torch.flip(c_k, [0]), 0), [0]) - c_k
+        below = torch.nonzero(tail[1:] < tol).flatten()
+        _ORDER_MEMO[key] = int(below[0]) + 1 if len(below) > 0 else max_k
+    return _ORDER_MEMO[key]
+
 @torch.amp.autocast(enabled=False, device_type='cuda')
 def _chebyshev_diffusion_per_sample(edge_index, num_nodes, E, k=128, edge_weight=None, beta=0.5):
     """
@@ -88,8 +145,447 @@ def _chebyshev_diffusion_per_sample(edge_index, num_nodes, E, k=128, edge_weight
     final_emb = final_emb.bfloat16()
     return final_emb
 
-def _chebyshev_diffusion(edge_index_list, num_nodes_list, E, k=64, beta=0.5):
+def _block_diagonal_L(edge_index_list, num_nodes_list, device):
+    """
+    Rescaled Laplacian of a batch of graphs, as one block-diagonal sparse matrix over the
+    nodes of all graphs packed one after another, and the degree of each node. Block i is
+    `_rescaled_L` of graph i.
+    """
+    edge_indices = []
+    offset = 0
+    for edge_index, num_nodes in zip(edge_index_list, num_nodes_list):
+        num_nodes = int(num_nodes)
+        edge_index, _ = remove_self_loops(edge_index.to(device))
+        # DANGER: same fallback as _rescaled_L, applied per graph
+        if edge_index.shape[-1] == 0:
+            idx = torch.arange(num_nodes, device=device)
+            edge_index = idx.unsqueeze(0).repeat(2, 1)
+        edge_indices.append(edge_index + offset)
+        offset += num_nodes
+    edge_index = torch.cat(edge_indices, dim=1) if edge_indices else torch.zeros(2, 0, dtype=torch.long, device=device)
+    return _normalized_L(edge_index, offset)
+
+
+def laplacian_csr(edge_index_list, num_nodes_list):
+    """
+    Precomputes the block-diagonal rescaled Laplacian of a batch of graphs on the CPU, e.g. in
+    the DataLoader workers (see `scglm_collate_fn`), so that the forward pass only copies it to
+    the device instead of building it. The edges are validated here, once per batch, instead of
+    by the diagnostics of `_rescaled_L` on the model's device.
+
+    Args:
+        edge_index_list (list): Edge index of each graph, length B.
+        num_nodes_list (list): Number of nodes of each graph.
+
+    Returns:
+        dict: "crow_indices", "col_indices" and (float32) "values" of the CSR Laplacian over the
+            packed nodes of all graphs, and the "degree" of each packed node.
+    """
+    for i, (edge_index, num_nodes) in enumerate(zip(edge_index_list, num_nodes_list)):
+        if edge_index.dim() != 2 or edge_index.shape[0] != 2:
+            raise ValueError(f"Graph {i}: expected a [2, E] edge index, got shape {tuple(edge_index.shape)}.")
+        if edge_index.numel() > 0 and (edge_index.min() < 0 or edge_index.max() >= int(num_nodes)):
+            raise ValueError(f"Graph {i}: edge index out of bounds for {int(num_nodes)} nodes.")
+
+    L_rescaled, degree = _block_diagonal_L(edge_index_list, num_nodes_list, "cpu")
+    L_rescaled = L_rescaled.coalesce().to_sparse_csr()
+    return {
+        "crow_indices": L_rescaled.crow_indices(),
+        "col_indices": L_rescaled.col_indices(),
+        "values": L_rescaled.values().to(torch.float32),
+        "degree": degree
+    }
+
+
+class GraphOperator(object):
+    """
+    Graph operator of a batch: the block-diagonal rescaled Laplacian of all graphs (as CSR)
+    over their packed nodes, the degree of each packed node and the padding layout. Built once
+    per batch and shared by every diffusion layer of a forward pass.
+
+    Args:
+        edge_index_list (list): Edge index of each graph, length B.
+        num_nodes_list (list or torch.Tensor): Number of nodes of each graph.
+        device (torch.device): Device of the operator.
+        laplacian (dict, optional): Laplacian precomputed by `laplacian_csr`, e.g. in the DataLoader
+            workers, which is copied to the device instead of being built from the edges.
+    """
+    def __init__(self, edge_index_list, num_nodes_list, device, laplacian=None):
+        self.device = torch.device(device)
+        num_nodes = torch.as_tensor(num_nodes_list).view(-1)
+        self.num_nodes = num_nodes.to(self.device)
+        self.max_num_nodes = int(num_nodes.max()) if len(num_nodes) > 0 else 0
+        self.total_num_nodes = int(num_nodes.sum())
+        if laplacian is not None:
+            # copies from pinned memory are asynchronous
+            self.L_rescaled = torch.sparse_csr_tensor(
+                laplacian["crow_indices"].to(self.device, non_blocking=True),
+                laplacian["col_indices"].to(self.device, non_blocking=True),
+                laplacian["values"].to(self.device, non_blocking=True),
+                size=(self.total_num_nodes, self.total_num_nodes)
+            )
+            self.degree = laplacian["degree"].to(self.device, non_blocking=True)
+        else:
+            L_rescaled, self.degree = _block_diagonal_L(edge_index_list, num_nodes_list, self.device)
+            self.L_rescaled = L_rescaled.coalesce().to_sparse_csr()
+        self._masks = {}
+        self._norm = None
+
+    def __len__(self):
+        return len(self.num_nodes)
+
+    def mask(self, S):
+        """(B, S) mask of the unpadded positions of a batch padded to S nodes."""
+        if S not in self._masks:
+            self._masks[S] = torch.arange(S, device=self.device) < self.num_nodes.unsqueeze(1)
+        return self._masks[S]
+
+    @property
+    def norm(self):
+        """1-norm (maximum absolute column sum) of the rescaled Laplacian."""
+        if self._norm is None:
+            column_sums = scatter(self.L_rescaled.values().abs(), self.L_rescaled.col_indices(), 0, dim_size=self.total_num_nodes, reduce='sum')
+            self._norm = float(column_sums.max()) if self.total_num_nodes > 0 else 0.0
+        return self._norm
+
+
+class DenseGraphOperator(object):
+    """
+    Dense counterpart of `GraphOperator` for small graphs: the rescaled Laplacian of each graph
+    as a dense matrix, padded to [B, n, n] with n the largest number of nodes. Its exact heat
+    kernel is computed once per beta with `torch.linalg.matrix_exp` and then shared by every
+    diffusion layer, each of which only runs one batched dense matmul.
+
+    Args:
+        edge_index_list (list): Edge index of each graph, length B.
+        num_nodes_list (list or torch.Tensor): Number of nodes of each graph.
+        device (torch.device): Device of the operator.
+    """
+    def __init__(self, edge_index_list, num_nodes_list, device):
+        self.device = torch.device(device)
+        self.num_nodes = torch.as_tensor(num_nodes_list, device=self.device).view(-1)
+        self.max_num_nodes = int(self.num_nodes.max()) if len(self.num_nodes) > 0 else 0
+        self.total_num_nodes = int(self.num_nodes.sum())
+
+        # unpack the block-diagonal Laplacian into one dense block per graph
+        L_rescaled = _block_diagonal_L(edge_index_list, num_nodes_list, self.device)[0].coalesce()
+        row, col = L_rescaled.indices()
+        offsets = torch.cumsum(self.num_nodes, 0) - self.num_nodes
+        sample = torch.repeat_interleave(torch.arange(len(self.num_nodes), device=self.device), self.num_nodes)
+        self.L_dense = torch.zeros(len(self.num_nodes), self.max_num_nodes, self.max_num_nodes, device=self.device)
+        self.L_dense[sample[row], row - offsets[sample[row]], col - offsets[sample[col]]] = L_rescaled.values()
+        self._kernels = {}
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.num_nodes)
+
+    def mask(self, S):
+        """(B, S) mask of the unpadded positions of a batch padded to S nodes."""
+        if S not in self._masks:
+            self._masks[S] = torch.arange(S, device=self.device) < self.num_nodes.unsqueeze(1)
+        return self._masks[S]
+
+    @torch.amp.autocast(enabled=False, device_type='cuda')
+    def kernel(self, beta):
+        """
+        [B, n, n] heat kernels exp(-beta (L + I)) + c_0 / 2 I, the function the Chebyshev series
+        of `_chebyshev_diffusion` converges to (its constant term is c_0 rather than c_0 / 2).
+        """
+        if beta not in self._kernels:
+            n = self.max_num_nodes
+            identity = torch.eye(n, device=self.device)
+            c_0 = _exp_kernel_coeff(0, beta, device=self.device)[0]
+            self._kernels[beta] = torch.linalg.matrix_exp(-beta * (self.L_dense + identity)) + (c_0 / 2) * identity
+        return self._kernels[beta]
+
+
+class GraphOperatorCache(object):
+    """
+    Bounded LRU cache of graph operators keyed by a fingerprint of the batch's edges, so that
+    batches of repeated graphs (e.g. repeated inference over the same cells) reuse the operator
+    instead of rebuilding it. Fingerprinting copies the edges to the CPU, so it only pays off
+    when graphs actually repeat.
+
+    Args:
+        max_items (int): Maximum number of cached operators.
+
+    Attributes:
+        hits (int): Number of operators served from the cache.
+        misses (int): Number of operators that were built.
+    """
+    def __init__(self, max_items=16):
+        if max_items < 0:
+            raise ValueError(f"max_items must be non-negative, got {max_items}.")
+        self.max_items = max_items
+        self._operators = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._operators)
+
+    @staticmethod
+    def fingerprint(edge_index_list, num_nodes_list):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.asarray([int(n) for n in num_nodes_list], dtype=np.int64).tobytes())
+        for edge_index in edge_index_list:
+            edge_index = edge_index.detach().cpu().to(torch.int64).numpy()
+            digest.update(np.asarray(edge_index.shape, dtype=np.int64).tobytes())
+            digest.update(np.ascontiguousarray(edge_index).tobytes())
+        return digest.hexdigest()
+
+    def get(self, edge_index_list, num_nodes_list, device, operator_cls=GraphOperator):
+        """Returns the operator of a batch, building and caching it on a miss."""
+        key = (self.fingerprint(edge_index_list, num_nodes_list), torch.device(device), operator_cls.__name__)
+        if key in self._operators:
+            self._operators.move_to_end(key)
+            self.hits += 1
+            return self._operators[key]
+
+        self.misses += 1
+        operator = operator_cls(edge_index_list, num_nodes_list, device)
+        self._operators[key] = operator
+        while len(self._operators) > self.max_items:
+            self._operators.popitem(last=False)
+        return operator
+
+    def clear(self):
+        self._operators.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class GraphOperatorContext(object):
+    """
+    Per-forward-pass handle on the graph operator of a batch. The model creates one context
+    per forward pass and passes it to every layer; the operator is built on first use (on the
+    device of the embeddings) and then shared by all diffusion layers. Operators over a subset
+    of the graphs (as used by the "auto" diffusion backend) are shared the same way.
+
+    Args:
+        edge_index_list (list): Edge index of each graph, length B.
+        num_nodes_list (list or torch.Tensor): Number of nodes of each graph.
+        cache (GraphOperatorCache, optional): Cache of operators shared across batches.
+        laplacian (dict, optional): Laplacian of the batch precomputed by `laplacian_csr`, used
+            for the operator of the whole batch (which then bypasses the cache).
+    """
+    def __init__(self, edge_index_list, num_nodes_list, cache: GraphOperatorCache = None, laplacian=None):
+        self.edge_index_list = edge_index_list
+        self.num_nodes_list = num_nodes_list
+        self.cache = cache
+        self.laplacian = laplacian
+        self._operators = {}
+        self._backends = {}
+
+    def operator(self, device, samples=None, dense=False):
+        """
+        Returns the operator of the batch, or of the graphs at indices `samples`, as a
+        `DenseGraphOperator` if `dense` and a `GraphOperator` otherwise.
+        """
+        key = (torch.device(device), samples, dense)
+        if key not in self._operators:
+            edge_index_list, num_nodes_list = self.edge_index_list, self.num_nodes_list
+            if samples is not None:
+                edge_index_list = [edge_index_list[i] for i in samples]
+                num_nodes_list = [num_nodes_list[i] for i in samples]
+            operator_cls = DenseGraphOperator if dense else GraphOperator
+            if self.laplacian is not None and samples is None and not dense:
+                self._operators[key] = GraphOperator(edge_index_list, num_nodes_list, key[0], laplacian=self.laplacian)
+            elif self.cache is not None:
+                self._operators[key] = self.cache.get(edge_index_list, num_nodes_list, key[0], operator_cls)
+            else:
+                self._operators[key] = operator_cls(edge_index_list, num_nodes_list, key[0])
+        return self._operators[key]
+
+    def backends(self, sparse_backend="expm_multiply", dense_max_nodes=DENSE_MAX_NODES, dense_min_density=DENSE_MIN_DENSITY):
+        """
+        Graphs of the batch handled by each backend under the "auto" policy, as a dict of
+        backend to tuple of sample indices. Small graphs (at most `dense_max_nodes` nodes) and
+        dense graphs (at least `dense_min_density * n^2` edges) use the "dense" backend, where one
+        dense matmul by the precomputed kernel beats many sparse ones, the others `sparse_backend`.
+        """
+        key = (sparse_backend, dense_max_nodes, dense_min_density)
+        if key not in self._backends:
+            groups = {}
+            for i, (edge_index, num_nodes) in enumerate(zip(self.edge_index_list, self.num_nodes_list)):
+                n = int(num_nodes)
+                dense = n <= dense_max_nodes or edge_index.shape[-1] >= dense_min_density * n * n
+                groups.setdefault("dense" if dense else sparse_backend, []).append(i)
+            self._backends[key] = {backend: tuple(samples) for backend, samples in groups.items()}
+        return self._backends[key]
+
+
+@torch.amp.autocast(enabled=False, device_type='cuda')
+def _chebyshev_diffusion_batched(operator: GraphOperator, E, k=64, beta=0.5):
+    """
+    Same as the per-sample loop of `_chebyshev_diffusion_looped`, with a single K-step recursion
+    over the unpadded nodes of the whole batch: the graphs are packed into one block-diagonal
+    Laplacian, and the embeddings into a [sum(num_nodes), H * d] matrix.
+
+    operator: GraphOperator of the batch
+    E: (B, S, H, d)
+    """
+    B, S, H, D = E.size()
+    assert len(operator) == B and operator.max_num_nodes <= S, \
+        f"Expect {B} samples of at most {S} nodes, Got {operator.num_nodes.tolist()}"
+    out = torch.zeros(B, S, H, D, device=E.device, dtype=torch.promote_types(torch.bfloat16, E.dtype))
+    if operator.total_num_nodes == 0:
+        return out
+
+    mask = operator.mask(S)
+    L_rescaled = operator.L_rescaled
+    c_k = _exp_kernel_coeff(k, beta, device=E.device)
+    T_0 = E[mask].to(torch.float32).reshape(-1, H * D)  # (sum(num_nodes), H * d)
+    T_1 = L_rescaled @ T_0
+    y = c_k[0] * T_0
+    y.addcmul_(T_1, c_k[1])
+
+    # start recursion, T_k = 2 L T_{k-1} - T_{k-2} in a single sparse kernel
+    T_k_prev = T_1
+    T_k_prev_prev = T_0
+    for i in range(2, k + 1):
+        T_k = torch.sparse.addmm(T_k_prev_prev, L_rescaled, T_k_prev, beta=-1, alpha=2)
+        y.addcmul_(T_k, c_k[i])
+
+        # shift index
+        T_k_prev_prev = T_k_prev
+        T_k_prev = T_k
+
+    # scatter back to the padded layout once
+    out[mask] = y.reshape(-1, H, D).bfloat16().to(out.dtype)
+    return out
+
+def _chebyshev_diffusion(edge_index_list, num_nodes_list, E, k=64, beta=0.5, graph_context: GraphOperatorContext = None, tol=None):
+    """
+    edge index list: list of edge index, length B
+    E: (B, S, H, d)
+    graph_context: per-forward context sharing the graph operator between layers, built from
+        the edge index list if not given
+    tol: if given, k is the maximum order and the series is truncated at `_adaptive_order(k, beta, tol)`
+    """
+    if tol is not None:
+        k = _adaptive_order(k, beta, tol)
+    if graph_context is None:
+        graph_context = GraphOperatorContext(edge_index_list, num_nodes_list)
+    return _chebyshev_diffusion_batched(graph_context.operator(E.device), E, k=k, beta=beta)
+
+@torch.amp.autocast(enabled=False, device_type='cuda')
+def _dense_diffusion(operator: DenseGraphOperator, E, beta=0.5):
+    """
+    Exact diffusion with the dense heat kernel of each graph, one batched matmul.
+
+    operator: DenseGraphOperator of the batch
+    E: (B, S, H, d)
+    """
+    B, S, H, D = E.size()
+    assert len(operator) == B and operator.max_num_nodes <= S, \
+        f"Expect {B} samples of at most {S} nodes, Got {operator.num_nodes.tolist()}"
+    out = torch.zeros(B, S, H, D, device=E.device, dtype=torch.promote_types(torch.bfloat16, E.dtype))
+    if operator.total_num_nodes == 0:
+        return out
+
+    n = operator.max_num_nodes
+    y = torch.bmm(operator.kernel(beta), E[:, :n].to(torch.float32).reshape(B, n, H * D))
+    mask = operator.mask(n)
+    out[:, :n][mask] = y[mask].reshape(-1, H, D).bfloat16().to(out.dtype)
+    return out
+
+@torch.amp.autocast(enabled=False, device_type='cuda')
+def _expm_multiply_diffusion(operator: GraphOperator, E, beta=0.5, tol=2 ** -24, max_terms=55):
+    """
+    Exact diffusion with the action of the heat kernel on the embeddings, computed with the
+    truncated Taylor series of Al-Mohy & Higham (the scheme of `scipy.sparse.linalg.expm_multiply`)
+    over the block-diagonal Laplacian: exp(A) X = (exp(A / s))^s X, with s chosen so that
+    ||A / s|| <= 1, each step summing terms until they fall below `tol` relative to the sum.
+    Unlike the Chebyshev series, this converges for directed graphs too.
+
+    operator: GraphOperator of the batch
+    E: (B, S, H, d)
+    """
+    B, S, H, D = E.size()
+    assert len(operator) == B and operator.max_num_nodes <= S, \
+        f"Expect {B} samples of at most {S} nodes, Got {operator.num_nodes.tolist()}"
+    out = torch.zeros(B, S, H, D, device=E.device, dtype=torch.promote_types(torch.bfloat16, E.dtype))
+    if operator.total_num_nodes == 0:
+        return out
+
+    # exp(-beta (L + I)) = exp(-beta) exp(-beta L)
+    mask = operator.mask(S)
+    X = E[mask].to(torch.float32).reshape(-1, H * D)
+    steps = max(1, math.ceil(beta * operator.norm))
+    F = X
+    for _ in range(steps):
+        term = F
+        for j in range(1, max_terms + 1):
+            term = (operator.L_rescaled @ term) * (-beta / (steps * j))
+            F = F + term
+            if term.abs().max() <= tol * F.abs().max():
+                break
+
+    # constant term of the Chebyshev series convention, see `DenseGraphOperator.kernel`
+    c_0 = _exp_kernel_coeff(0, beta, device=E.device)[0]
+    y = math.exp(-beta) * F + (c_0 / 2) * X
+    out[mask] = y.reshape(-1, H, D).bfloat16().to(out.dtype)
+    return out
+
+def _diffusion(
+        edge_index_list, 
+        num_nodes_list, 
+        E, 
+        k=64, 
+        beta=0.5, 
+        graph_context: GraphOperatorContext = None, 
+        tol=None, 
+        backend="chebyshev"
+    ):
+    """
+    Heat-kernel diffusion of the embeddings over each graph with a selectable backend:
+        - "chebyshev": K-term Chebyshev series with sparse matmuls, see `_chebyshev_diffusion`.
+        - "dense": Exact dense kernel, computed once per batch, see `DenseGraphOperator`.
+        - "expm_multiply": Exact sparse action of the kernel, see `_expm_multiply_diffusion`.
+        - "auto": "dense" for small or dense graphs, otherwise "expm_multiply" (or "chebyshev" with
+            an adaptive order `tol`), see `GraphOperatorContext.backends`.
+    All backends agree on undirected graphs, where the Chebyshev series converges.
+
+    edge index list: list of edge index, length B
+    E: (B, S, H, d)
+    graph_context: per-forward context sharing graph operators between layers
+    tol: tolerance of the adaptive Chebyshev order, see `_chebyshev_diffusion`
     """
+    if backend not in DIFFUSION_BACKENDS:
+        raise ValueError(f"Unknown diffusion backend {backend}, expected one of {DIFFUSION_BACKENDS}.")
+    if graph_context is None:
+        graph_context = GraphOperatorContext(edge_index_list, num_nodes_list)
+
+    if backend == "chebyshev":
+        return _chebyshev_diffusion(edge_index_list, num_nodes_list, E, k=k, beta=beta, graph_context=graph_context, tol=tol)
+    if backend == "dense":
+        return _dense_diffusion(graph_context.operator(E.device, dense=True), E, beta=beta)
+    if backend == "expm_multiply":
+        return _expm_multiply_diffusion(graph_context.operator(E.device), E, beta=beta)
+
+    groups = graph_context.backends(sparse_backend="chebyshev" if tol is not None else "expm_multiply")
+    if len(groups) == 1:
+        return _diffusion(edge_index_list, num_nodes_list, E, k=k, beta=beta, graph_context=graph_context, tol=tol, backend=next(iter(groups)))
+
+    out = torch.zeros(E.size(), device=E.device, dtype=torch.promote_types(torch.bfloat16, E.dtype))
+    if tol is not None:
+        k = _adaptive_order(k, beta, tol)
+    for group, samples in groups.items():
+        index = torch.tensor(samples, device=E.device)
+        if group == "dense":
+            out[index] = _dense_diffusion(graph_context.operator(E.device, samples, dense=True), E[index], beta=beta)
+        elif group == "expm_multiply":
+            out[index] = _expm_multiply_diffusion(graph_context.operator(E.device, samples), E[index], beta=beta)
+        else:
+            out[index] = _chebyshev_diffusion_batched(graph_context.operator(E.device, samples), E[index], k=k, beta=beta)
+    return out
+
+def _chebyshev_diffusion_looped(edge_index_list, num_nodes_list, E, k=64, beta=0.5):
+    """
+    Reference implementation of `_chebyshev_diffusion`, diffusing one sample at a time.
+
     edge index list: list of edge index, length B
     E: (B, S, H, d)
     """
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from typing import Union, Dict, List
 
 from scGraphLLM._globals import *
@@ -9,37 +10,85 @@ from scGraphLLM.network import RegulatoryNetwork
 def build_class_edge_matrix(
         class_networks: Dict[str, RegulatoryNetwork], 
         classes: List[str], 
-        default_alpha: float
+        default_alpha: float,
+        sparse: bool = False
     ):
     """
     Build edge × class matrix of p-values. Missing edges use default_alpha.
+
+    Edges are encoded as integer keys over a shared, sorted gene dictionary, so the global
+    edge set is a sorted union of keys and each class network is placed with `searchsorted`.
+
+    Args:
+        class_networks (Dict[str, RegulatoryNetwork]): Network of each class.
+        classes (List[str]): Classes, in the order of the columns of the matrices.
+        default_alpha (float): p-value of edges missing from a class network.
+        sparse (bool): If True, return E and W as sparse matrices holding only the edges
+            present in each class network. Missing entries are implied to be `default_alpha`
+            in E and NaN in W.
+
+    Returns:
+        E (np.ndarray or scipy.sparse.csr_matrix): [num_edges x num_classes] matrix of p-values.
+        W (np.ndarray or scipy.sparse.csr_matrix): [num_edges x num_classes] matrix of weights.
+        all_edges (np.ndarray): [num_edges x 2] array of (regulator, target) edges, sorted.
     """
-    # Identify global set of edges
-    all_edges = set()
-    for network in class_networks.values():
-        all_edges.update(network.edges)
-    all_edges = sorted(list(all_edges))
-    
-    edge_to_idx = {e: i for i, e in enumerate(all_edges)}
-    num_edges = len(all_edges)
+    networks = [class_networks[c] for c in classes]
+
+    # shared gene dictionary, sorted so that edge keys sort like (regulator, target) tuples
+    gene_names = np.sort(pd.unique(np.concatenate([list(network.genes) for network in networks] + [[]])).astype(str))
+    num_genes = max(len(gene_names), 1)
+    keys = [network.edge_keys(gene_names) for network in networks]
+
+    # global set of edges
+    all_keys = np.sort(np.concatenate(keys))
+    all_keys = all_keys[np.concatenate([[True], all_keys[1:] != all_keys[:-1]])] if len(all_keys) > 0 else all_keys
+    num_edges = len(all_keys)
     num_classes = len(classes)
 
-    # Initialize matrix with default alpha
-    E = np.full((num_edges, num_classes), default_alpha, dtype=np.float32)
-    W = np.full((num_edges, num_classes), np.nan, dtype=np.float32)
+    rows, cols, pvals, weights = [], [], [], []
+    for j, (network, class_keys) in enumerate(zip(networks, keys)):
+        # the last occurrence of a duplicated edge wins
+        _, last = np.unique(class_keys[::-1], return_index=True)
+        positions = len(class_keys) - 1 - last
+        rows.append(np.searchsorted(all_keys, class_keys[positions]))
+        cols.append(np.full(len(positions), j))
+        pvals.append(np.exp(network.likelihoods.to_numpy()[positions]))
+        weights.append(network.weights.to_numpy()[positions])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    pvals, weights = np.concatenate(pvals).astype(np.float32), np.concatenate(weights).astype(np.float32)
+
+    if sparse:
+        E = sp.csr_matrix((pvals, (rows, cols)), shape=(num_edges, num_classes))
+        W = sp.csr_matrix((weights, (rows, cols)), shape=(num_edges, num_classes))
+    else:
+        # Initialize matrix with default alpha
+        E = np.full((num_edges, num_classes), default_alpha, dtype=np.float32)
+        W = np.full((num_edges, num_classes), np.nan, dtype=np.float32)
+        E[rows, cols] = pvals
+        W[rows, cols] = weights
+
+    all_edges = np.stack([gene_names[all_keys // num_genes], gene_names[all_keys % num_genes]], axis=1)
+    return E, W, all_edges
 
-    for j, c in enumerate(classes):
-        network = class_networks[c]
-        for i, e in enumerate(network.edges):
-            idx = edge_to_idx[e]
-            edge = network.df.iloc[i]
-            E[idx, j] = np.exp(edge[network.lik_name])
-            W[idx, j] = edge[network.wt_name]
 
-    return E, W, np.array(all_edges)
+def build_class_edge_ids(class_networks: Dict[str, RegulatoryNetwork], all_edges: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Maps each class to the indices (into `all_edges`) of the edges of its network, in network order.
 
+    Args:
+        class_networks (Dict[str, RegulatoryNetwork]): Network of each class.
+        all_edges (np.ndarray): [num_edges x 2] sorted array of edges from `build_class_edge_matrix`.
 
-def infer_cell_edges_(probs, E, W, alpha=None):
+    Returns:
+        Dict[str, np.ndarray]: Edge indices of each class network.
+    """
+    gene_names = np.unique(all_edges)
+    num_genes = max(len(gene_names), 1)
+    all_keys = np.searchsorted(gene_names, all_edges[:, 0]).astype(np.int64) * num_genes + np.searchsorted(gene_names, all_edges[:, 1])
+    return {c: np.searchsorted(all_keys, network.edge_keys(gene_names)) for c, network in class_networks.items()}
+
+
+def infer_cell_edges_(probs, E, W, alpha=None, default_alpha=None):
     """
     Fast inference using precomputed class-edge matrix.
 
@@ -48,6 +97,7 @@ def infer_cell_edges_(probs, E, W, alpha=None):
     - E: [num_edges x num_classes] matrix of per-class p-values
     - all_edges: list of edge tuples (same order as rows in E)
     - alpha: optional p-value threshold
+    - default_alpha: p-value of missing edges, required if E and W are sparse
 
     Returns:
     - List of edge indices (integers into all_edges) passing the threshold
@@ -58,6 +108,9 @@ def infer_cell_edges_(probs, E, W, alpha=None):
 
     assert np.abs(probs.sum() - 1.0) < 1e-4, "probs must sum to 1"
 
+    if sp.issparse(E):
+        return _infer_cell_edges_sparse(probs, E, W, alpha, default_alpha)
+
     expected_pvals = E @ probs
     # if using default W = 0
     # expected_wts = W @ probs
@@ -75,3 +128,105 @@ def infer_cell_edges_(probs, E, W, alpha=None):
         edge_ids = np.arange(len(expected_pvals))
 
     return edge_ids, expected_pvals, expected_wts
+
+
+def infer_cells_edges(P, E, W, alpha=None, chunk_size=1024, default_alpha=None):
+    """
+    Batched counterpart of `infer_cell_edges_`, inferring the networks of many cells at once.
+
+    Expected p-values and weights are computed for a block of `chunk_size` cells with one
+    matrix product per quantity, and the NaN mask of W is computed once for all cells, so
+    memory is bounded by `num_edges x chunk_size`. Cells whose probabilities are all zero
+    get no edges.
+
+    Args:
+        P (np.ndarray): [num_cells x num_classes] matrix of class probabilities.
+        E (np.ndarray or scipy.sparse.spmatrix): [num_edges x num_classes] matrix of per-class p-values.
+        W (np.ndarray or scipy.sparse.spmatrix): [num_edges x num_classes] matrix of per-class weights.
+        alpha (float, optional): p-value threshold.
+        chunk_size (int): Number of cells processed at a time.
+        default_alpha (float, optional): p-value of missing edges, required if E and W are sparse.
+
+    Returns:
+        indptr (np.ndarray): [num_cells + 1] offsets, the edges of cell `i` are at `indptr[i]:indptr[i + 1]`.
+        edge_ids (np.ndarray): Indices (into all_edges) of the edges passing the threshold.
+        pvals (np.ndarray): Expected p-value of each edge.
+        weights (np.ndarray): Expected weight of each edge.
+    """
+    P = np.atleast_2d(np.asarray(P, dtype=np.float64))
+    sums = P.sum(axis=1)
+    has_probs = sums != 0
+    assert np.all(np.abs(sums[has_probs] - 1.0) < 1e-4), "probs must sum to 1"
+
+    # NaN mask and NaN-free weights, computed once for all cells
+    if sp.issparse(E):
+        if default_alpha is None:
+            raise ValueError("default_alpha is required to infer edges from sparse class-edge matrices.")
+        E, W = sp.csr_matrix(E), sp.csr_matrix(W)
+        present = E.copy()
+        present.data[:] = 1
+        mask = W.copy()
+        mask.data = (~np.isnan(W.data)).astype(W.dtype)
+        weighted = W.copy()
+        weighted.data = np.nan_to_num(W.data, nan=0.0)
+    else:
+        present = None
+        mask = (~np.isnan(W)).astype(W.dtype)
+        weighted = np.nan_to_num(W, nan=0.0)
+
+    counts, edge_ids, pvals, weights = [], [], [], []
+    for start in range(0, len(P), chunk_size):
+        probs = P[start:start + chunk_size].T
+        expected_pvals = E @ probs
+        if present is not None:
+            expected_pvals = expected_pvals + default_alpha * (probs.sum(axis=0) - present @ probs)
+        weight_sums = mask @ probs
+        expected_wts = np.divide(weighted @ probs, weight_sums, out=np.zeros_like(weight_sums), where=weight_sums != 0)
+
+        keep = expected_pvals <= alpha if alpha is not None else np.ones(expected_pvals.shape, dtype=bool)
+        keep[:, ~has_probs[start:start + chunk_size]] = False
+
+        # transpose so that edges are grouped by cell
+        cells, edges = np.nonzero(keep.T)
+        counts.append(np.bincount(cells, minlength=probs.shape[1]))
+        edge_ids.append(edges)
+        pvals.append(expected_pvals[edges, cells])
+        weights.append(expected_wts[edges, cells])
+
+    if len(counts) == 0:
+        return np.zeros(1, dtype=np.int64), np.array([], dtype=np.int64), np.array([]), np.array([])
+
+    indptr = np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+    return indptr, np.concatenate(edge_ids), np.concatenate(pvals), np.concatenate(weights)
+
+
+def _infer_cell_edges_sparse(probs, E, W, alpha, default_alpha):
+    """
+    Counterpart of `infer_cell_edges_` for the sparse matrices of `build_class_edge_matrix`,
+    where missing entries are implied to be `default_alpha` in E and NaN in W.
+    """
+    if default_alpha is None:
+        raise ValueError("default_alpha is required to infer edges from sparse class-edge matrices.")
+
+    E, W = sp.csr_matrix(E), sp.csr_matrix(W)
+    present = E.copy()
+    present.data[:] = 1
+    expected_pvals = E @ probs + default_alpha * (probs.sum() - present @ probs)
+
+    # missing weights are excluded from the expected weight
+    mask = W.copy()
+    mask.data = (~np.isnan(W.data)).astype(W.dtype)
+    weighted = W.copy()
+    weighted.data = np.nan_to_num(W.data, nan=0.0)
+    weighted_mis = weighted @ probs
+    weight_sums = mask @ probs
+    expected_wts = np.divide(weighted_mis, weight_sums, out=np.zeros_like(weight_sums), where=weight_sums != 0)
+
+    if alpha is not None:
+        edge_ids = np.where(expected_pvals <= alpha)[0]
+        expected_pvals = expected_pvals[edge_ids]
+        expected_wts = expected_wts[edge_ids]
+    else:
+        edge_ids = np.arange(len(expected_pvals))
+
+    return edge_ids, expected_pvals, expected_wts
@@ -1,9 +1,11 @@
+import os
 from tqdm import tqdm
 from functools import partial
 from collections import defaultdict
 from typing import Literal
 import numpy as np
 import pandas as pd
+import anndata as ad
 import torch
 from torch.utils.data import DataLoader
 
@@ -11,6 +13,9 @@ from scGraphLLM.data import GraphTransformerDataset, send_to_gpu
 from scGraphLLM.vocab import GeneVocab
 from scGraphLLM.network import RegulatoryNetwork
 from scGraphLLM.tokenizer import GraphTokenizer
+from scGraphLLM.token_cache import TokenizationCache
+from scGraphLLM.embedding_writer import EmbeddingWriter
+from scGraphLLM.samplers import LengthBucketSampler
 
 
 class InferenceDataset(GraphTransformerDataset):
@@ -24,12 +29,32 @@ class InferenceDataset(GraphTransformerDataset):
         expression (pd.DataFrame): Gene expression matrix (cells x genes).
         tokenizer (GraphTokenizer): Tokenizer to tokenize each cell into and compute its edge index.
         cache_dir (str, optional): Directory to cache tokenized data.
+        token_cache (TokenizationCache, optional): Cache of tokenized cells, attached to `tokenizer`
+            so that repeated passes over the same cells skip tokenization.
+        precompute_laplacian (bool): Whether batches carry their graph Laplacian, built (and
+            validated) by the collate function in the DataLoader workers, see `laplacian_csr`.
     """
-    def __init__(self, expression: pd.DataFrame, tokenizer: GraphTokenizer, cache_dir=None):
+    def __init__(
+            self, 
+            expression: pd.DataFrame, 
+            tokenizer: GraphTokenizer, 
+            cache_dir=None, 
+            token_cache: TokenizationCache = None, 
+            precompute_laplacian=False
+        ):
+        if token_cache is not None:
+            tokenizer.cache = token_cache
         self.tokenizer = tokenizer
         self.obs_names = expression.index
         self.expression = expression[expression.columns[expression.columns.isin(self.gene_to_node)]]
-        super().__init__(cache_dir=cache_dir, vocab=tokenizer.vocab, mask_fraction=0.0, inference=True)
+        self._sequence_lengths = {}
+        super().__init__(
+            cache_dir=cache_dir, 
+            vocab=tokenizer.vocab, 
+            mask_fraction=0.0, 
+            inference=True, 
+            precompute_laplacian=precompute_laplacian
+        )
     
     @property
     def gene_to_node(self):
@@ -46,6 +71,18 @@ class InferenceDataset(GraphTransformerDataset):
     def __len__(self):
         return len(self.expression)
 
+    def sequence_lengths(self, block_size=1024, with_edges=False):
+        """
+        Number of gene tokens of each cell, computed in vectorized blocks without tokenizing
+        the cells. Used by `LengthBucketSampler` to batch cells of similar length. With
+        `with_edges`, a tuple of the number of tokens and the number of edges of each cell.
+        """
+        if with_edges not in self._sequence_lengths:
+            self._sequence_lengths[with_edges] = self.tokenizer.sequence_lengths(
+                self.expression.to_numpy(), self.expression.columns, block_size=block_size, with_edges=with_edges
+            )
+        return self._sequence_lengths[with_edges]
+
     def __getitem__(self, idx):
         """
         Returns a tokenized representation of the cell at the given index.
@@ -60,8 +97,31 @@ class InferenceDataset(GraphTransformerDataset):
         data = self.tokenizer(cell)
         item = self._item_from_tokenized_data(data)
         item["obs_name"] = self.obs_names[idx]
+        item["obs_index"] = idx
         return item
 
+    def __getitems__(self, indices):
+        """
+        Returns tokenized representations of the cells at the given indices.
+
+        Cells are tokenized together in one vectorized pass with `GraphTokenizer.tokenize_batch`.
+        `DataLoader` uses this method to fetch whole batches at once.
+
+        Args:
+            indices (List[int]): Indices of the cells.
+
+        Returns:
+            List[dict]: Tokenized representations, in the order of `indices`.
+        """
+        cells = self.expression.iloc[indices]
+        items = []
+        for idx, data in zip(indices, self.tokenizer.tokenize_batch(cells.to_numpy(), cells.columns)):
+            item = self._item_from_tokenized_data(data)
+            item["obs_name"] = self.obs_names[idx]
+            item["obs_index"] = idx
+            items.append(item)
+        return items
+
 
 class VariableNetworksInferenceDataset(InferenceDataset):
     """
@@ -76,9 +136,22 @@ class VariableNetworksInferenceDataset(InferenceDataset):
         weights_list (List[np.ndarray], optional): List of edge weights per cell.
         limit_regulon (int, optional): Limit number of regulators per target gene.
         limit_graph (int, optional): Limit the total number of edges in the graph.
-        drop_unpaired (bool, optional): Whether to drop directed (unpaired) edges when making
-            the graph directed.
+        drop_unpaired (bool, optional): If given, cell networks are made undirected: with False,
+            the reverse of each unpaired edge is added, with True, unpaired edges are dropped.
+        network_ids (array-like, optional): Index of the network of each cell, e.g. the class
+            of cells hard-assigned to class networks. Cells with the same non-negative index share
+            one network, so their entries in `edge_ids_list` (and `weights_list`) must be equal.
+            Cells with a negative index have their own network. By default, no network is shared.
         **kwargs: Additional arguments passed to `InferenceDataset`.
+
+    Edges are held as integer arrays: `all_edges` is encoded once into a `RegulatoryNetwork`,
+    and the edge ids and weights of all cells are concatenated into CSR-style arrays, so each
+    cell's network is carved out of the shared table (and pruned and made undirected) with
+    array operations on its slice.
+
+    Cells with the same index in `network_ids` share a single row of the table and a single
+    `RegulatoryNetwork`. It is built once together with its adjacency index, and cells sharing
+    it are tokenized together.
     """
     def __init__(
             self, 
@@ -88,15 +161,43 @@ class VariableNetworksInferenceDataset(InferenceDataset):
             limit_regulon=None,
             limit_graph=None,
             drop_unpaired=None,
+            network_ids=None,
             **kwargs
         ):
         super().__init__(**kwargs)
-        self.edge_ids_list = edge_ids_list
-        self.all_edges = np.array(all_edges)
-        self.weights_list = weights_list
+        self.all_edges = np.array(all_edges).reshape(-1, 2)
         self.limit_regulon = limit_regulon
         self.limit_graph = limit_graph
         self.drop_unpaired = drop_unpaired
+        self.edge_table = RegulatoryNetwork(self.all_edges[:, 0], self.all_edges[:, 1], weights=None, likelihoods=None)
+
+        # one row per shared network and per cell with its own network
+        if network_ids is None:
+            network_ids = np.full(len(edge_ids_list), -1, dtype=np.int64)
+        network_ids = np.asarray(network_ids, dtype=np.int64)
+        if len(network_ids) != len(edge_ids_list):
+            raise ValueError(f"Expected {len(edge_ids_list)} network ids, got {len(network_ids)}.")
+        network_keys = [
+            ("network", network_id) if network_id >= 0 else ("cell", idx)
+            for idx, network_id in enumerate(network_ids.tolist())
+        ]
+        rows = {}
+        for idx, key in enumerate(network_keys):
+            rows.setdefault(key, idx)
+        first_cells = list(rows.values())
+        row_of_key = {key: row for row, key in enumerate(rows)}
+        self.cell_rows = np.array([row_of_key[key] for key in network_keys], dtype=np.int64)
+
+        lengths = [len(edge_ids_list[idx]) for idx in first_cells]
+        self.indptr = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        self.edge_ids = np.concatenate([np.asarray(edge_ids_list[idx], dtype=np.int64).ravel() for idx in first_cells] + [np.zeros(0, dtype=np.int64)])
+        self.weights = None
+        if weights_list:
+            self.weights = np.concatenate([np.asarray(weights_list[idx], dtype=np.float32).ravel() for idx in first_cells] + [np.zeros(0, dtype=np.float32)])
+
+        counts = np.bincount(self.cell_rows, minlength=len(first_cells))
+        self.shared_rows = counts > 1
+        self._shared_networks = {}
     
     @property
     def prune_graph(self):
@@ -106,33 +207,461 @@ class VariableNetworksInferenceDataset(InferenceDataset):
     def make_undirected(self):
         return self.drop_unpaired is not None
 
-    def __getitem__(self, idx):
-        cell = self.expression.iloc[idx]
-        edge_ids = self.edge_ids_list[idx]
-        edges = self.all_edges[edge_ids]
-        regulators, targets = zip(*edges)
-        weights = self.weights_list[idx] if self.weights_list else None
-        cell_network = RegulatoryNetwork(regulators=regulators, targets=targets, weights=weights, likelihoods=None)
+    def cell_network(self, idx) -> RegulatoryNetwork:
+        """
+        Returns the regulatory network of the cell at the given index, pruned and made
+        undirected as configured. Networks shared by several cells are built once.
+        """
+        row = self.cell_rows[idx]
+        if row in self._shared_networks:
+            return self._shared_networks[row]
+
+        start, end = self.indptr[row], self.indptr[row + 1]
+        weights = self.weights[start:end] if self.weights is not None else None
+        cell_network = self.edge_table.take(self.edge_ids[start:end], weights=weights)
 
         if self.prune_graph:
             cell_network.prune(limit_regulon=self.limit_regulon, limit_graph=self.limit_graph, inplace=True)
         
         if self.make_undirected:
-            cell_network.make_undirected(drop_unpaired=self.drop_unpaired)
-        
-        data = self.tokenizer(cell, cell_network)
+            cell_network.make_undirected(drop_unpaired=self.drop_unpaired, inplace=True)
+
+        if self.shared_rows[row]:
+            self._shared_networks[row] = cell_network
+        return cell_network
+
+    def sequence_lengths(self, block_size=1024, with_edges=False):
+        """
+        Number of gene tokens (and edges, with `with_edges`) of each cell, computed against each
+        cell's own network. Cells sharing a network are processed together.
+        """
+        if with_edges not in self._sequence_lengths:
+            lengths = np.zeros(len(self), dtype=np.int64)
+            num_edges = np.zeros(len(self), dtype=np.int64)
+            order = np.argsort(self.cell_rows, kind="stable")
+            bounds = np.flatnonzero(np.diff(self.cell_rows[order])) + 1
+            for cells in np.split(order, bounds):
+                if len(cells) == 0:
+                    continue
+                expression = self.expression.iloc[cells]
+                sizes = self.tokenizer.sequence_lengths(
+                    expression.to_numpy(), 
+                    expression.columns, 
+                    override_network=self.cell_network(cells[0]), 
+                    block_size=block_size,
+                    with_edges=with_edges
+                )
+                if with_edges:
+                    lengths[cells], num_edges[cells] = sizes
+                else:
+                    lengths[cells] = sizes
+            self._sequence_lengths[with_edges] = (lengths, num_edges) if with_edges else lengths
+        return self._sequence_lengths[with_edges]
+
+    def __getitem__(self, idx):
+        cell = self.expression.iloc[idx]
+        data = self.tokenizer(cell, self.cell_network(idx))
         item = self._item_from_tokenized_data(data)
         item["obs_name"] = self.obs_names[idx]
+        item["obs_index"] = idx
 
         return item
+
+    def __getitems__(self, indices):
+        """
+        Returns tokenized representations of the cells at the given indices. Cells sharing
+        a network are tokenized together with `GraphTokenizer.tokenize_batch`, the others
+        one at a time.
+        """
+        items = [None] * len(indices)
+        positions_by_row = defaultdict(list)
+        for position, idx in enumerate(indices):
+            positions_by_row[self.cell_rows[idx]].append(position)
+
+        for row, positions in positions_by_row.items():
+            if not self.shared_rows[row]:
+                for position in positions:
+                    items[position] = self[indices[position]]
+                continue
+
+            cell_indices = [indices[position] for position in positions]
+            cells = self.expression.iloc[cell_indices]
+            network = self.cell_network(cell_indices[0])
+            tokenized = self.tokenizer.tokenize_batch(cells.to_numpy(), cells.columns, override_network=network)
+            for position, idx, data in zip(positions, cell_indices, tokenized):
+                item = self._item_from_tokenized_data(data)
+                item["obs_name"] = self.obs_names[idx]
+                item["obs_index"] = idx
+                items[position] = item
+
+        return items
     
 
+class CellEmbeddingAccumulator(object):
+    """
+    Pools the token embeddings of each batch of cells into cell embeddings.
+
+    Depending on `cls_policy`, embeddings are derived by:
+        - "include": Mean-pooling over all gene nodes, including the CLS token (default).
+        - "exclude": Mean-pooling over all gene nodes, excluding the CLS token.
+        - "only": Using only the CLS token embedding for each cell.
+
+    Args:
+        cls_policy (str): One of {"include", "exclude", "only"} determining how CLS tokens
+            are handled during pooling.
+        vocab (GeneVocab, optional): Required if `cls_policy` is "exclude" or "only",
+            used to identify the CLS token node ID.
+        path (str, optional): If given, embeddings are streamed batch by batch to this `.h5ad`
+            file with an `EmbeddingWriter` instead of being held in memory.
+        obs (pd.DataFrame or pd.Index, optional): Observations of the file written to `path`,
+            required with `path`, in dataset order. Rows are placed by dataset position, so
+            observation names need not be unique.
+    """
+    def __init__(
+            self, 
+            cls_policy: Literal["include", "exclude", "only"] = "include", 
+            vocab: GeneVocab = None, 
+            path=None, 
+            obs=None
+        ):
+        assert cls_policy in {"include", "exclude", "only"}
+        if cls_policy != "include" and vocab is None:
+            raise ValueError("vocab must be provided if include_cls is not 'include'")
+        if path is not None and obs is None:
+            raise ValueError("obs must be provided to stream embeddings to a file")
+        self.cls_policy = cls_policy
+        self.vocab = vocab
+        self.path = path
+        self.obs = obs
+        self.writer = None
+        self.x_list = []
+        self.obs_names_list = []
+        self.obs_indices_list = []
+
+    def update(self, x: torch.Tensor, gene_ids: torch.Tensor, seq_lengths, obs_names, obs_indices=None):
+        """
+        Pools the token embeddings of a batch of cells.
+
+        Args:
+            x (torch.Tensor): [B, T, H] token embeddings.
+            gene_ids (torch.Tensor): [B, T] gene node id of each token.
+            seq_lengths (array-like): Number of (non-padding) tokens of each cell.
+            obs_names (array-like): Observation name of each cell.
+            obs_indices (array-like, optional): Dataset position of each cell, given when batches
+                do not arrive in dataset order. The result is then restored to the dataset order.
+        """
+        if self.cls_policy == "only":
+            # extract CLS token (assumed to be at position where orig_gene_id == vocab.cls_node)
+            cls_mask = (gene_ids == self.vocab.cls_node).to(x.device)  # [B, T]
+            cls_indices = cls_mask.float().argmax(dim=1)  # assume one CLS per cell
+            x_cell = x[torch.arange(x.size(0)), cls_indices]  # [B, H]
+        else:
+            # create mask: optionally exclude CLS
+            seq_lengths = torch.as_tensor(np.asarray(seq_lengths), device=x.device)
+            mask = torch.arange(x.shape[1], device=x.device).unsqueeze(0) < seq_lengths.unsqueeze(1)
+            if self.cls_policy == "exclude":
+                cls_mask = (gene_ids == self.vocab.cls_node).to(x.device)
+                mask = mask & (~cls_mask)
+            mask = mask.unsqueeze(-1).float()
+            x_masked = x * mask
+            x_cell = x_masked.sum(dim=1) / mask.sum(dim=1)
+
+        x_cell = x_cell.detach().cpu().numpy()
+        if self.path is None:
+            self.x_list.append(x_cell)
+            self.obs_names_list.append(obs_names)
+            if obs_indices is not None:
+                self.obs_indices_list.append(obs_indices)
+            return
+
+        if self.writer is None:
+            self.writer = EmbeddingWriter(self.path, self.obs, n_dims=x_cell.shape[1])
+        self.writer.write(x_cell, obs_indices)
+
+    def result(self):
+        """
+        Returns:
+            pd.DataFrame or ad.AnnData: DataFrame of cell-level embeddings with cell names as the index
+                and hidden dimensions as columns. When streaming to `path`, the file is closed
+                and opened as a backed AnnData instead.
+        """
+        if self.path is None:
+            x, obs_names = np.vstack(self.x_list), np.concatenate(self.obs_names_list)
+            if self.obs_indices_list:
+                # inverse permutation of the batch order, by position so that repeated names are fine
+                order = np.argsort(np.concatenate(self.obs_indices_list), kind="stable")
+                x, obs_names = x[order], obs_names[order]
+            return pd.DataFrame(x, index=obs_names)
+
+        self.writer.close()
+        return ad.read_h5ad(self.path, backed="r")
+
+
+class GeneEmbeddingAccumulator(object):
+    """
+    Accumulates per-gene token embeddings across batches on the model's device.
+
+    Token embeddings are scattered with `index_add_` into preallocated `[groups * num_nodes, H]`
+    buffers, indexed by gene node id (and group), so that each batch costs a few tensor
+    operations and the buffers are copied to the host once, when the result is requested.
+    With `with_variance`, running means and sums of squared deviations are merged batch by
+    batch (Welford/Chan update), giving per-gene variances in the same single pass.
+
+    Args:
+        vocab (GeneVocab): Vocabulary of the gene node ids, used to translate them back to gene names.
+        include_cls (bool): Whether to keep the CLS token (identified via `vocab.cls_node`) in the result.
+        groups (pd.Series, optional): Group label of each cell (e.g. a cell type column of `obs`),
+            indexed by observation name. Cells missing from `groups` or with a null label are skipped.
+        with_variance (bool): Whether to also accumulate per-gene variances.
+    """
+    def __init__(self, vocab: GeneVocab, include_cls=False, groups: pd.Series = None, with_variance=False):
+        self.vocab = vocab
+        self.num_nodes = vocab.num_nodes
+        self.include_cls = include_cls
+        self.with_variance = with_variance
+        self.group_index, self.group_codes, self.group_labels = None, None, [None]
+        if groups is not None:
+            group_codes, group_labels = pd.factorize(groups)
+            self.group_index = pd.Index(groups.index)
+            self.group_codes = group_codes
+            self.group_labels = list(group_labels)
+        self.counts, self.sums, self.means, self.m2 = None, None, None, None
+
+    @property
+    def num_slots(self):
+        return len(self.group_labels) * self.num_nodes
+
+    def _allocate(self, x: torch.Tensor):
+        self.counts = torch.zeros(self.num_slots, dtype=torch.float32, device=x.device)
+        if self.with_variance:
+            self.means = torch.zeros(self.num_slots, x.shape[-1], dtype=torch.float32, device=x.device)
+            self.m2 = torch.zeros_like(self.means)
+        else:
+            self.sums = torch.zeros(self.num_slots, x.shape[-1], dtype=torch.float32, device=x.device)
+
+    def update(self, x: torch.Tensor, gene_ids: torch.Tensor, seq_lengths, obs_names=None, obs_indices=None):
+        """
+        Adds the token embeddings of a batch of cells.
+
+        Args:
+            x (torch.Tensor): [B, T, H] token embeddings.
+            gene_ids (torch.Tensor): [B, T] gene node id of each token.
+            seq_lengths (array-like): Number of (non-padding) tokens of each cell.
+            obs_names (array-like, optional): Observation name of each cell, required with `groups`.
+            obs_indices (array-like, optional): Dataset position of each cell, unused since gene
+                embeddings do not depend on the order of the cells.
+        """
+        if self.counts is None:
+            self._allocate(x)
+
+        device = x.device
+        seq_lengths = torch.as_tensor(np.asarray(seq_lengths), device=device)
+        mask = torch.arange(x.shape[1], device=device).unsqueeze(0) < seq_lengths.unsqueeze(1)
+
+        slots = gene_ids.to(device=device, dtype=torch.long)
+        if self.group_codes is not None:
+            positions = self.group_index.get_indexer(obs_names)
+            cell_groups = np.where(positions >= 0, self.group_codes[positions], -1)
+            cell_groups = torch.as_tensor(cell_groups, device=device, dtype=torch.long)
+            mask = mask & (cell_groups >= 0).unsqueeze(1)
+            slots = slots + cell_groups.clamp(min=0).unsqueeze(1) * self.num_nodes
+
+        slots = slots[mask]
+        x_tokens = x[mask].float()
+        batch_counts = torch.zeros_like(self.counts).index_add_(0, slots, torch.ones_like(slots, dtype=torch.float32))
+
+        if not self.with_variance:
+            self.sums.index_add_(0, slots, x_tokens)
+            self.counts += batch_counts
+            return
+
+        # merge the batch mean and squared deviations into the running statistics
+        batch_means = torch.zeros_like(self.means).index_add_(0, slots, x_tokens)
+        batch_means /= batch_counts.clamp(min=1).unsqueeze(1)
+        batch_m2 = torch.zeros_like(self.m2).index_add_(0, slots, (x_tokens - batch_means[slots]) ** 2)
+        counts = self.counts + batch_counts
+        delta = batch_means - self.means
+        weight = (batch_counts / counts.clamp(min=1)).unsqueeze(1)
+        self.means += delta * weight
+        self.m2 += batch_m2 + delta ** 2 * (self.counts.unsqueeze(1) * weight)
+        self.counts = counts
+
+    def result(self):
+        """
+        Returns the mean embedding (and variance, with `with_variance`) of each gene seen at least once.
+
+        Returns:
+            pd.DataFrame or Tuple[pd.DataFrame, pd.DataFrame]: Mean embeddings, one row per gene
+                (indexed by gene name, or by group and gene name with `groups`). With `with_variance`,
+                also the per-gene (unbiased) variances, NaN for genes seen once.
+        """
+        counts = self.counts.cpu().numpy()
+        slots = np.flatnonzero(counts)
+        nodes = slots % self.num_nodes
+        if not self.include_cls:
+            slots, nodes = slots[nodes != self.vocab.cls_node], nodes[nodes != self.vocab.cls_node]
+
+        genes = [self.vocab.node_to_gene[node] for node in nodes]
+        if self.group_codes is None:
+            index = pd.Index(genes)
+        else:
+            groups = [self.group_labels[slot // self.num_nodes] for slot in slots]
+            index = pd.MultiIndex.from_arrays([groups, genes])
+
+        counts = counts[slots, None]
+        if not self.with_variance:
+            return pd.DataFrame(self.sums.cpu().numpy()[slots] / counts, index=index)
+
+        means = pd.DataFrame(self.means.cpu().numpy()[slots], index=index)
+        variances = self.m2.cpu().numpy()[slots] / np.where(counts > 1, counts - 1, np.nan)
+        return means, pd.DataFrame(variances, index=index)
+
+
+def _forward_pass(
+        dataset: InferenceDataset, 
+        model: "GDTransformer", 
+        consumers, 
+        batch_size=256, 
+        bucket_by_length=False, 
+        max_tokens_per_batch=None, 
+        max_edges_per_batch=None
+    ):
+    """
+    Runs every batch of the dataset through the model once and feeds its token embeddings to each consumer.
+    When batches are bucketed by length, consumers also get the dataset position of each cell, to
+    restore the dataset order.
+    """
+    bucketed = bucket_by_length or max_tokens_per_batch is not None or max_edges_per_batch is not None
+    if max_tokens_per_batch is not None or max_edges_per_batch is not None:
+        # pack cells of similar length up to the token/edge budgets, the batch size is then variable
+        if max_edges_per_batch is not None:
+            lengths, num_edges = dataset.sequence_lengths(with_edges=True)
+        else:
+            lengths, num_edges = dataset.sequence_lengths(), None
+        dataloader = DataLoader(
+            dataset=dataset,
+            batch_sampler=LengthBucketSampler(
+                lengths, 
+                max_tokens=max_tokens_per_batch, 
+                num_edges=num_edges, 
+                max_edges=max_edges_per_batch,
+                extra_tokens=1  # CLS token
+            ),
+            collate_fn=dataset.collate_fn,
+            pin_memory=dataset.precompute_laplacian and torch.cuda.is_available()
+        )
+    elif bucket_by_length:
+        # batch cells of similar length, in a deterministic order
+        dataloader = DataLoader(
+            dataset=dataset,
+            batch_sampler=LengthBucketSampler(dataset.sequence_lengths(), batch_size=batch_size),
+            collate_fn=dataset.collate_fn,
+            pin_memory=dataset.precompute_laplacian and torch.cuda.is_available()
+        )
+    else:
+        dataloader = DataLoader(
+            dataset=dataset, 
+            batch_size=batch_size, 
+            shuffle=False, 
+            collate_fn=dataset.collate_fn,
+            pin_memory=dataset.precompute_laplacian and torch.cuda.is_available()
+        )
+
+    with torch.no_grad():
+        for batch in tqdm(dataloader, desc="Forward Pass"):
+            gpu_batch = send_to_gpu(batch)
+            x = model(gpu_batch)[0]  # shape: [B, T, H]
+            obs_indices = batch["obs_index"] if bucketed else None
+            for consumer in consumers:
+                consumer.update(x, gpu_batch["orig_gene_id"], batch["num_nodes"], batch["obs_name"], obs_indices)
+
+
+EMBEDDING_OUTPUTS = ("cell", "cell_with_cls", "cell_only_cls", "gene")
+
+
+def get_embeddings(
+        dataset: InferenceDataset,
+        model: "GDTransformer",
+        vocab: GeneVocab,
+        outputs=("cell_with_cls", "gene"),
+        batch_size=256,
+        groups: pd.Series = None,
+        return_variance=False,
+        out_dir=None,
+        obs: pd.DataFrame = None,
+        bucket_by_length=False,
+        max_tokens_per_batch=None,
+        max_edges_per_batch=None
+    ) -> dict:
+    """
+    Computes several kinds of embeddings in a single pass over the dataset.
+
+    Each batch is tokenized and run through the model once, and its token embeddings are
+    fed to one consumer per requested output:
+        - "cell": Mean-pooled cell embeddings, excluding the CLS token.
+        - "cell_with_cls": Mean-pooled cell embeddings, including the CLS token.
+        - "cell_only_cls": CLS token embedding of each cell.
+        - "gene": Average embedding of each gene, see `get_gene_embeddings`.
+
+    Args:
+        dataset (InferenceDataset): Dataset containing graph-structured cell inputs.
+        model (GDTransformer): Trained model that outputs sequence (node-level) embeddings.
+        vocab (GeneVocab): Identifies the CLS token and translates node ids back to gene names.
+        outputs (Iterable[str]): Embeddings to compute, from `EMBEDDING_OUTPUTS`.
+        batch_size (int): Number of cells to process per batch.
+        groups (pd.Series, optional): Group label of each cell, stratifies the "gene" output.
+        return_variance (bool): Whether the "gene" output also includes per-gene variances.
+        out_dir (str, optional): If given, cell-level outputs are streamed batch by batch to
+            `<out_dir>/emb_<output>.h5ad` instead of being held in memory.
+        obs (pd.DataFrame, optional): Metadata of the cells written to `out_dir`, indexed by
+            observation name. Defaults to the dataset's observation names.
+        bucket_by_length (bool): Whether to batch cells of similar sequence length together with
+            `LengthBucketSampler` to reduce padding. Cell embeddings are returned in the original order.
+        max_tokens_per_batch (int, optional): If given, batches hold a variable number of cells of
+            similar length, packed up to this many (padded) tokens, CLS tokens included, instead
+            of `batch_size` cells.
+        max_edges_per_batch (int, optional): If given, batches are also limited to this many graph edges.
+
+    Returns:
+        dict: Result of each requested output, as returned by `get_cell_embeddings` and
+            `get_gene_embeddings`. Streamed outputs are returned as backed AnnData objects.
+    """
+    unknown = set(outputs) - set(EMBEDDING_OUTPUTS)
+    if unknown:
+        raise ValueError(f"Unknown outputs {sorted(unknown)}, expected any of {EMBEDDING_OUTPUTS}.")
+
+    consumers = {}
+    for output in outputs:
+        if output == "gene":
+            consumers[output] = GeneEmbeddingAccumulator(vocab, groups=groups, with_variance=return_variance)
+        else:
+            cls_policy = {"cell": "exclude", "cell_with_cls": "include", "cell_only_cls": "only"}[output]
+            path = os.path.join(out_dir, f"emb_{output}.h5ad") if out_dir is not None else None
+            consumers[output] = CellEmbeddingAccumulator(
+                cls_policy, 
+                vocab=vocab, 
+                path=path, 
+                obs=obs if obs is not None else dataset.obs_names
+            )
+
+    _forward_pass(
+        dataset, model, consumers.values(), batch_size, 
+        bucket_by_length=bucket_by_length, 
+        max_tokens_per_batch=max_tokens_per_batch, 
+        max_edges_per_batch=max_edges_per_batch
+    )
+    return {output: consumer.result() for output, consumer in consumers.items()}
+
+
 def get_cell_embeddings(
     dataset: InferenceDataset,
     model: "GDTransformer",
     vocab: GeneVocab = None,
     batch_size=256,
-    cls_policy: Literal["include", "exclude", "only"] = "include"
+    cls_policy: Literal["include", "exclude", "only"] = "include",
+    bucket_by_length=False,
+    max_tokens_per_batch=None,
+    max_edges_per_batch=None
 ):
     """
     Computes embeddings for each cell in the dataset using a trained GDTransformer model.
@@ -142,6 +671,8 @@ def get_cell_embeddings(
         - "exclude": Mean-pooling over all gene nodes, excluding the CLS token.
         - "only": Using only the CLS token embedding for each cell.
 
+    To compute several kinds of embeddings with a single forward pass, use `get_embeddings`.
+
     Args:
         dataset (InferenceDataset): Dataset containing graph-structured cell inputs.
         model (GDTransformer): Trained transformer model for graph-based gene expression.
@@ -150,50 +681,24 @@ def get_cell_embeddings(
         batch_size (int): Number of cells to process per batch.
         cls_policy (str): One of {"include", "exclude", "only"} determining how CLS tokens
             are handled during embedding computation.
+        bucket_by_length (bool): Whether to batch cells of similar sequence length together to
+            reduce padding. Embeddings are returned in the original order.
+        max_tokens_per_batch (int, optional): If given, batches are packed up to this many (padded)
+            tokens, CLS tokens included, instead of holding `batch_size` cells.
+        max_edges_per_batch (int, optional): If given, batches are also limited to this many graph edges.
 
     Returns:
         pd.DataFrame: DataFrame of cell-level embeddings with cell names as the index
             and hidden dimensions as columns.
     """
-    assert cls_policy in {"include", "exclude", "only"}
-    if cls_policy != "include" and vocab is None:
-        raise ValueError("vocab must be provided if include_cls is not 'include'")
-
-    dataloader = DataLoader(
-        dataset=dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        collate_fn=dataset.collate_fn
+    accumulator = CellEmbeddingAccumulator(cls_policy, vocab=vocab)
+    _forward_pass(
+        dataset, model, [accumulator], batch_size, 
+        bucket_by_length=bucket_by_length, 
+        max_tokens_per_batch=max_tokens_per_batch, 
+        max_edges_per_batch=max_edges_per_batch
     )
-
-    x_list = []
-    obs_names_list = []
-    with torch.no_grad():
-        for batch in tqdm(dataloader, desc="Forward Pass"):
-            seq_lengths = torch.tensor(batch["num_nodes"]).to("cuda")
-            obs_names = batch["obs_name"]
-            x = model(send_to_gpu(batch))[0]  # shape: [B, T, H]
-            gene_ids = batch["orig_gene_id"]  # shape: [B, T]
-
-            if cls_policy == "only":
-                # extract CLS token (assumed to be at position where orig_gene_id == vocab.cls_node)
-                cls_mask = (gene_ids == vocab.cls_node).to(x.device)  # [B, T]
-                cls_indices = cls_mask.float().argmax(dim=1)  # assume one CLS per cell
-                x_cell = x[torch.arange(x.size(0)), cls_indices]  # [B, H]
-            else:
-                # create mask: optionally exclude CLS
-                mask = torch.arange(x.shape[1], device=x.device).unsqueeze(0) < seq_lengths.unsqueeze(1)
-                if cls_policy == "exclude":
-                    cls_mask = (gene_ids == vocab.cls_node).to(x.device)
-                    mask = mask & (~cls_mask)
-                mask = mask.unsqueeze(-1).float()
-                x_masked = x * mask
-                x_cell = x_masked.sum(dim=1) / mask.sum(dim=1)
-
-            x_list.append(x_cell.detach().cpu().numpy())
-            obs_names_list.append(obs_names)
-
-    return pd.DataFrame(np.vstack(x_list), index=np.concatenate(obs_names_list))
+    return accumulator.result()
 
 
 def get_gene_embeddings(
@@ -202,12 +707,19 @@ def get_gene_embeddings(
         vocab: GeneVocab,
         batch_size=256,
         include_cls=False,
-    ) -> pd.DataFrame:
+        groups: pd.Series = None,
+        return_variance=False,
+        bucket_by_length=False,
+        max_tokens_per_batch=None,
+        max_edges_per_batch=None
+    ):
     """
     Computes average embeddings for each gene across all cells in the dataset.
 
-    For each gene, this function collects its token embeddings from all cells where
-    it is expressed and computes the mean embedding vector.
+    For each gene, this function accumulates its token embeddings from all cells where
+    it is tokenized and computes the mean embedding vector. Embeddings are aggregated on
+    the model's device by `GeneEmbeddingAccumulator` in a single pass. To compute cell
+    embeddings in the same pass, use `get_embeddings`.
 
     Args:
         dataset (InferenceDataset): Dataset containing graph-structured cell inputs.
@@ -217,47 +729,25 @@ def get_gene_embeddings(
         batch_size (int): Number of cells to process per batch.
         include_cls (bool): Whether to include the CLS token in the final gene embeddings.
             If False, the CLS embedding (identified via `vocab.cls_node`) is excluded.
+        groups (pd.Series, optional): Group label of each cell (e.g. `adata.obs["cell_type"]`), indexed
+            by observation name. If given, gene embeddings are computed separately for each group.
+        return_variance (bool): Whether to also return the variance of each gene's embeddings.
+        bucket_by_length (bool): Whether to batch cells of similar sequence length together to
+            reduce padding.
+        max_tokens_per_batch (int, optional): If given, batches are packed up to this many (padded)
+            tokens, CLS tokens included, instead of holding `batch_size` cells.
+        max_edges_per_batch (int, optional): If given, batches are also limited to this many graph edges.
 
     Returns:
-        pd.DataFrame: DataFrame with one row per gene (indexed by gene name),
-            and one column per hidden dimension from the model.
+        pd.DataFrame: DataFrame with one row per gene (indexed by gene name, or by group and gene 
+            name if `groups` is given), and one column per hidden dimension from the model.
+            If `return_variance`, a tuple of the mean and variance DataFrames.
     """
-
-    dataloader = DataLoader(
-        dataset=dataset, 
-        batch_size=batch_size, 
-        shuffle=False, 
-        collate_fn=dataset.collate_fn
+    accumulator = GeneEmbeddingAccumulator(vocab, include_cls=include_cls, groups=groups, with_variance=return_variance)
+    _forward_pass(
+        dataset, model, [accumulator], batch_size, 
+        bucket_by_length=bucket_by_length, 
+        max_tokens_per_batch=max_tokens_per_batch, 
+        max_edges_per_batch=max_edges_per_batch
     )
-
-    gene_embedding_sums = dict()
-    gene_counts = defaultdict(int)
-    with torch.no_grad():
-        for batch in tqdm(dataloader, desc="Forward Pass"):
-            seq_lengths = torch.tensor(batch["num_nodes"]).to("cuda")
-            gene_ids = batch["orig_gene_id"].detach().cpu().numpy()
-            x = model(send_to_gpu(batch))[0] # shape: [B, T, H]
-            
-            for x_cell, ids, seq_len in zip(x, gene_ids, seq_lengths):
-                for j in range(seq_len):
-                    gene_id = ids[j]
-                    x_gene = x_cell[j].detach().cpu().numpy()
-                    if gene_id not in gene_embedding_sums:
-                        gene_embedding_sums[gene_id] = x_gene.copy()
-                    else:
-                        gene_embedding_sums[gene_id] += x_gene
-                    gene_counts[gene_id] += 1
-
-    # compute average embedding per gene
-    gene_embeddings = {
-        gene: gene_embedding_sums[gene] / gene_counts[gene]
-        for gene in gene_embedding_sums
-    }
-    
-    if not include_cls:
-        gene_embeddings.pop(vocab.cls_node, None)
-
-    df = pd.DataFrame.from_dict(gene_embeddings, orient='index')
-    df.index = df.index.map(vocab.node_to_gene)
-
-    return df
\ No newline at end of file
+    return accumulator.result()
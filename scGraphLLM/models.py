@@ -8,6 +8,7 @@ from scGraphLLM.GNN_modules import *
 from scGraphLLM.MLP_modules import *
 from scGraphLLM._globals import * ## these define the indices for the special tokens 
 from scGraphLLM.transformer_modules import *
+from scGraphLLM.graph_op import GraphOperatorContext, GraphOperatorCache
 
 class LitScGraphLLM(pl.LightningModule):
     def __init__(self, config, pad_node=PAD_GENE_IDX):
@@ -116,12 +117,27 @@ class GDTransformer(LitScGraphLLM):
                     use_PE=self.tconfig.use_pe,
                     use_flash_attn=self.tconfig.use_flash_attn,
                     fine_tuning=self.tconfig.fine_tuning,
+                    diffusion_order=self.tconfig.get("diffusion_order", 64),
+                    diffusion_tol=self.tconfig.get("diffusion_tol", None),
+                    diffusion_backend=self.tconfig.get("diffusion_backend", "chebyshev")
                 )   
             )
         
         self.use_attn_mask = self.tconfig.use_attn_mask
         self.use_PE = self.tconfig.use_pe
 
+        # effective Chebyshev order of the diffusion (truncated below diffusion_order if diffusion_tol is set)
+        self.diffusion_order = self.transformer_encoder[0].self_attention.diffusion_order if len(self.transformer_encoder) > 0 else None
+
+        # optionally reuse graph operators across batches of repeated graphs (e.g. fixed-network inference)
+        graph_operator_cache_size = self.tconfig.get("graph_operator_cache_size", 0)
+        self.graph_operator_cache = GraphOperatorCache(graph_operator_cache_size) if graph_operator_cache_size else None
+
+    def on_fit_start(self):
+        # record the effective diffusion order with the run's hyperparameters
+        if self.logger is not None and self.use_attn_mask:
+            self.logger.log_hyperparams({"diffusion_order": self.diffusion_order})
+
     def forward(self, batch):        
         orig_gene_id = batch["orig_gene_id"]
         orig_rank_indices = batch["orig_rank_indices"]
@@ -149,12 +165,19 @@ class GDTransformer(LitScGraphLLM):
         
         combined_embedding = torch.concat([node_embedding, rank_embedding], dim=2)
         
+        # the graph operator is built once and shared by all diffusion layers
+        graph_context = GraphOperatorContext(
+            edge_index_list, num_nodes_list, 
+            cache=self.graph_operator_cache, 
+            laplacian=batch.get("laplacian")
+        )
         for encoder_layer in self.transformer_encoder:
             combined_embedding = encoder_layer(
                 combined_embedding, 
                 p=pe, 
                 edge_index_list=edge_index_list, 
-                num_nodes_list=num_nodes_list
+                num_nodes_list=num_nodes_list,
+                graph_context=graph_context
             )
         
         # We have the learned cell embedding, no more need for MASKED gene_ids & expression
@@ -191,18 +214,25 @@ class Perturb_GDTransformer(GDTransformer):
         
         # FIXME - WE SPLIT THE NODE_EMBEDDING INTO GENE/RANK_EMBEDDING
         ctrl_exp_embedding = self.node_embedding(x_c)
+        graph_context = GraphOperatorContext(
+            edge_index_list, num_nodes_list, 
+            cache=self.graph_operator_cache, 
+            laplacian=batch.get("laplacian")
+        )
         
         if self.tconfig.num_encoder_layers == 1:
             pert_exp_embedding = self.transformer_encoder(ctrl_exp_embedding, p=pe, 
                                                      edge_index_list=edge_index_list, 
                                                      num_nodes_list=num_nodes_list,
-                                                     perturb_one_hot=r_p)
+                                                     perturb_one_hot=r_p,
+                                                     graph_context=graph_context)
         else:
             for encoder_layer in self.transformer_encoder:
                 pert_exp_embedding = encoder_layer(ctrl_exp_embedding, p=pe, 
                                                edge_index_list=edge_index_list, 
                                                num_nodes_list=num_nodes_list,
-                                               perturb_one_hot=r_p)
+                                               perturb_one_hot=r_p,
+                                               graph_context=graph_context)
         x_p_hat = self.expression_pred_head(pert_exp_embedding).squeeze()
         assert x_p_hat.shape == x_p.shape
         return x_c, x_p, x_p_hat
@@ -1,18 +1,27 @@
+import os
+import hashlib
+import argparse
 import pandas as pd
 import numpy as np
-from typing import Union
+import scipy.sparse as sp
+from typing import Union, List
 from scGraphLLM._globals import *
 
 
 class RegulatoryNetwork(object):
     """
-    Represents a gene regulatory network as a dataframe of directed edges 
+    Represents a gene regulatory network as a table of directed edges 
     between regulators and targets, with associated weights and likelihoods.
 
+    Edges are stored column-wise: regulators and targets as `int32` codes into a gene
+    dictionary, weights and likelihoods as `float32` arrays. Networks derived through
+    `prune`, `retain` or `filter` share the dictionary of their parent. The DataFrame view
+    (`df`) and other derived structures (gene set, degree, edge list, regulons) are built
+    on first use and cached until the edges change.
+
     Attributes:
-        df (pd.DataFrame): Internal representation of the network.
-        genes (set): Genes that appe
-        ar both as regulators and targets.
+        df (pd.DataFrame): DataFrame view of the network. Assign a new DataFrame to change the edges.
+        genes (set): Genes that appear as regulators or targets.
 
     Column naming follows constants from `_globals.py`:
         REG_VALS, TAR_VALS, WT_VALS, LOGP_VALS
@@ -32,27 +41,122 @@ class RegulatoryNetwork(object):
             weights (list): List of edge weights (e.g. MI values).
             likelihoods (list): List of statistical confidences (e.g. log p-values).
         """
-        self.df = pd.DataFrame({
-            self.reg_name: regulators,
-            self.tar_name: targets,
-            self.wt_name: weights,
-            self.lik_name: likelihoods
-        }).astype({
-            self.wt_name: float,
-            self.lik_name: float
-        })
+        regulators = np.asarray(regulators, dtype=object).ravel()
+        targets = np.asarray(targets, dtype=object).ravel()
+        if len(regulators) != len(targets):
+            raise ValueError("Regulators and targets must have the same length.")
+
+        # encode both columns against a single gene dictionary
+        codes, gene_names = pd.factorize(np.concatenate([regulators, targets]), use_na_sentinel=False)
+        codes = codes.astype(np.int32)
+        self._set_columns(
+            gene_names=np.asarray(gene_names, dtype=object),
+            reg_codes=codes[:len(regulators)],
+            tar_codes=codes[len(regulators):],
+            weights=self._float_column(weights, len(regulators)),
+            likelihoods=self._float_column(likelihoods, len(regulators))
+        )
+
+    @staticmethod
+    def _float_column(values, length):
+        if values is None:
+            return np.full(length, np.nan, dtype=np.float32)
+        values = np.asarray(values, dtype=np.float32).ravel()
+        if len(values) == 1 and length != 1:
+            values = np.repeat(values, length)
+        if len(values) != length:
+            raise ValueError("Weights and likelihoods must have one value per edge.")
+        return values
+
+    def _set_columns(self, gene_names, reg_codes, tar_codes, weights, likelihoods, gene_memo=None):
+        self._gene_names = gene_names
+        self._reg_codes = reg_codes
+        self._tar_codes = tar_codes
+        self._weights = weights
+        self._likelihoods = likelihoods
+
+        # derived structures, built lazily
+        self._df = None
+        self._genes = None
+        self._edges = None
+        self._regulons = None
+        self._adjacency = {}
+        self._fingerprint = None
+        self._source = None
+
+        # lookups over the gene dictionary (name ranks, node ids per vocabulary), shared by
+        # all networks that share the dictionary
+        self._gene_memo = {} if gene_memo is None else gene_memo
+
+    def __getstate__(self):
+        # memory-mapped networks are pickled by path, so that worker processes map the same files
+        if self._source is not None:
+            return {"source": self._source}
+        return {
+            "gene_names": self._gene_names,
+            "reg_codes": self._reg_codes,
+            "tar_codes": self._tar_codes,
+            "weights": self._weights,
+            "likelihoods": self._likelihoods
+        }
+
+    def __setstate__(self, state):
+        if "source" in state:
+            self.__dict__.update(RegulatoryNetwork.load(state["source"], mmap=True).__dict__)
+        else:
+            self._set_columns(**state)
+
+    def _from_columns(self, which) -> "RegulatoryNetwork":
+        """Returns a new network with the edges at positions `which`, sharing the gene dictionary."""
+        network = RegulatoryNetwork.__new__(RegulatoryNetwork)
+        network._set_columns(
+            gene_names=self._gene_names,
+            reg_codes=self._reg_codes[which],
+            tar_codes=self._tar_codes[which],
+            weights=self._weights[which],
+            likelihoods=self._likelihoods[which],
+            gene_memo=self._gene_memo
+        )
+        return network
+
+    def _update(self, which, inplace) -> "RegulatoryNetwork":
+        if not inplace:
+            return self._from_columns(which)
+        self._set_columns(
+            gene_names=self._gene_names,
+            reg_codes=self._reg_codes[which],
+            tar_codes=self._tar_codes[which],
+            weights=self._weights[which],
+            likelihoods=self._likelihoods[which],
+            gene_memo=self._gene_memo
+        )
+        return self
 
     def __len__(self):
-        return len(self.df)
+        return len(self._reg_codes)
     
     @property
     def df(self) -> pd.DataFrame:
+        if self._df is None:
+            self._df = pd.DataFrame({
+                self.reg_name: self._gene_names[self._reg_codes],
+                self.tar_name: self._gene_names[self._tar_codes],
+                self.wt_name: self._weights,
+                self.lik_name: self._likelihoods
+            })
         return self._df
     
     @df.setter
     def df(self, df: pd.DataFrame):
-        self._df = df
-        self.genes = set(self.regulators) | set(self.targets)
+        network = RegulatoryNetwork(df[self.reg_name], df[self.tar_name], df[self.wt_name], df[self.lik_name])
+        self._set_columns(network._gene_names, network._reg_codes, network._tar_codes, network._weights, network._likelihoods)
+
+    @property
+    def genes(self) -> set:
+        if self._genes is None:
+            used = np.unique(np.concatenate([self._reg_codes, self._tar_codes]))
+            self._genes = set(self._gene_names[used])
+        return self._genes
 
     @property
     def regulators(self):
@@ -64,18 +168,27 @@ class RegulatoryNetwork(object):
 
     @property
     def weights(self):
-        return self.df[self.wt_name]
+        return pd.Series(self._weights, name=self.wt_name)
     
     @property
     def likelihoods(self):
-        return self.df[self.lik_name]
+        return pd.Series(self._likelihoods, name=self.lik_name)
 
     @property
     def edges(self):
-        return list(zip(self.regulators, self.targets))
+        if self._edges is None:
+            self._edges = list(zip(self._gene_names[self._reg_codes], self._gene_names[self._tar_codes]))
+        return self._edges
+
+    @property
+    def degree(self) -> pd.Series:
+        """Number of edges (incoming and outgoing) of each gene in the network."""
+        counts = np.bincount(np.concatenate([self._reg_codes, self._tar_codes]), minlength=len(self._gene_names))
+        used = np.flatnonzero(counts)
+        return pd.Series(counts[used], index=pd.Index(self._gene_names[used]), name="degree")
 
     def __str__(self):
-        num_edges = len(self.df)
+        num_edges = len(self)
         num_genes = len(self.genes)
         targets_per_regulon = self.regulators.value_counts()
         num_regulons = len(targets_per_regulon)
@@ -94,8 +207,86 @@ class RegulatoryNetwork(object):
     def __repr__(self):
         return self.__str__()
 
+    def adjacency(self, vocab) -> "NetworkAdjacency":
+        """
+        Returns the integer-coded CSR adjacency of the network, keyed by the node ids of `vocab`.
+
+        The index is built lazily on first use and cached per vocabulary until the
+        network's edges change.
+
+        Args:
+            vocab (GeneVocab): Vocabulary mapping gene names to node ids.
+
+        Returns:
+            NetworkAdjacency: CSR adjacency of the network over the vocabulary's node ids.
+        """
+        if vocab not in self._adjacency:
+            if vocab not in self._gene_memo:
+                self._gene_memo[vocab] = vocab.encode(self._gene_names).astype(np.int64)
+            gene_nodes = self._gene_memo[vocab]
+            self._adjacency[vocab] = NetworkAdjacency(gene_nodes[self._reg_codes], gene_nodes[self._tar_codes], vocab.num_nodes)
+        return self._adjacency[vocab]
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Hash of the edges, weights and likelihoods of the network, used to key cached tokenizations.
+        """
+        if self._fingerprint is None:
+            gene_hashes = pd.util.hash_pandas_object(pd.Series(self._gene_names, dtype=object), index=False).to_numpy()
+            digest = hashlib.blake2b(digest_size=16)
+            for column in [gene_hashes[self._reg_codes], gene_hashes[self._tar_codes], self._weights, self._likelihoods]:
+                digest.update(np.ascontiguousarray(column).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def edge_keys(self, gene_names: np.ndarray) -> np.ndarray:
+        """
+        Encodes each edge as the int64 key `regulator * len(gene_names) + target`, where genes
+        are numbered by their position in `gene_names`. With sorted gene names, keys sort like
+        (regulator, target) tuples.
+
+        Args:
+            gene_names (np.ndarray): Sorted array of gene names, containing all genes of the network.
+
+        Returns:
+            np.ndarray: Key of each edge.
+        """
+        codes = np.searchsorted(gene_names, self._gene_names.astype(gene_names.dtype))
+        return codes[self._reg_codes].astype(np.int64) * max(len(gene_names), 1) + codes[self._tar_codes]
+
+    def take(self, which: np.ndarray, weights=None, likelihoods=None) -> "RegulatoryNetwork":
+        """
+        Returns a new network with the edges at the given positions, sharing the gene dictionary
+        (and the lookups built over it) with this network. Cheap enough to carve one network per
+        cell out of a table of all possible edges.
+
+        Args:
+            which (np.ndarray): Positions of the edges to take.
+            weights (array-like, optional): Weights of the taken edges, replacing those of this network.
+            likelihoods (array-like, optional): Likelihoods of the taken edges, replacing those of this network.
+
+        Returns:
+            RegulatoryNetwork: Network with the selected edges.
+        """
+        network = self._from_columns(which)
+        if weights is not None:
+            network._weights = self._float_column(weights, len(network))
+        if likelihoods is not None:
+            network._likelihoods = self._float_column(likelihoods, len(network))
+        return network
+
     def targets_of(self, regulator):
-        return self.targets[self.regulators == regulator].tolist()
+        if self._regulons is None:
+            order = np.argsort(self._reg_codes, kind="stable")
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(self._reg_codes, minlength=len(self._gene_names)))])
+            self._regulons = (pd.Index(self._gene_names), order, indptr)
+
+        gene_index, order, indptr = self._regulons
+        code = gene_index.get_indexer([regulator])[0]
+        if code < 0:
+            return []
+        return self._gene_names[self._tar_codes[order[indptr[code]:indptr[code + 1]]]].tolist()
 
     @classmethod
     def from_edge_ids(edge_ids, all_edges, weights, likelihoods):
@@ -122,6 +313,134 @@ class RegulatoryNetwork(object):
         df = pd.read_csv(path, **kwargs)    
         return cls(df[reg_name], df[tar_name], df[wt_name], df[lik_name])
 
+    def save(self, path):
+        """
+        Saves the network in a binary format: a directory holding the gene dictionary and one
+        `.npy` file per column, which `load` can memory-map without parsing or copying.
+
+        Args:
+            path (str): Directory to write the network to, created if needed.
+        """
+        os.makedirs(path, exist_ok=True)
+        columns = {
+            _GENES_FILE: np.asarray(self._gene_names, dtype=str),
+            _REGULATORS_FILE: self._reg_codes,
+            _TARGETS_FILE: self._tar_codes,
+            _WEIGHTS_FILE: self._weights,
+            _LIKELIHOODS_FILE: self._likelihoods
+        }
+        for name, values in columns.items():
+            np.save(os.path.join(path, name), np.ascontiguousarray(values))
+
+    @classmethod
+    def load(cls, path, mmap=True) -> "RegulatoryNetwork":
+        """
+        Loads a network saved with `save`.
+
+        Args:
+            path (str): Directory the network was saved to.
+            mmap (bool): If True, memory-map the edge columns instead of reading them into memory.
+                Memory-mapped networks share pages across processes and are pickled by path,
+                which makes them cheap to send to DataLoader workers.
+
+        Returns:
+            RegulatoryNetwork: The loaded network.
+        """
+        mmap_mode = "r" if mmap else None
+        network = cls.__new__(cls)
+        network._set_columns(
+            gene_names=np.load(os.path.join(path, _GENES_FILE)).astype(object),
+            reg_codes=np.load(os.path.join(path, _REGULATORS_FILE), mmap_mode=mmap_mode),
+            tar_codes=np.load(os.path.join(path, _TARGETS_FILE), mmap_mode=mmap_mode),
+            weights=np.load(os.path.join(path, _WEIGHTS_FILE), mmap_mode=mmap_mode),
+            likelihoods=np.load(os.path.join(path, _LIKELIHOODS_FILE), mmap_mode=mmap_mode)
+        )
+        if mmap:
+            network._source = os.path.abspath(path)
+        return network
+
+    @classmethod
+    def from_aracne(cls, path, **kwargs) -> "RegulatoryNetwork":
+        """
+        Reads an ARACNe network, from its binary conversion (see `convert_aracne_outputs`) if
+        there is one, otherwise from the TSV file.
+
+        Args:
+            path (str): Path to the ARACNe TSV file, e.g. `.../consolidated-net_defaultid.tsv`.
+            **kwargs: Additional arguments passed to `from_csv`.
+
+        Returns:
+            RegulatoryNetwork: The ARACNe network.
+        """
+        binary_path = binary_network_path(path)
+        if os.path.isdir(binary_path):
+            return cls.load(binary_path)
+        return cls.from_csv(path, sep="\t", **kwargs)
+
+    @classmethod
+    def from_csv_pruned(
+        cls, 
+        path, 
+        limit_regulon=None, 
+        limit_graph=None, 
+        chunksize=1_000_000, 
+        reg_name="regulator.values", 
+        tar_name="target.values", 
+        wt_name="mi.values", 
+        lik_name="log.p.values", 
+        **kwargs
+    ) -> "RegulatoryNetwork":
+        """
+        Reads and prunes a network from a CSV file in chunks, so that the full network never
+        has to fit in memory. Only the edges that can still make it into the pruned network
+        (at most `limit_regulon` per regulator and `limit_graph` in total) are kept between
+        chunks. The result is the same as `from_csv(path).prune(limit_regulon, limit_graph)`.
+
+        Args:
+            path (str): Path to CSV file.
+            limit_regulon (int, optional): Max number of targets per regulator.
+            limit_graph (int, optional): Max number of total edges (by weight).
+            chunksize (int): Number of rows read at a time.
+            reg_name (str): Column name for regulators.
+            tar_name (str): Column name for targets.
+            wt_name (str): Column name for weights.
+            lik_name (str): Column name for likelihoods.
+            **kwargs: Additional arguments passed to `pd.read_csv`.
+
+        Returns:
+            RegulatoryNetwork: The pruned network.
+        """
+        kept = None
+        columns = [reg_name, tar_name, wt_name, lik_name]
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize, **kwargs):
+            network = cls(chunk[reg_name], chunk[tar_name], chunk[wt_name], chunk[lik_name])
+            if kept is not None:
+                network = kept._concat(network)
+
+            # keep the surviving edges in their original order
+            kept = network._update(np.sort(network._prune_order(limit_regulon, limit_graph)), inplace=True)
+
+        if kept is None:
+            return cls([], [], [], [])
+        return kept.prune(limit_regulon=limit_regulon, limit_graph=limit_graph, inplace=True)
+
+    def _concat(self, other: "RegulatoryNetwork") -> "RegulatoryNetwork":
+        """Returns a new network with the edges of `other` appended to those of this network."""
+        gene_index = pd.Index(self._gene_names)
+        other_codes = gene_index.get_indexer(other._gene_names)
+        new_genes = other._gene_names[other_codes < 0]
+        other_codes[other_codes < 0] = np.arange(len(gene_index), len(gene_index) + len(new_genes))
+
+        network = RegulatoryNetwork.__new__(RegulatoryNetwork)
+        network._set_columns(
+            gene_names=np.concatenate([self._gene_names, new_genes]),
+            reg_codes=np.concatenate([self._reg_codes, other_codes[other._reg_codes]]).astype(np.int32),
+            tar_codes=np.concatenate([self._tar_codes, other_codes[other._tar_codes]]).astype(np.int32),
+            weights=np.concatenate([self._weights, other._weights]),
+            likelihoods=np.concatenate([self._likelihoods, other._likelihoods])
+        )
+        return network
+
     def prune(
         self,
         limit_regulon=None,
@@ -139,26 +458,25 @@ class RegulatoryNetwork(object):
         Returns:
             RegulatoryNetwork: The pruned network (self or new).
         """
-        df = self.df if inplace else self.df.copy()
+        return self._update(self._prune_order(limit_regulon, limit_graph), inplace)
+
+    def _prune_order(self, limit_regulon=None, limit_graph=None) -> np.ndarray:
+        """Positions of the edges kept by `prune`, in the order `prune` returns them."""
+        order = np.arange(len(self))
 
         if limit_regulon is not None:
-            df = df.sort_values(by=[self.reg_name, self.wt_name], ascending=[True, False])\
-                .groupby(self.reg_name, group_keys=False)\
-                .head(limit_regulon)
+            # sort edges by regulator name, then by decreasing weight, and keep the head of each regulon
+            if "name_rank" not in self._gene_memo:
+                name_rank = np.empty(len(self._gene_names), dtype=np.int64)
+                name_rank[np.argsort(self._gene_names, kind="stable")] = np.arange(len(self._gene_names))
+                self._gene_memo["name_rank"] = name_rank
+            order = _top_k_per_group(self._gene_memo["name_rank"][self._reg_codes], self._weights, limit_regulon)
 
         if limit_graph is not None:
-            df = df.nlargest(limit_graph, self.wt_name)
-
-        if inplace:
-            self.df = df
-            return self
+            # largest weights first, ties in order of appearance
+            order = order[_top_k(self._weights[order], limit_graph)]
 
-        return RegulatoryNetwork(
-            regulators=df[self.reg_name].tolist(),
-            targets=df[self.tar_name].tolist(),
-            weights=df[self.wt_name].tolist(),
-            likelihoods=df[self.lik_name].tolist()
-        )
+        return order
     
     def make_undirected(self, drop_unpaired=False, inplace=False) -> "RegulatoryNetwork":
         """
@@ -173,41 +491,28 @@ class RegulatoryNetwork(object):
         Returns:
             RegulatoryNetwork: Updated network object (self or new).
         """
-        df = self.df if inplace else self.df.copy()
-        edge_set = set(zip(df[self.reg_name], df[self.tar_name]))
-        reverse_set = set((t, r) for r, t in edge_set)
+        # pack (regulator, target) codes into int64 keys and look up the reverse of each edge
+        num_genes = max(len(self._gene_names), 1)
+        keys = self._reg_codes.astype(np.int64) * num_genes + self._tar_codes
+        reverse_keys = self._tar_codes.astype(np.int64) * num_genes + self._reg_codes
+        has_reverse = np.isin(reverse_keys, keys)
 
         if drop_unpaired:
             # Keep only edges that have a reverse
-            bidirectional_edges = edge_set & reverse_set
-            mask = [(r, t) in bidirectional_edges for r, t in zip(df[self.reg_name], df[self.tar_name])]
-            df = df[mask].reset_index(drop=True)
-        else:
-            existing_edges = set(zip(df[self.reg_name], df[self.tar_name]))
-            reversed_edges = []
-            for _, row in df.iterrows():
-                src, tgt = row[self.reg_name], row[self.tar_name]
-                if (tgt, src) not in existing_edges:
-                    reversed_edges.append({
-                        self.reg_name: tgt,
-                        self.tar_name: src,
-                        self.wt_name: row[self.wt_name],
-                        self.lik_name: row[self.lik_name]
-                    })
-            if reversed_edges:
-                reversed_df = pd.DataFrame(reversed_edges)
-                df = pd.concat([df, reversed_df], ignore_index=True)
-
-        if inplace:
-            self.df = df
-            return self
-
-        return RegulatoryNetwork(
-            regulators=df[self.reg_name].tolist(),
-            targets=df[self.tar_name].tolist(),
-            weights=df[self.wt_name].tolist(),
-            likelihoods=df[self.lik_name].tolist()
+            return self._update(np.flatnonzero(has_reverse), inplace)
+
+        # append the reverse of every unpaired edge, with the same weight and likelihood
+        unpaired = np.flatnonzero(~has_reverse)
+        network = self if inplace else RegulatoryNetwork.__new__(RegulatoryNetwork)
+        network._set_columns(
+            gene_names=self._gene_names,
+            reg_codes=np.concatenate([self._reg_codes, self._tar_codes[unpaired]]),
+            tar_codes=np.concatenate([self._tar_codes, self._reg_codes[unpaired]]),
+            weights=np.concatenate([self._weights, self._weights[unpaired]]),
+            likelihoods=np.concatenate([self._likelihoods, self._likelihoods[unpaired]]),
+            gene_memo=self._gene_memo
         )
+        return network
 
     def retain(self, which: Union[pd.Series, np.ndarray], inplace=True) -> "RegulatoryNetwork":
         """
@@ -221,21 +526,10 @@ class RegulatoryNetwork(object):
         Returns:
             RegulatoryNetwork: The retained network (self or new).
         """
-        if len(which) != len(self.df):
+        if len(which) != len(self):
             raise ValueError("Length of mask does not match number of edges in network.")
         
-        new_df = self.df[which].reset_index(drop=True)
-
-        if inplace:
-            self.df = new_df
-            return self
-
-        return RegulatoryNetwork(
-            regulators=new_df[self.reg_name].tolist(),
-            targets=new_df[self.tar_name].tolist(),
-            weights=new_df[self.wt_name].tolist(),
-            likelihoods=new_df[self.lik_name].tolist()
-        )
+        return self._update(np.flatnonzero(np.asarray(which, dtype=bool)), inplace)
     
     def filter(self, which: Union[pd.Series, np.ndarray], inplace=True) -> "RegulatoryNetwork":
         """
@@ -249,21 +543,226 @@ class RegulatoryNetwork(object):
         Returns:
             RegulatoryNetwork: The filtered network (self or new).
         """
-        return self.retain(~which, inplace=inplace)
+        return self.retain(~np.asarray(which, dtype=bool), inplace=inplace)
 
     
     def __eq__(self, other):
         if not isinstance(other, RegulatoryNetwork):
             return NotImplemented
-    
-        # Sort edges by regulator and target in both networks
-        self_edges = self.df[[self.reg_name, self.tar_name]].sort_values(
-            by=[self.reg_name, self.tar_name]
-        ).reset_index(drop=True)
-        
-        other_edges = other.df[[other.reg_name, other.tar_name]].sort_values(
-            by=[other.reg_name, other.tar_name]
-        ).reset_index(drop=True)
-        
-        # Compare the edge DataFrames for equality
-        return self_edges.equals(other_edges)
\ No newline at end of file
+
+        if len(self) != len(other):
+            return False
+
+        # express both networks against a common gene dictionary
+        if self._gene_names is other._gene_names:
+            self_codes = other_codes = np.arange(len(self._gene_names))
+            num_genes = len(self._gene_names)
+        else:
+            codes, gene_names = pd.factorize(np.concatenate([self._gene_names, other._gene_names]), use_na_sentinel=False)
+            self_codes, other_codes = codes[:len(self._gene_names)], codes[len(self._gene_names):]
+            num_genes = len(gene_names)
+
+        # compare the sorted (regulator, target) keys of both networks
+        self_keys = np.sort(self_codes[self._reg_codes].astype(np.int64) * num_genes + self_codes[self._tar_codes])
+        other_keys = np.sort(other_codes[other._reg_codes].astype(np.int64) * num_genes + other_codes[other._tar_codes])
+        return np.array_equal(self_keys, other_keys)
+
+
+def _top_k_per_group(groups: np.ndarray, weights: np.ndarray, k: int) -> np.ndarray:
+    """
+    Positions of the `k` largest weights of each group, sorted by group and decreasing
+    weight, with ties in order of position.
+    """
+    if len(groups) > 0 and groups.min() >= 0 and groups.max() <= np.iinfo(np.uint16).max:
+        groups = groups.astype(np.uint16) # numpy radix-sorts 16-bit integers
+    order = np.argsort(-weights, kind="stable")
+    order = order[np.argsort(groups[order], kind="stable")]
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_groups[1:] != sorted_groups[:-1]]))
+    group_start = np.repeat(starts, np.diff(np.append(starts, len(order))))
+    return order[np.arange(len(order)) - group_start < k]
+
+
+def _top_k(weights: np.ndarray, k: int) -> np.ndarray:
+    """
+    Positions of the `k` largest (non-NaN) weights, sorted by decreasing weight, with ties in
+    order of position. Candidates are selected with a partition rather than a full sort.
+    """
+    candidates = np.flatnonzero(~np.isnan(weights))
+    if 0 < k < len(candidates):
+        threshold = -np.partition(-weights[candidates], k - 1)[k - 1]
+        above = candidates[weights[candidates] > threshold]
+        ties = candidates[weights[candidates] == threshold][:k - len(above)]
+        candidates = np.sort(np.concatenate([above, ties]))
+    elif k <= 0:
+        candidates = candidates[:0]
+    return candidates[np.argsort(-weights[candidates], kind="stable")]
+
+
+_GENES_FILE = "genes.npy"
+_REGULATORS_FILE = "regulators.npy"
+_TARGETS_FILE = "targets.npy"
+_WEIGHTS_FILE = "weights.npy"
+_LIKELIHOODS_FILE = "likelihoods.npy"
+
+
+def binary_network_path(path):
+    """Path of the binary conversion of a network file: the file path without its extension, plus `.network`."""
+    return os.path.splitext(path)[0] + ".network"
+
+
+def convert_aracne_outputs(aracne_dirs: List[str], network_file="consolidated-net_defaultid.tsv", overwrite=False, **kwargs):
+    """
+    Converts the TSV networks of ARACNe output directories to the binary format of
+    `RegulatoryNetwork.save`, next to the TSV files, where `RegulatoryNetwork.from_aracne` finds them.
+
+    Args:
+        aracne_dirs (List[str]): ARACNe output directories.
+        network_file (str): Name of the network file within each directory.
+        overwrite (bool): If True, convert networks that were already converted.
+        **kwargs: Additional arguments passed to `RegulatoryNetwork.from_csv`.
+
+    Returns:
+        List[str]: Paths of the converted networks.
+    """
+    converted = []
+    for aracne_dir in aracne_dirs:
+        path = os.path.join(aracne_dir, network_file)
+        binary_path = binary_network_path(path)
+        if overwrite or not os.path.isdir(binary_path):
+            RegulatoryNetwork.from_csv(path, sep="\t", **kwargs).save(binary_path)
+        converted.append(binary_path)
+    return converted
+
+
+class NetworkAdjacency(object):
+    """
+    Integer-coded CSR adjacency of a `RegulatoryNetwork` over vocabulary node ids.
+
+    Row `i` holds the outgoing edges of the regulator with node id `i`, so that the subgraph
+    induced by a set of genes is extracted by reading only the rows of those genes, independent
+    of the total number of edges in the network. Edges whose regulator or target is not in the
+    vocabulary are left out.
+
+    Args:
+        regulators (np.ndarray): Node id of the regulator of each edge, -1 if unknown.
+        targets (np.ndarray): Node id of the target of each edge, -1 if unknown.
+        num_nodes (int): Number of node ids (largest node id + 1).
+
+    Attributes:
+        indptr (np.ndarray): Row pointers, of length `num_nodes + 1`.
+        targets (np.ndarray): Target node id of each edge, grouped by regulator.
+        edge_ids (np.ndarray): Position of each edge in the network's edge table.
+        in_network (np.ndarray): Boolean mask of node ids that appear in the network.
+    """
+    def __init__(self, regulators: np.ndarray, targets: np.ndarray, num_nodes: int):
+        self.num_nodes = num_nodes
+        self.in_network = np.zeros(num_nodes, dtype=bool)
+        self.in_network[regulators[regulators >= 0]] = True
+        self.in_network[targets[targets >= 0]] = True
+
+        edge_ids = np.flatnonzero((regulators >= 0) & (targets >= 0))
+        order = np.argsort(regulators[edge_ids], kind="stable")
+        self.edge_ids = edge_ids[order]
+        self.regulators = regulators[self.edge_ids]
+        self.targets = targets[self.edge_ids]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(self.regulators, minlength=num_nodes))])
+        self._undirected = None
+
+    def __len__(self):
+        return len(self.edge_ids)
+
+    @property
+    def undirected(self) -> sp.csr_matrix:
+        """
+        Symmetric (num_nodes x num_nodes) adjacency matrix with a 1 wherever two genes share
+        an edge in either direction. Built on first use and cached.
+        """
+        if self._undirected is None:
+            ones = np.ones(2 * len(self), dtype=np.float32)
+            src = np.concatenate([self.regulators, self.targets])
+            dst = np.concatenate([self.targets, self.regulators])
+            undirected = sp.csr_matrix((ones, (src, dst)), shape=(self.num_nodes, self.num_nodes))
+            undirected.data[:] = 1
+            self._undirected = undirected
+        return self._undirected
+
+    def neighbors(self, indicator: sp.spmatrix) -> sp.csr_matrix:
+        """
+        Finds the neighbors of sets of genes with one sparse matrix product.
+
+        Args:
+            indicator (scipy.sparse.spmatrix): (cells x num_nodes) indicator of the genes of each cell.
+
+        Returns:
+            scipy.sparse.csr_matrix: Boolean (cells x num_nodes) matrix, True for genes sharing an
+                edge with at least one gene of the cell.
+        """
+        indicator = sp.csr_matrix(indicator, dtype=np.float32)
+        return (indicator @ self.undirected) > 0
+
+    def subgraph(self, nodes: np.ndarray):
+        """
+        Extracts the edges between the given nodes.
+
+        Args:
+            nodes (np.ndarray): Node ids of the genes in the subgraph.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Local (positional) indices into `nodes` of
+                the regulator and target of each edge, and the position of each edge in the
+                network's edge table. Edges are in network order.
+        """
+        _, src, dst, edge_ids = self.subgraphs(nodes, np.array([0, len(nodes)]))
+        return src, dst, edge_ids
+
+    def subgraphs(self, nodes: np.ndarray, offsets: np.ndarray):
+        """
+        Extracts the edges of many subgraphs at once.
+
+        Args:
+            nodes (np.ndarray): Concatenated node ids of the genes of each subgraph.
+            offsets (np.ndarray): Subgraph `i` consists of `nodes[offsets[i]:offsets[i+1]]`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Subgraph of each edge, local
+                indices of its regulator and target within the subgraph, and its position in the
+                network's edge table. Edges are grouped by subgraph and in network order.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        n_subgraphs = len(offsets) - 1
+        node_subgraph = np.repeat(np.arange(n_subgraphs), np.diff(offsets))
+        node_local = np.arange(len(nodes)) - offsets[node_subgraph]
+
+        # outgoing edges of every node, read from the rows of the CSR index
+        starts, ends = self.indptr[nodes], self.indptr[nodes + 1]
+        n_out = ends - starts
+        source = np.repeat(np.arange(len(nodes)), n_out)
+        positions = np.arange(n_out.sum()) - np.repeat(np.cumsum(n_out) - n_out, n_out) + starts[source]
+
+        # keep edges whose target belongs to the same subgraph
+        keys = node_subgraph * self.num_nodes + nodes
+        key_order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[key_order]
+        target_keys = node_subgraph[source] * self.num_nodes + self.targets[positions]
+        found = np.minimum(np.searchsorted(sorted_keys, target_keys), max(len(nodes) - 1, 0))
+        keep = sorted_keys[found] == target_keys
+
+        source, target, positions = source[keep], key_order[found[keep]], positions[keep]
+        edge_subgraph, edge_ids = node_subgraph[source], self.edge_ids[positions]
+        order = np.lexsort((edge_ids, edge_subgraph))
+        return edge_subgraph[order], node_local[source[order]], node_local[target[order]], edge_ids[order]
+
+
+if __name__ == "__main__":
+    ## Converts ARACNe output directories to the binary network format
+    ## python scGraphLLM/network.py --aracne-dirs /path/to/cell_type/aracne_4096 ...
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--aracne-dirs", type=str, nargs="+", required=True, help="ARACNe output directories")
+    parser.add_argument("--network-file", type=str, default="consolidated-net_defaultid.tsv", help="Name of the network file within each directory")
+    parser.add_argument("--overwrite", action="store_true", default=False)
+    args = parser.parse_args()
+
+    for path in convert_aracne_outputs(args.aracne_dirs, network_file=args.network_file, overwrite=args.overwrite):
+        print(f"Converted: {path}")
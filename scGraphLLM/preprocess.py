@@ -22,6 +22,7 @@ import matplotlib.pyplot as plt
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import os
 import re
 import logging
@@ -36,7 +37,7 @@ from typing import List
 from os.path import join, abspath, dirname
 from functools import partial
 
-from scGraphLLM.tokenizer import tokenize_expr, quantize_cells
+from scGraphLLM.tokenizer import tokenize_expr, quantize_cells, quantize_sparse
 
 warnings.filterwarnings("ignore")
 logger = logging.getLogger(__name__)
@@ -494,24 +495,32 @@ def make_metacells(
 
 
 
-def quantize(cells, n_bins, save_path=None):    
-    # Get the z-score test statistic   
-    cells = cells.to_df()
-    bins = quantize_cells(cells, n_bins)
+def quantize(cells, n_bins, save_path=None, chunk_size=10_000):    
+    # Bin each cell's expression directly on the sparse matrix
+    X = sp.csr_matrix(cells.X)
+    bins = quantize_sparse(X, n_bins)
     
-    # Save bins_raw.csv file to cell-type-specific directory
-    if save_path is not None:
-        bins.to_csv(save_path, index=False, header=True)
+    # Save binned expression to cell-type-specific directory: a sparse .h5ad if requested,
+    # otherwise the dense binned_expression.csv, written a chunk of cells at a time
+    if save_path is not None and save_path.endswith(".h5ad"):
+        ad.AnnData(X=bins, obs=pd.DataFrame(index=cells.obs_names), var=pd.DataFrame(index=cells.var_names))\
+            .write_h5ad(save_path)
+    elif save_path is not None:
+        with open(save_path, "w") as f:
+            for start in range(0, max(bins.shape[0], 1), chunk_size):
+                pd.DataFrame(bins[start:start + chunk_size].toarray(), columns=cells.var_names)\
+                    .to_csv(f, index=False, header=start == 0)
 
     # Save the bin info
-    cells_info = cells.count(axis=1)
+    nan_rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))[np.isnan(X.data)]
+    cells_info = pd.Series(X.shape[1] - np.bincount(nan_rows, minlength=X.shape[0])) # non-missing values per cell
     binfo = {
         "n_bins": n_bins,
         "min_genes_per_cell": int(cells_info.min()),
         "max_genes_per_cell": int(cells_info.max()),
         "median_genes_per_cell": cells_info.median(),
-        "mean_genes_per_bin": round(cells.count(axis=0).sum()/(cells.dropna(how="all").shape[0] * n_bins), 2),
-        "num_unique_highest_expressed": int(np.sum(np.any(np.isin(bins, [99]), axis=0))) # Number of genes that were in the highest bin rank across cells
+        "mean_genes_per_bin": round(cells_info.sum()/(int((cells_info > 0).sum()) * n_bins), 2),
+        "num_unique_highest_expressed": int(np.unique(bins.indices[bins.data == 99]).shape[0]) # Number of genes that were in the highest bin rank across cells
     }
 
     return bins, binfo
@@ -610,7 +619,7 @@ def main(args):
         else:
             data = adata
             
-        # Returns: pandas dataframe with metacell x genes: values are ranking bin number | AND | rank_info JSON element
+        # Returns: sparse metacell x genes matrix: values are ranking bin number | AND | rank_info JSON element
         print(f"Quantizing dataset into {args.n_bins} bins...")
         bins, qc_bins = quantize(
             data,
@@ -684,6 +693,7 @@ if __name__ == "__main__":
     parser.add_argument("--aracne_top_n_hvg", type=int, default=None)
     parser.add_argument("--aracne_dirname", type=str, default="aracne")
     parser.add_argument("--n_bins", type=int, default=100)
+    parser.add_argument("--save_bins_h5ad", action="store_true", help="Save the binned expression as a sparse .h5ad instead of a .csv")
     # figures
     parser.add_argument("--produce_figures", action="store_true")
     parser.add_argument("--produce_stats", action="store_true")
@@ -702,7 +712,7 @@ if __name__ == "__main__":
     
     # define paths 
     timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    args.bins_path = join(args.out_dir, "binned_expression.csv")
+    args.bins_path = join(args.out_dir, "binned_expression.h5ad" if args.save_bins_h5ad else "binned_expression.csv")
     args.meta_path = join(args.out_dir, "metacells.h5ad")
     args.cells_path = join(args.out_dir, "cells.h5ad")
     args.info_path = join(args.out_dir, f"info_{timestamp}.json")
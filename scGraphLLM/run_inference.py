@@ -6,7 +6,7 @@ import anndata as ad
 import pandas as pd
 
 from scGraphLLM.config import graph_kernel_attn_3L_4096
-from scGraphLLM.inference import get_cell_embeddings, get_gene_embeddings
+from scGraphLLM.inference import get_embeddings, EMBEDDING_OUTPUTS
 from scGraphLLM.models import GDTransformer
 from scGraphLLM import RegulatoryNetwork, GeneVocab, GraphTokenizer, InferenceDataset
 
@@ -19,7 +19,7 @@ def main(args):
     vocab = GeneVocab.from_csv(args.vocab_path, gene_col="gene_name", node_col="idx")
 
     # Load network
-    network = RegulatoryNetwork.from_csv(args.network_path, sep="\t")
+    network = RegulatoryNetwork.from_aracne(args.network_path)
 
     # Load model
     model = GDTransformer.load_from_checkpoint(args.model_path, config=graph_kernel_attn_3L_4096)
@@ -27,24 +27,23 @@ def main(args):
     # Initialize dataset for inference
     dataset = InferenceDataset(
         expression=adata.to_df(), 
-        tokenizer=GraphTokenizer(vocab=vocab, network=network)
+        tokenizer=GraphTokenizer(vocab=vocab, network=network),
+        precompute_laplacian=args.precompute_laplacian
     )
 
-    # # get cell embeddings 
-    # x_cell = get_cell_embeddings(dataset, model, vocab, cls_policy="exclude")
-    # save_with_metadata(x_cell, metadata=adata.obs, path=join(args.out_dir, "emb_cell.h5ad"))
-
-    # get cell embeddings including cls token embedding
-    x_cell_with_cls = get_cell_embeddings(dataset, model, vocab, cls_policy="include")
-    save_with_metadata(x_cell_with_cls, metadata=adata.obs, path=join(args.out_dir, "emb_cell_with_cls.h5ad"))
-
-    # # get cls token embedding as cell embedding
-    # x_cell_only_cls = get_cell_embeddings(dataset, model, vocab, cls_policy="only")
-    # save_with_metadata(x_cell_only_cls, metadata=adata.obs, path=join(args.out_dir, "emb_cell_only_cls.h5ad"))
-
-    # get gene embeddings
-    x_gene = get_gene_embeddings(dataset, model, vocab)
-    save_with_metadata(x_gene, metadata=adata.var, path=join(args.out_dir, "emb_gene.h5ad"))
+    # compute all requested embeddings with a single forward pass over the data,
+    # cell embeddings are streamed to emb_<output>.h5ad in out_dir as batches complete
+    embeddings = get_embeddings(
+        dataset, model, vocab, 
+        outputs=args.outputs, 
+        out_dir=args.out_dir, 
+        obs=adata.obs, 
+        bucket_by_length=args.bucket_by_length,
+        max_tokens_per_batch=args.max_tokens_per_batch,
+        max_edges_per_batch=args.max_edges_per_batch
+    )
+    if "gene" in embeddings:
+        save_with_metadata(embeddings["gene"], metadata=adata.var, path=join(args.out_dir, "emb_gene.h5ad"))
      
 
 def save_with_metadata(x: pd.DataFrame, metadata: pd.DataFrame, path):
@@ -60,6 +59,12 @@ if __name__ == "__main__":
     parser.add_argument("--network_path", type=str, required=True)
     parser.add_argument("--model_path", type=str, required=True)
     parser.add_argument("--out_dir", type=str, required=True)
+    parser.add_argument("--outputs", type=str, nargs="+", choices=EMBEDDING_OUTPUTS, default=["cell_with_cls", "gene"],
+                        help="Embeddings to compute in a single pass, each saved to emb_<output>.h5ad")
+    parser.add_argument("--bucket_by_length", action="store_true", help="Batch cells of similar sequence length together")
+    parser.add_argument("--max_tokens_per_batch", type=int, default=None, help="Pack batches up to this many (padded) tokens, CLS included")
+    parser.add_argument("--max_edges_per_batch", type=int, default=None, help="Limit batches to this many graph edges")
+    parser.add_argument("--precompute_laplacian", action="store_true", help="Build graph Laplacians when collating batches")
     args = parser.parse_args()
     os.makedirs(args.out_dir, exist_ok=True)
 
@@ -13,12 +13,14 @@ import time
 import pickle 
 import wandb
 import glob 
+from functools import partial
 from torch.utils.data import DataLoader as torchDataLoader
 
 # import torchsummary
 
 from scGraphLLM.models import LitScGraphLLM
 from scGraphLLM.data import GraphTransformerDataset
+from scGraphLLM.samplers import DistributedLengthBucketSampler
 from scGraphLLM._globals import *
 from scGraphLLM.config import *
 from scGraphLLM.vocab import GeneVocab
@@ -63,38 +65,56 @@ class GraphTransformerDataModule(pl.LightningDataModule):
     def __init__(self, data_config, vocab: GeneVocab):
         super().__init__()
         self.data_config = data_config
-        self.train_ds = GraphTransformerDataset(vocab=vocab, **data_config.train)
-        self.val_ds = [GraphTransformerDataset(vocab=vocab, **val) for val in data_config.val]
+        # optionally build the graph Laplacians in the DataLoader workers, see graph_op.laplacian_csr
+        self.precompute_laplacian = data_config.get("precompute_laplacian", False)
+        dataset_fn = partial(GraphTransformerDataset, vocab=vocab, precompute_laplacian=self.precompute_laplacian)
+        self.train_ds = dataset_fn(**data_config.train)
+        self.val_ds = [dataset_fn(**val) for val in data_config.val]
         if data_config.run_test:
-            self.test_ds = [GraphTransformerDataset(vocab=vocab, **test) for test in data_config.test]
+            self.test_ds = [dataset_fn(**test) for test in data_config.test]
     
-    def train_dataloader(self):
+    def _dataloader(self, dataset, shuffle):
+        max_tokens = self.data_config.get("max_tokens_per_batch", None)
+        max_edges = self.data_config.get("max_edges_per_batch", None)
+        if not (self.data_config.get("bucket_by_length", False) or max_tokens is not None or max_edges is not None):
+            return torchDataLoader(
+                dataset=dataset, 
+                batch_size=self.data_config.batch_size, 
+                num_workers=self.data_config.num_workers, 
+                collate_fn=dataset.collate_fn,
+                pin_memory=self.precompute_laplacian
+            )
+
+        # batch cells of similar length (packed up to the token/edge budgets, if any),
+        # split between processes under DDP
+        if max_edges is not None:
+            lengths, num_edges = dataset.sequence_lengths(with_edges=True)
+        else:
+            lengths, num_edges = dataset.sequence_lengths(), None
         return torchDataLoader(
-            dataset=self.train_ds, 
-            batch_size=self.data_config.batch_size, 
-            num_workers=self.data_config.num_workers, 
-            collate_fn=self.train_ds.collate_fn
+            dataset=dataset,
+            batch_sampler=DistributedLengthBucketSampler(
+                lengths, 
+                batch_size=self.data_config.batch_size if max_tokens is None and max_edges is None else None, 
+                shuffle=shuffle,
+                max_tokens=max_tokens,
+                num_edges=num_edges,
+                max_edges=max_edges,
+                extra_tokens=1  # CLS token
+            ),
+            num_workers=self.data_config.num_workers,
+            collate_fn=dataset.collate_fn,
+            pin_memory=self.precompute_laplacian
         )
+
+    def train_dataloader(self):
+        return self._dataloader(self.train_ds, shuffle=True)
     
     def val_dataloader(self):
-        return [
-            torchDataLoader(
-                dataset=val_ds, 
-                batch_size=self.data_config.batch_size, 
-                num_workers=self.data_config.num_workers, 
-                collate_fn=val_ds.collate_fn) 
-            for val_ds in self.val_ds
-        ]
+        return [self._dataloader(val_ds, shuffle=False) for val_ds in self.val_ds]
     
     def test_dataloader(self):
-        return [
-            torchDataLoader(
-                dataset=test_ds, 
-                batch_size=self.data_config.batch_size, 
-                num_workers=self.data_config.num_workers, 
-                collate_fn=test_ds.collate_fn) 
-            for test_ds in self.test_ds
-        ]
+        return [self._dataloader(test_ds, shuffle=False) for test_ds in self.test_ds]
 
 
 def main(args):
@@ -193,6 +213,10 @@ def main(args):
     if "checkpoint_config" in trainer_conf:
         del trainer_conf["checkpoint_config"]
     
+    if any(mconfig.data_config.get(key, None) for key in ["bucket_by_length", "max_tokens_per_batch", "max_edges_per_batch"]):
+        # length-bucketed loaders split batches between processes themselves
+        trainer_conf["use_distributed_sampler"] = False
+
     wandb.init(project=mconfig['wandb_project'], name=name)
     if (mode == "train") or (mode == "debug"):
         trainer = pl.Trainer(**trainer_conf, default_root_dir=str(outdir))
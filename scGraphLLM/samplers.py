@@ -0,0 +1,163 @@
+import math
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler that groups cells of similar tokenized sequence length, so that padding
+    every batch to its longest cell wastes little compute.
+
+    Without shuffling, cells are ordered by decreasing length and cut into consecutive batches,
+    a deterministic order suited to inference (results can be restored to the original order
+    through the dataset indices of the batches). With shuffling, the cells are randomly split
+    into buckets of `bucket_size` cells, each bucket is sorted by length and cut into batches,
+    and the order of all batches is shuffled, reseeded by `set_epoch`.
+
+    Instead of (or in addition to) a fixed number of cells, batches can be packed up to a
+    token budget: cells are added to a batch as long as the padded batch (number of cells
+    times the longest length plus `extra_tokens`) holds at most `max_tokens` tokens and,
+    optionally, the batch has at most `max_edges` edges in total, since graph diffusion
+    costs scale with edges.
+    A single cell exceeding a budget forms a batch on its own.
+
+    Args:
+        lengths (array-like): Sequence length of each cell, e.g. from the dataset's `sequence_lengths`.
+        batch_size (int, optional): Maximum number of cells per batch.
+        shuffle (bool): Whether to shuffle cells within buckets and batches across buckets.
+        bucket_size (int, optional): Number of cells per bucket when shuffling. Defaults to
+            `100 * batch_size`, or 10,000 cells without `batch_size`.
+        drop_last (bool): Whether to drop the last, smaller batch of each bucket (fixed-size batches only).
+        seed (int): Random seed for shuffling.
+        max_tokens (int, optional): Maximum number of padded tokens per batch.
+        num_edges (array-like, optional): Number of edges of each cell, required with `max_edges`.
+        max_edges (int, optional): Maximum number of edges per batch.
+        extra_tokens (int): Tokens added to every cell when batches are collated (e.g. 1 for the
+            CLS token, which `lengths` from `sequence_lengths` leave out), counted in `max_tokens`.
+    """
+    def __init__(
+            self, 
+            lengths, 
+            batch_size=None, 
+            shuffle=False, 
+            bucket_size=None, 
+            drop_last=False, 
+            seed=0, 
+            max_tokens=None, 
+            num_edges=None, 
+            max_edges=None, 
+            extra_tokens=0
+        ):
+        if batch_size is None and max_tokens is None and max_edges is None:
+            raise ValueError("At least one of batch_size, max_tokens and max_edges must be given.")
+        for name, value in [("batch_size", batch_size), ("max_tokens", max_tokens), ("max_edges", max_edges)]:
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be positive, got {value}.")
+        if max_edges is not None and num_edges is None:
+            raise ValueError("num_edges must be provided with max_edges.")
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.num_edges = np.asarray(num_edges, dtype=np.int64) if num_edges is not None else None
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.max_edges = max_edges
+        self.extra_tokens = extra_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size if bucket_size is not None else (100 * batch_size if batch_size is not None else 10_000)
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        """Returns the batches of the current epoch, as arrays of dataset indices."""
+        if not self.shuffle:
+            order = np.argsort(-self.lengths, kind="stable")
+            return self._split(order)
+
+        rng = np.random.default_rng((self.seed, self.epoch))
+        permutation = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(permutation), self.bucket_size):
+            bucket = permutation[start:start + self.bucket_size]
+            batches += self._split(bucket[np.argsort(-self.lengths[bucket], kind="stable")])
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def _split(self, order):
+        if self.max_tokens is None and self.max_edges is None:
+            batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+            if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+                batches = batches[:-1]
+            return batches
+
+        # greedily pack cells (in order) until the next one would exceed a budget
+        lengths = self.lengths[order].tolist()
+        num_edges = self.num_edges[order].tolist() if self.num_edges is not None else [0] * len(order)
+        bounds, size, longest, edges = [0], 0, 0, 0
+        for i, (length, n_edges) in enumerate(zip(lengths, num_edges)):
+            length += self.extra_tokens
+            full = size > 0 and (
+                (self.batch_size is not None and size >= self.batch_size) or
+                (self.max_tokens is not None and max(longest, length) * (size + 1) > self.max_tokens) or
+                (self.max_edges is not None and edges + n_edges > self.max_edges)
+            )
+            if full:
+                bounds.append(i)
+                size, longest, edges = 0, 0, 0
+            size, longest, edges = size + 1, max(longest, length), edges + n_edges
+        bounds.append(len(order))
+        return [order[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batches())
+
+
+class DistributedLengthBucketSampler(LengthBucketSampler):
+    """
+    Distributed counterpart of `LengthBucketSampler`, splitting the batches of each epoch
+    between the processes of a distributed run.
+
+    All processes build the same batches (from the same seed and epoch) and process `rank`
+    takes every `num_replicas`-th batch. Batches are repeated from the start as needed so that
+    every process gets the same number of batches. If not given, the number of replicas and
+    the rank are read from `torch.distributed` when iterating, so the sampler can be created
+    before the process group is initialized.
+
+    Args:
+        lengths (array-like): Sequence length of each cell.
+        batch_size (int, optional): Maximum number of cells per batch.
+        num_replicas (int, optional): Number of processes. Defaults to the world size.
+        rank (int, optional): Rank of this process. Defaults to the current rank.
+        shuffle (bool): Whether to shuffle cells within buckets and batches across buckets.
+        **kwargs: Additional arguments passed to `LengthBucketSampler`.
+    """
+    def __init__(self, lengths, batch_size=None, num_replicas=None, rank=None, shuffle=True, **kwargs):
+        super().__init__(lengths, batch_size, shuffle=shuffle, **kwargs)
+        self._num_replicas = num_replicas
+        self._rank = rank
+
+    @property
+    def num_replicas(self):
+        if self._num_replicas is not None:
+            return self._num_replicas
+        return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+    @property
+    def rank(self):
+        if self._rank is not None:
+            return self._rank
+        return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+    def batches(self):
+        batches = super().batches()
+        if len(batches) == 0:
+            return batches
+        num_batches = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+        batches = (batches * math.ceil(num_batches / len(batches)))[:num_batches]
+        return batches[self.rank::self.num_replicas]
@@ -0,0 +1,130 @@
+import os
+from collections import OrderedDict
+
+from scGraphLLM.tokenizer import TokenizedCell, save_tokenized, load_tokenized
+
+
+class TokenizationCache(object):
+    """
+    Content-addressed store of tokenized cells with a bounded in-memory LRU tier and an
+    optional on-disk tier.
+
+    Entries are keyed by the fingerprints `GraphTokenizer` computes from the expression profile
+    of a cell, the regulatory network, the vocabulary and the tokenizer configuration, so a
+    cache can be shared between tokenizers and runs without returning stale tokenizations.
+    Cells evicted from memory remain available on disk when `cache_dir` is given, and cells
+    found on disk are promoted back to memory.
+
+    Note that with `DataLoader` workers, each worker holds its own memory tier while the
+    disk tier is shared.
+
+    Args:
+        max_items (int): Maximum number of tokenized cells held in memory.
+        cache_dir (str, optional): Directory of the on-disk tier. If None, only memory is used.
+
+    Attributes:
+        hits (int): Number of lookups served from memory or disk.
+        disk_hits (int): Number of lookups served from disk.
+        misses (int): Number of lookups that were not in the cache.
+    """
+    def __init__(self, max_items=100_000, cache_dir=None):
+        if max_items < 0:
+            raise ValueError(f"max_items must be non-negative, got {max_items}.")
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __str__(self):
+        return (
+            f"TokenizationCache(size={len(self)}/{self.max_items}, hits={self.hits}, "
+            f"disk_hits={self.disk_hits}, misses={self.misses}, hit_rate={self.hit_rate:.2%})"
+        )
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate
+        }
+
+    def get(self, key):
+        """
+        Looks up a tokenized cell, first in memory, then on disk.
+
+        Args:
+            key (str): Cache key of the cell.
+
+        Returns:
+            torch_geometric.data.Data or TokenizedCell: The tokenized cell, or None if not cached.
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+
+        if self.cache_dir is not None:
+            for path in [self._path(key, compact=True), self._path(key, compact=False)]:
+                if os.path.exists(path):
+                    data = load_tokenized(path)
+                    self._remember(key, data)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return data
+
+        self.misses += 1
+        return None
+
+    def put(self, key, data):
+        """
+        Adds a tokenized cell to memory, evicting the least recently used cells beyond
+        `max_items`, and writes it to disk if it is not there already.
+
+        Args:
+            key (str): Cache key of the cell.
+            data (torch_geometric.data.Data or TokenizedCell): Tokenized cell.
+        """
+        self._remember(key, data)
+
+        if self.cache_dir is not None:
+            path = self._path(key, compact=isinstance(data, TokenizedCell))
+            if not os.path.exists(path):
+                # write to a temporary file first so that concurrent readers never see partial files
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                save_tokenized(data, tmp_path)
+                os.replace(tmp_path, path)
+
+    def clear(self):
+        """Empties the memory tier and resets the counters. The disk tier is left untouched."""
+        self._memory.clear()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _remember(self, key, data):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _path(self, key, compact):
+        return os.path.join(self.cache_dir, f"{key}.{'npz' if compact else 'pt'}")
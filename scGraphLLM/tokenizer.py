@@ -1,10 +1,12 @@
+import hashlib
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import torch
 from torch_geometric.data import Data as torchGeomData
 
 from scGraphLLM.vocab import GeneVocab
-from scGraphLLM.network import RegulatoryNetwork
+from scGraphLLM.network import RegulatoryNetwork, NetworkAdjacency
 from scGraphLLM._globals import *
 
 
@@ -36,6 +38,11 @@ class GraphTokenizer:
         n_bins (int): Number of discrete bins to categorize gene expression values into.
         method (str): Method for binning expression values; 'quantile' uses quantiles of
             non-zero expression values, 'uniform' uses equal-width bins.
+        compact (bool): If True, return tokenized cells as compact `TokenizedCell` records
+            instead of torch_geometric Data objects.
+        cache (TokenizationCache, optional): Cache of tokenized cells, keyed by fingerprints of the
+            expression profile, the network and the tokenizer configuration. Cached cells are
+            returned without being tokenized again.
 
     Notes:
         - Filtering order is: expression filtering → neighbor inclusion (if enabled) → network membership filtering → max sequence length enforcement.
@@ -52,8 +59,14 @@ class GraphTokenizer:
             only_network_genes=True,
             with_edge_weights=False,
             n_bins=NUM_BINS, 
-            method="quantile"
+            method="quantile",
+            compact=False,
+            cache=None
         ):
+        if compact and n_bins > TokenizedCell.MAX_BINS:
+            raise ValueError(f"Compact tokenization supports at most {TokenizedCell.MAX_BINS} bins, got n_bins={n_bins}.")
+        if compact and max_seq_length is not None and max_seq_length > TokenizedCell.MAX_NODES:
+            raise ValueError(f"Compact tokenization supports at most {TokenizedCell.MAX_NODES} genes, got max_seq_length={max_seq_length}.")
         self.vocab = vocab
         self.network = network
         self.max_seq_length = max_seq_length
@@ -63,6 +76,9 @@ class GraphTokenizer:
         self.with_edge_weights = with_edge_weights
         self.n_bins = n_bins
         self.method = method
+        self.compact = compact
+        self.cache = cache
+        self._columns_fingerprint = (None, None)
 
     @property
     def gene_to_node(self):
@@ -83,16 +99,29 @@ class GraphTokenizer:
             target_sum (float): target sum for normalization if from_counts is True
 
         Returns:
-            torch_geometric.data.Data: Expression features and regulatory edges.
+            torch_geometric.data.Data or TokenizedCell: Expression features and regulatory edges.
         """
-        if from_counts:
-            cell_expr = np.log1p(cell_expr / cell_expr.sum() * target_sum)
-
         # override original network if network is provided
         network = override_network if override_network is not None else self.network
+
+        if self.cache is None:
+            return self._tokenize_cell(cell_expr, network, from_counts, target_sum)
+
+        values = cell_expr.to_numpy()
+        cols = np.flatnonzero(values)
+        key = self._cache_keys(cell_expr.index, np.zeros(len(cols), dtype=np.int64), cols, values[cols], 1, network, from_counts, target_sum)[0]
+        data = self.cache.get(key)
+        if data is None:
+            data = self._tokenize_cell(cell_expr, network, from_counts, target_sum)
+            self.cache.put(key, data)
+        return data
+
+    def _tokenize_cell(self, cell_expr: pd.Series, network: RegulatoryNetwork, from_counts, target_sum):
+        if from_counts:
+            cell_expr = np.log1p(cell_expr / cell_expr.sum() * target_sum)
         
         # limit cell to known genes in vocabulary
-        cell_expr = cell_expr[cell_expr.index.isin(self.gene_to_node)]
+        cell_expr = cell_expr[self.vocab.align(cell_expr.index) >= 0]
 
         # tokenize cell by by binning expression values
         cell = tokenize_expr(cell_expr, n_bins=self.n_bins, method=self.method)
@@ -104,27 +133,24 @@ class GraphTokenizer:
         if (self.max_seq_length is not None) and (cell.shape[0] > self.max_seq_length):
             cell = cell.nlargest(n=self.max_seq_length, keep="first")
 
-        # create local gene to node mapping
-        local_gene_to_node = {gene:i for i, gene in enumerate(cell.index)}
+        # create edge list from the subgraph induced by the genes in the cell
+        nodes = self.vocab.encode(cell.index).astype(np.int64)
+        reg_index, tar_index, edge_ids = network.adjacency(self.vocab).subgraph(nodes)
 
-        # Subset network to only include genes in the cell
-        network_cell = network.df.copy()
-        network_cell = network_cell[
-            network_cell[network.reg_name].isin(cell.index) & 
-            network_cell[network.tar_name].isin(cell.index)
-        ]
+        if self.compact:
+            return TokenizedCell(
+                genes=nodes, 
+                bins=cell.to_numpy(), 
+                edge_index=[reg_index, tar_index],
+                edge_weight=network.weights.to_numpy()[edge_ids] if self.with_edge_weights else None
+            )
 
-        # create edge list
-        reg_index = network_cell[network.reg_name].map(local_gene_to_node).values
-        tar_index = network_cell[network.tar_name].map(local_gene_to_node).values
         edge_index = torch.tensor(np.array([reg_index, tar_index]))
 
-        node_expression = torch.tensor(np.array([
-            (self.gene_to_node[gene], cell[gene]) for gene in cell.index
-        ]), dtype=torch.long)
+        node_expression = torch.tensor(np.stack([nodes, cell.to_numpy()], axis=1), dtype=torch.long)
    
         if self.with_edge_weights:
-            edge_weights = torch.tensor(np.array(network_cell[network.wt_name]))
+            edge_weights = torch.tensor(network.weights.to_numpy()[edge_ids])
             data = torchGeomData(
                 x=node_expression, 
                 edge_index=edge_index, 
@@ -138,6 +164,253 @@ class GraphTokenizer:
 
         return data
 
+    def tokenize_batch(self, X, gene_names, override_network: RegulatoryNetwork = None, from_counts=False, target_sum=1e6):
+        """
+        Tokenizes a block of cells in a single vectorized pass.
+
+        Binning, gene selection, max sequence length enforcement and edge extraction are
+        carried out with NumPy array operations over the whole block. The output is identical
+        to calling the tokenizer on each row of `X` individually.
+
+        Args:
+            X (np.ndarray or scipy.sparse.spmatrix): Expression block (cells x genes).
+            gene_names (array-like): Gene names corresponding to the columns of `X`.
+            override_network (RegulatoryNetwork, optional): Overrides the default network for this block.
+            from_counts (boolean): If True, assume X is raw UMI counts and normalize + log transform.
+            target_sum (float): target sum for normalization if from_counts is True
+
+        Returns:
+            List[torch_geometric.data.Data] or List[TokenizedCell]: Expression features and regulatory
+                edges, one per row of `X`.
+        """
+        network = override_network if override_network is not None else self.network
+
+        if self.cache is None:
+            return self._tokenize_batch(X, gene_names, network, from_counts, target_sum)
+
+        if sp.issparse(X):
+            X = sp.csr_matrix(X)
+        rows, cols, values = _nonzero_entries(X)
+        keys = self._cache_keys(gene_names, rows, cols, values, X.shape[0], network, from_counts, target_sum)
+        tokenized = [self.cache.get(key) for key in keys]
+
+        # tokenize the cells missing from the cache together
+        missing = [i for i, data in enumerate(tokenized) if data is None]
+        if len(missing) > 0:
+            for i, data in zip(missing, self._tokenize_batch(X[missing], gene_names, network, from_counts, target_sum)):
+                self.cache.put(keys[i], data)
+                tokenized[i] = data
+
+        return tokenized
+
+    def sequence_lengths(
+            self, 
+            X, 
+            gene_names, 
+            override_network: RegulatoryNetwork = None, 
+            from_counts=False, 
+            target_sum=1e6, 
+            block_size=1024, 
+            with_edges=False
+        ):
+        """
+        Computes the number of gene tokens each cell would be tokenized into, without building
+        tokenized cells. Used to index cells by sequence length for batching.
+
+        Args:
+            X (np.ndarray or scipy.sparse.spmatrix): Expression block (cells x genes).
+            gene_names (array-like): Gene names corresponding to the columns of `X`.
+            override_network (RegulatoryNetwork, optional): Overrides the default network.
+            from_counts (boolean): If True, assume X is raw UMI counts and normalize + log transform.
+            target_sum (float): target sum for normalization if from_counts is True
+            block_size (int): Number of cells processed at once.
+            with_edges (bool): Whether to also count the edges of each cell, which requires
+                extracting its subgraph.
+
+        Returns:
+            np.ndarray: Number of gene tokens (excluding CLS) of each row of `X`. With `with_edges`,
+                a tuple of the number of tokens and the number of edges.
+        """
+        network = override_network if override_network is not None else self.network
+        if sp.issparse(X):
+            X = sp.csr_matrix(X)
+
+        lengths = np.zeros(X.shape[0], dtype=np.int64)
+        num_edges = np.zeros(X.shape[0], dtype=np.int64)
+        for start in range(0, X.shape[0], block_size):
+            block = X[start:start + block_size]
+            if not with_edges:
+                _, _, selected, _ = self._select_block(block, gene_names, network, from_counts, target_sum)
+                lengths[start:start + block_size] = selected.sum(axis=1)
+                continue
+
+            nodes, _, _, token_cols, offsets, adjacency = self._token_layout(block, gene_names, network, from_counts, target_sum)
+            edge_rows, _, _, _ = adjacency.subgraphs(nodes[token_cols], offsets)
+            lengths[start:start + block_size] = np.diff(offsets)
+            num_edges[start:start + block_size] = np.bincount(edge_rows, minlength=block.shape[0])
+
+        if self.max_seq_length is not None:
+            lengths = np.minimum(lengths, self.max_seq_length)
+        return (lengths, num_edges) if with_edges else lengths
+
+    def _select_block(self, X, gene_names, network: RegulatoryNetwork, from_counts, target_sum):
+        """
+        Bins a block of cells and selects the genes to tokenize, returning the node ids of the
+        block's known genes, the (cells x genes) bins, the selection mask and the network adjacency.
+        """
+        all_nodes = self.vocab.align(gene_names)
+        n_cells = X.shape[0]
+        rows, cols, values = _nonzero_entries(X)
+
+        if from_counts:
+            cell_sums = np.asarray(X.sum(axis=1)).ravel()
+            values = np.log1p(values / cell_sums[rows] * target_sum)
+
+        # limit block to known genes in vocabulary
+        known = all_nodes >= 0
+        nodes = all_nodes[known].astype(np.int64)
+        col_map = np.full(len(all_nodes), -1, dtype=np.int64)
+        col_map[known] = np.arange(len(nodes))
+        keep = known[cols]
+        rows, cols, values = rows[keep], col_map[cols[keep]], values[keep]
+
+        # tokenize cells by binning expression values
+        bins = np.zeros((n_cells, len(nodes)), dtype=np.int16)
+        bins[rows, cols] = _bin_nonzero(values, rows, n_cells, n_bins=self.n_bins, method=self.method)
+
+        # select genes to include in tokenization
+        adjacency = network.adjacency(self.vocab)
+        selected = self._select_genes_batch(bins, nodes, adjacency)
+        return nodes, bins, selected, adjacency
+
+    def _token_layout(self, X, gene_names, network: RegulatoryNetwork, from_counts, target_sum):
+        """
+        Selects the tokens of a block of cells, returning the node ids of the block's known genes,
+        the bins, the (row, column) of each token grouped by cell, the token offsets of each cell
+        and the network adjacency.
+        """
+        n_cells = X.shape[0]
+        nodes, bins, selected, adjacency = self._select_block(X, gene_names, network, from_counts, target_sum)
+
+        # enforce max sequence length, keeping the top genes by expression (ties by position)
+        n_selected = selected.sum(axis=1)
+        sort_key = np.where(selected, 0, 1).astype(np.int32)
+        if self.max_seq_length is not None:
+            truncate = n_selected > self.max_seq_length
+            sort_key[truncate] = np.where(selected[truncate], -bins[truncate], self.n_bins + 1)
+            n_tokens = np.minimum(n_selected, self.max_seq_length)
+        else:
+            n_tokens = n_selected
+        order = np.argsort(sort_key, axis=1, kind="stable")
+        token_cols = order[np.arange(len(nodes)) < n_tokens[:, None]]
+        token_rows = np.repeat(np.arange(n_cells), n_tokens)
+        offsets = np.concatenate([[0], np.cumsum(n_tokens)])
+        return nodes, bins, token_rows, token_cols, offsets, adjacency
+
+    def _tokenize_batch(self, X, gene_names, network: RegulatoryNetwork, from_counts, target_sum):
+        n_cells = X.shape[0]
+        nodes, bins, token_rows, token_cols, offsets, adjacency = self._token_layout(X, gene_names, network, from_counts, target_sum)
+
+        # extract edges with both endpoints tokenized, reading only the rows of the tokenized genes
+        edge_rows, edge_src, edge_dst, edge_ids = adjacency.subgraphs(nodes[token_cols], offsets)
+        edge_offsets = np.concatenate([[0], np.cumsum(np.bincount(edge_rows, minlength=n_cells))])
+
+        node_expression = np.stack([nodes[token_cols], bins[token_rows, token_cols]], axis=1).astype(np.int64)
+        weights = network.weights.to_numpy()[edge_ids] if self.with_edge_weights else None
+
+        if self.compact:
+            genes = nodes[token_cols].astype(np.int32)
+            token_bins = bins[token_rows, token_cols].astype(np.uint8)
+            edge_index = np.array([edge_src, edge_dst], dtype=np.int16)
+            weights = weights.astype(np.float32) if self.with_edge_weights else None
+            return [
+                TokenizedCell(
+                    genes=genes[offsets[i]:offsets[i + 1]],
+                    bins=token_bins[offsets[i]:offsets[i + 1]],
+                    edge_index=edge_index[:, edge_offsets[i]:edge_offsets[i + 1]],
+                    edge_weight=weights[edge_offsets[i]:edge_offsets[i + 1]] if self.with_edge_weights else None
+                )
+                for i in range(n_cells)
+            ]
+
+        tokenized = []
+        for i in range(n_cells):
+            t0, t1 = offsets[i], offsets[i + 1]
+            e0, e1 = edge_offsets[i], edge_offsets[i + 1]
+            data = torchGeomData(
+                x=torch.tensor(node_expression[t0:t1], dtype=torch.long),
+                edge_index=torch.tensor(np.array([edge_src[e0:e1], edge_dst[e0:e1]]))
+            )
+            if self.with_edge_weights:
+                data.edge_weight = torch.tensor(weights[e0:e1])
+            tokenized.append(data)
+
+        return tokenized
+
+    def _cache_keys(self, gene_names, rows, cols, values, n_cells, network, from_counts, target_sum):
+        """
+        Computes the cache key of each cell of a block from its nonzero entries (in row-major order),
+        the gene names of the columns, the network, the vocabulary and the tokenizer configuration.
+        """
+        if self._columns_fingerprint[0] is not gene_names:
+            hashes = pd.util.hash_pandas_object(pd.Index(gene_names), index=False).to_numpy()
+            self._columns_fingerprint = (gene_names, hashlib.blake2b(hashes.tobytes(), digest_size=16).hexdigest())
+
+        config = (
+            self.max_seq_length, self.only_expressed_genes, self.only_expressed_plus_neighbors, self.only_network_genes,
+            self.with_edge_weights, self.n_bins, self.method, self.compact, from_counts, target_sum, values.dtype.str
+        )
+        prefix = hashlib.blake2b(digest_size=16)
+        prefix.update(repr(config).encode())
+        for fingerprint in [self.vocab.fingerprint, network.fingerprint, self._columns_fingerprint[1]]:
+            prefix.update(fingerprint.encode())
+
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_cells))])
+        cols = cols.astype(np.int64)
+        keys = []
+        for i in range(n_cells):
+            digest = prefix.copy()
+            digest.update(cols[offsets[i]:offsets[i + 1]].tobytes())
+            digest.update(values[offsets[i]:offsets[i + 1]].tobytes())
+            keys.append(digest.hexdigest())
+        return keys
+
+    def _select_genes_batch(self, bins: np.ndarray, nodes: np.ndarray, adjacency: NetworkAdjacency):
+        """
+        Block-wise counterpart of `select_genes`, returning a (cells x genes) selection mask.
+        """
+        expressed = bins != ZERO_IDX
+        in_network = adjacency.in_network[nodes]
+        selected = np.ones_like(expressed)
+
+        # limit cell to expressed genes
+        if self.only_expressed_genes and not self.only_expressed_plus_neighbors:
+            selected = expressed
+
+        # limit cell to expressed genes and their neighbors
+        if self.only_expressed_plus_neighbors:
+            expressed = expressed & in_network
+            rows, cols = np.nonzero(expressed)
+            indicator = sp.csr_matrix(
+                (np.ones(len(rows), dtype=np.float32), (rows, nodes[cols])), 
+                shape=(len(bins), adjacency.num_nodes)
+            )
+
+            # neighbors of every cell in one sparse product, mapped back to block columns
+            node_col = np.full(adjacency.num_nodes, -1, dtype=np.int64)
+            node_col[nodes] = np.arange(len(nodes))
+            rows, neighbor_cols = adjacency.neighbors(indicator).nonzero()
+            neighbor_cols = node_col[neighbor_cols]
+            in_block = neighbor_cols >= 0
+            selected = expressed.copy()
+            selected[rows[in_block], neighbor_cols[in_block]] = True
+
+        # limit cell to genes in the the network
+        if self.only_network_genes:
+            selected = selected & in_network
+
+        return selected
+
     def select_genes(self, cell: pd.Series, network: RegulatoryNetwork):
         # limit cell to expressed genes
         if self.only_expressed_genes and not self.only_expressed_plus_neighbors:
@@ -145,27 +418,262 @@ class GraphTokenizer:
         
         # limit cell to expressed genes and their neighbors
         if self.only_expressed_plus_neighbors:
-            expressed = set(cell[cell != ZERO_IDX].index) & network.genes
-            neighbors = set()
-
-            # collect all neighbors (regulators and targets) of expressed genes
-            network_df = network.df
-            mask = network_df[network.reg_name].isin(expressed) | network_df[network.tar_name].isin(expressed)
-            neighbors.update(network_df.loc[mask, network.reg_name])
-            neighbors.update(network_df.loc[mask, network.tar_name])
+            adjacency = network.adjacency(self.vocab)
+            nodes = self.vocab.encode(cell.index).astype(np.int64)
+            known = nodes >= 0
+            expressed = (cell.to_numpy() != ZERO_IDX) & known
+            expressed[known] &= adjacency.in_network[nodes[known]]
+            indicator = sp.csr_matrix(
+                (np.ones(expressed.sum(), dtype=np.float32), (np.zeros(expressed.sum(), dtype=np.int64), nodes[expressed])),
+                shape=(1, adjacency.num_nodes)
+            )
 
             # union of expressed + neighbors, limited to available genes
-            selected_genes = expressed | neighbors
-            selected_genes = selected_genes & set(cell.index)
-            cell = cell[cell.index.isin(selected_genes)]
+            neighbors = adjacency.neighbors(indicator).toarray().ravel()
+            selected = expressed.copy()
+            selected[known] |= neighbors[nodes[known]]
+            cell = cell[selected]
 
         # limit cell to genes in the the network
         if self.only_network_genes:
-            cell = cell[cell.index.isin(network.genes)]
+            nodes = self.vocab.encode(cell.index).astype(np.int64)
+            in_network = np.zeros(len(nodes), dtype=bool)
+            in_network[nodes >= 0] = network.adjacency(self.vocab).in_network[nodes[nodes >= 0]]
+            cell = cell[in_network]
 
         return cell
 
 
+class TokenizedCell:
+    """
+    Compact struct-of-arrays record of a tokenized cell.
+
+    Holds the same information as the torch_geometric Data object produced by `GraphTokenizer`,
+    using the smallest dtypes that fit: `int32` gene node indices, `uint8` expression bins,
+    `int16` local edge endpoints and `float32` (or `float16`) edge weights. Records are saved
+    as uncompressed `.npz` archives and converted to tensors without copying.
+
+    Args:
+        genes (array-like): Node index of each gene token.
+        bins (array-like): Expression bin of each gene token.
+        edge_index (array-like): (2 x num_edges) local indices of the regulator and target of each edge.
+        edge_weight (array-like, optional): Weight of each edge.
+        weight_dtype (np.dtype): Floating point dtype used to store edge weights.
+        obs_name (str, optional): Name of the tokenized cell.
+    """
+    MAX_NODES = np.iinfo(np.int16).max
+    MAX_BINS = np.iinfo(np.uint8).max  # largest bin value, bins are 1 to n_bins (0 for no expression)
+
+    def __init__(self, genes, bins, edge_index, edge_weight=None, weight_dtype=np.float32, obs_name=None):
+        bins = np.asarray(bins)
+        if bins.size > 0 and (bins.min() < 0 or bins.max() > self.MAX_BINS):
+            raise ValueError(f"TokenizedCell supports bins from 0 to {self.MAX_BINS}, got {bins.min()} to {bins.max()}.")
+        self.genes = np.asarray(genes, dtype=np.int32)
+        self.bins = bins.astype(np.uint8, copy=False)
+        self.edge_index = np.asarray(edge_index, dtype=np.int16).reshape(2, -1)
+        self.edge_weight = None if edge_weight is None else np.asarray(edge_weight, dtype=weight_dtype)
+        self.obs_name = obs_name
+
+        if len(self.genes) > self.MAX_NODES:
+            raise ValueError(f"TokenizedCell supports at most {self.MAX_NODES} genes, got {len(self.genes)}.")
+        if len(self.genes) != len(self.bins):
+            raise ValueError("genes and bins must have the same length.")
+
+    @property
+    def num_nodes(self):
+        return len(self.genes)
+
+    @property
+    def num_edges(self):
+        return self.edge_index.shape[1]
+
+    def to_tensors(self):
+        """
+        Views the record's arrays as tensors, without copying.
+
+        Returns:
+            tuple: Gene node indices, expression bins, edge index and edge weights (None if absent).
+        """
+        edge_weight = None if self.edge_weight is None else torch.from_numpy(self.edge_weight)
+        return torch.from_numpy(self.genes), torch.from_numpy(self.bins), torch.from_numpy(self.edge_index), edge_weight
+
+    def to_data(self) -> torchGeomData:
+        """
+        Converts the record to the torch_geometric Data object produced by `GraphTokenizer`.
+        """
+        genes, bins, edge_index, edge_weight = self.to_tensors()
+        data = torchGeomData(
+            x=torch.stack([genes, bins.to(genes.dtype)], dim=1).long(), 
+            edge_index=edge_index.long()
+        )
+        if edge_weight is not None:
+            data.edge_weight = edge_weight
+        return data
+
+    def save(self, path):
+        arrays = {"genes": self.genes, "bins": self.bins, "edge_index": self.edge_index}
+        if self.edge_weight is not None:
+            arrays["edge_weight"] = self.edge_weight
+        if self.obs_name is not None:
+            arrays["obs_name"] = np.array(self.obs_name)
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            edge_weight = arrays["edge_weight"] if "edge_weight" in arrays else None
+            return cls(
+                genes=arrays["genes"],
+                bins=arrays["bins"],
+                edge_index=arrays["edge_index"],
+                edge_weight=edge_weight,
+                weight_dtype=None if edge_weight is None else edge_weight.dtype,
+                obs_name=arrays["obs_name"].item() if "obs_name" in arrays else None
+            )
+
+
+def save_tokenized(data, file):
+    if isinstance(data, TokenizedCell):
+        data.save(file)
+    else:
+        torch.save(data, file)
+
+
+def load_tokenized(file):
+    if str(file).endswith(".npz"):
+        return TokenizedCell.load(file)
+    return torch.load(file, weights_only=False)
+
+
+def _nonzero_entries(X):
+    """
+    Returns the row indices, column indices and values of the nonzero entries of a
+    dense array or scipy sparse matrix, in row-major order.
+    """
+    if sp.issparse(X):
+        X = sp.csr_matrix(X)
+        rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        cols, values = X.indices.astype(np.int64), X.data
+        nonzero = values != 0
+        return rows[nonzero], cols[nonzero], values[nonzero]
+    X = np.asarray(X)
+    rows, cols = np.nonzero(X)
+    return rows, cols, X[rows, cols]
+
+
+def _bin_nonzero(values: np.ndarray, rows: np.ndarray, n_rows: int, n_bins: int = 5, method: str = "quantile") -> np.ndarray:
+    """
+    Vectorized counterpart of `tokenize_expr` operating on the nonzero entries of many cells at once.
+
+    Bin edges are computed per row over the nonzero values only, reproducing `np.quantile`
+    (linear interpolation) and `np.linspace` exactly, and values are assigned to bins with the
+    semantics of `np.digitize(..., right=True)`.
+
+    Args:
+        values (np.ndarray): Nonzero expression values.
+        rows (np.ndarray): Row (cell) index of each value.
+        n_rows (int): Total number of rows.
+        n_bins (int): Number of bins to categorize expression values into.
+        method (str): "quantile" or any other value for equally spaced bins.
+
+    Returns:
+        np.ndarray: int16 bin number (1 to n_bins) of each value, in the order of `values`.
+    """
+    binned = np.zeros(len(values), dtype=np.int16)
+    if len(values) == 0:
+        return binned
+
+    # sort values within each row
+    order = np.lexsort((values, rows))
+    sorted_values, sorted_rows = values[order], rows[order]
+    counts = np.bincount(sorted_rows, minlength=n_rows)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    # rows with a single unique nonzero value are assigned the middle bin
+    present = np.flatnonzero(counts)
+    multi = present[sorted_values[starts[present]] != sorted_values[starts[present] + counts[present] - 1]]
+    sorted_binned = np.full(len(values), round(n_bins / 2), dtype=np.int16)
+    if len(multi) == 0:
+        binned[order] = sorted_binned
+        return binned
+
+    # bin edges for each row with more than one unique value, shape (len(multi), n_edges)
+    first, n = starts[multi], counts[multi]
+    if method == "quantile":
+        quantiles = np.linspace(0, 1, n_bins)[1:-1]
+        virtual = (n - 1)[:, None] * quantiles[None, :]
+        previous = np.floor(virtual)
+        gamma = virtual - previous
+        previous = np.minimum(previous.astype(np.int64), (n - 1)[:, None])
+        following = np.minimum(previous + 1, (n - 1)[:, None])
+        lower = sorted_values[first[:, None] + previous]
+        upper = sorted_values[first[:, None] + following]
+        diff = upper - lower
+        edges = lower + diff * gamma
+        edges = np.where(gamma >= 0.5, upper - diff * (1 - gamma), edges)
+    else:
+        # in double precision, like np.linspace on the (scalar) min and max of each row
+        lowest, highest = sorted_values[first].astype(np.float64), sorted_values[first + n - 1].astype(np.float64)
+        edges = np.linspace(lowest, highest, n_bins, axis=1)
+    n_edges = edges.shape[1]
+
+    # count the edges strictly below each value (np.digitize with right=True) by merging
+    # the sorted values and edges of each row, values first on ties
+    in_multi = np.zeros(n_rows, dtype=bool)
+    in_multi[multi] = True
+    value_pos = np.flatnonzero(in_multi[sorted_rows])
+    multi_rank = np.zeros(n_rows, dtype=np.int64)
+    multi_rank[multi] = np.arange(len(multi))
+    value_rank = multi_rank[sorted_rows[value_pos]]
+
+    merged_rows = np.concatenate([value_rank, np.repeat(np.arange(len(multi)), n_edges)])
+    merged_values = np.concatenate([sorted_values[value_pos], edges.ravel()])
+    is_edge = np.concatenate([np.zeros(len(value_pos), dtype=np.int8), np.ones(edges.size, dtype=np.int8)])
+    merge_order = np.lexsort((is_edge, merged_values, merged_rows))
+    edges_before = np.cumsum(is_edge[merge_order])
+    is_value = merge_order < len(value_pos)
+    digitized = np.empty(len(value_pos), dtype=np.int64)
+    digitized[merge_order[is_value]] = edges_before[is_value] - value_rank[merge_order[is_value]] * n_edges
+
+    sorted_binned[value_pos] = digitized + 1
+    binned[order] = sorted_binned
+    return binned
+
+
+def quantize_sparse(X, n_bins: int = 5, method: str = "quantile", dtype=np.int16) -> sp.csr_matrix:
+    """
+    Discretize (bin) the expression profiles of many cells stored as a sparse matrix.
+
+    Bin edges are computed per row over the stored nonzero values only, with a single sort
+    of all nonzeros by (row, value), so neither a dense cells x genes matrix nor a Python loop
+    over cells is needed. Each row is binned exactly as `tokenize_expr` would bin it.
+
+    Parameters
+    ----------
+    X : scipy.sparse.spmatrix or np.ndarray
+        Expression matrix (cells x genes).
+    n_bins : int, optional (default=5)
+        Number of bins to categorize expression values into.
+    method : str, optional (default="quantile")
+        Method to determine bin edges, see `tokenize_expr`.
+    dtype : np.dtype, optional (default=np.int16)
+        Integer dtype of the returned bins, e.g. np.uint8 when n_bins < 256.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Bin numbers (1 to n_bins) with the same sparsity pattern as `X`.
+        Explicitly stored zeros remain in bin 0.
+    """
+    X = sp.csr_matrix(X)
+    rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    nonzero = X.data != 0
+    binned = np.zeros(X.nnz, dtype=dtype)
+    binned[nonzero] = _bin_nonzero(X.data[nonzero], rows[nonzero], X.shape[0], n_bins=n_bins, method=method)
+    return sp.csr_matrix((binned, X.indices.copy(), X.indptr.copy()), shape=X.shape)
+
+
 def tokenize_expr(expr: pd.Series, n_bins: int = 5, method: str = "quantile") -> pd.Series:
     """
     Discretize (bin) a single gene expression profile into categorical bins.
@@ -194,28 +702,17 @@ def tokenize_expr(expr: pd.Series, n_bins: int = 5, method: str = "quantile") ->
     - Only non-zero expression values are binned; zero values remain zero.
     - If there is only one unique non-zero value, it is assigned the middle bin (rounded n_bins/2).
     """
-    non_zero_idx = expr.to_numpy(dtype=float).nonzero()[0]
-    binned = np.zeros_like(expr, dtype=np.int16)
-
-    if len(non_zero_idx) == 0:
-        return pd.Series(binned, index=expr.index)
-    
-    non_zero_expr = expr.iloc[non_zero_idx]
-    if np.unique(non_zero_expr).shape[0] > 1:
-        if method == "quantile":
-            bins = np.quantile(non_zero_expr, np.linspace(0, 1, n_bins))[1:-1]
-        else:
-            bins = np.linspace(min(non_zero_expr), max(non_zero_expr), n_bins)
-        binned[non_zero_idx] = np.digitize(non_zero_expr, bins, right=True) + 1
-    else:
-        binned[non_zero_idx] = round(n_bins / 2)
-
+    values = expr.to_numpy()
+    non_zero_idx = values.astype(float).nonzero()[0]
+    binned = np.zeros(len(values), dtype=np.int16)
+    binned[non_zero_idx] = _bin_nonzero(
+        values[non_zero_idx], np.zeros(len(non_zero_idx), dtype=np.int64), 1, n_bins=n_bins, method=method
+    )
     return pd.Series(binned, index=expr.index)
 
 
 def quantize_cells(gex: pd.DataFrame, n_bins: int = 5, method: str = "quantile") -> pd.DataFrame:
-    tokenized_cells = [
-        tokenize_expr(gex.iloc[i], n_bins=n_bins, method=method)
-        for i in range(len(gex))
-    ]
-    return pd.DataFrame(tokenized_cells, index=gex.index, columns=gex.columns)
+    rows, cols, values = _nonzero_entries(gex.to_numpy())
+    binned = np.zeros(gex.shape, dtype=np.int16)
+    binned[rows, cols] = _bin_nonzero(values, rows, gex.shape[0], n_bins=n_bins, method=method)
+    return pd.DataFrame(binned, index=gex.index, columns=gex.columns)
@@ -32,7 +32,7 @@ import importlib
 import torch
 from typing import Tuple
 from einops import repeat
-from scGraphLLM.graph_op import _chebyshev_diffusion
+from scGraphLLM.graph_op import _diffusion, _adaptive_order, DIFFUSION_BACKENDS
 from scGraphLLM.MLP_modules import PerturbEmbedding
 from scGraphLLM._globals import *
 
@@ -192,6 +192,9 @@ class FlashMHASelfMaskKV(nn.Module):
             diffusion_kernel_attn=False, 
             fine_tuning=False,
             use_rotary_emb=None, 
+            diffusion_order=64,
+            diffusion_tol=None,
+            diffusion_backend="chebyshev",
             device = None, 
             dtype = None
         ) -> None:
@@ -202,6 +205,13 @@ class FlashMHASelfMaskKV(nn.Module):
         self.d_model = d_model
         self.causal = causal
         self.diffusion_kernel_attn= diffusion_kernel_attn
+        # with a tolerance, diffusion_order is the maximum order and the series is truncated once
+        # the remaining Chebyshev coefficients sum below the tolerance (the effective order)
+        self.max_diffusion_order = diffusion_order
+        self.diffusion_tol = diffusion_tol
+        self.diffusion_order = _adaptive_order(diffusion_order, BETA, diffusion_tol) if diffusion_tol is not None else diffusion_order
+        assert diffusion_backend in DIFFUSION_BACKENDS, f"diffusion_backend must be one of {DIFFUSION_BACKENDS}"
+        self.diffusion_backend = diffusion_backend
         self.dropout_p = attention_dropout
         self.mode = mode 
         self.num_heads = num_heads
@@ -219,7 +229,7 @@ class FlashMHASelfMaskKV(nn.Module):
                                             hidden_dim=100, output_dim=self.d_model)
 
     def forward(self, q, k,v, key_padding_mask=None, 
-                edge_index_list=None, num_nodes_list=None, perturb_one_hot=None):
+                edge_index_list=None, num_nodes_list=None, perturb_one_hot=None, graph_context=None):
         """
         Credit: some elements adopted from OpenFold:
         https://github.com/aqlaboratory/openfold/blob/feed4ae22edf899b37bee49293fff902bdd64e2d/openfold/model/primitives.py#L660
@@ -241,7 +251,9 @@ class FlashMHASelfMaskKV(nn.Module):
         if self.diffusion_kernel_attn:
             q_genes = q[:, 1:, :, :]
             q_cls = q[:, 0, :, :]
-            q_genes_diffused = _chebyshev_diffusion(edge_index_list, num_nodes_list, q_genes, k=64, beta=BETA)
+            q_genes_diffused = _diffusion(edge_index_list, num_nodes_list, q_genes, k=self.max_diffusion_order, beta=BETA, 
+                                          graph_context=graph_context, tol=self.diffusion_tol, 
+                                          backend=self.diffusion_backend)
             
             # shift query by perturbational embedding if observing perturb seq data
             if self.fine_tuning:
@@ -324,7 +336,10 @@ class FlashTransformerEncoderLayer(nn.Module):
             norm_first=False,
             lora_qv_rank=None, 
             use_rotary_emb=False, 
-            init_scheme = "kaiming_uniform"
+            init_scheme = "kaiming_uniform",
+            diffusion_order=64,
+            diffusion_tol=None,
+            diffusion_backend="chebyshev"
         ):
         
         super(FlashTransformerEncoderLayer, self).__init__()
@@ -345,7 +360,8 @@ class FlashTransformerEncoderLayer(nn.Module):
         self.self_attention = FlashMHASelfMaskKV(
             d_model=d_model, num_heads = nhead, batch_first = batch_first, 
             attention_dropout=dropout, use_rotary_emb=use_rotary_emb, 
-            diffusion_kernel_attn=diffusion_kernel_attn, fine_tuning=self.fine_tuning
+            diffusion_kernel_attn=diffusion_kernel_attn, fine_tuning=self.fine_tuning,
+            diffusion_order=diffusion_order, diffusion_tol=diffusion_tol, diffusion_backend=diffusion_backend
         )
     
         ## Wqkv:
@@ -371,7 +387,7 @@ class FlashTransformerEncoderLayer(nn.Module):
         self.ln2 = nn.LayerNorm(d_model, eps=layer_norm_eps)
         
     def forward(self, qkv, p=None, key_padding_mask=None, edge_index_list=None, 
-                num_nodes_list=None, perturb_one_hot=None):
+                num_nodes_list=None, perturb_one_hot=None, graph_context=None):
         x = qkv
         if self.use_PE:
             assert p is not None, "Positional encoding tensor must be provided when use_PE is True."
@@ -393,7 +409,8 @@ class FlashTransformerEncoderLayer(nn.Module):
                 x = x + self.self_attention(q, k, v, 
                                             edge_index_list=edge_index_list, 
                                             num_nodes_list=num_nodes_list,
-                                            perturb_one_hot=perturb_one_hot)
+                                            perturb_one_hot=perturb_one_hot,
+                                            graph_context=graph_context)
             else:
                 x = x + self.self_attention(q, k, v, key_padding_mask=key_padding_mask)
             
@@ -410,7 +427,8 @@ class FlashTransformerEncoderLayer(nn.Module):
                 x = x + self.self_attention(q, k, v, 
                                             edge_index_list=edge_index_list, 
                                             num_nodes_list=num_nodes_list,
-                                            perturb_one_hot=perturb_one_hot)
+                                            perturb_one_hot=perturb_one_hot,
+                                            graph_context=graph_context)
             else:
                 x = x + self.self_attention(q, k, v, key_padding_mask=key_padding_mask)
 
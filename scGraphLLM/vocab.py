@@ -1,3 +1,5 @@
+import hashlib
+import numpy as np
 import pandas as pd
 import importlib.resources as pkg_resources
 
@@ -21,6 +23,9 @@ class GeneVocab(object):
         nodes (list): Corresponding list of node indices.
         gene_to_node (dict): Mapping from gene name to node index.
         node_to_gene (dict): Mapping from node index to gene name.
+
+    For translating many genes or nodes at once, use the array-backed `encode`, `decode`
+    and `align` methods rather than the dictionaries.
     """
     cls_gene = CLS_GENE
     pad_gene = PAD_GENE
@@ -42,6 +47,78 @@ class GeneVocab(object):
             missing = [t for t in special_tokens if t not in self.gene_to_node]
             if missing:
                 raise ValueError(f"Missing required special tokens: {missing}")
+
+        # array-backed lookup tables
+        self._gene_index = pd.Index(genes)
+        self._node_array = np.asarray(nodes, dtype=np.int32)
+        self._gene_array = np.full(self.num_nodes, None, dtype=object)
+        self._gene_array[self._node_array] = np.asarray(genes, dtype=object)
+        self._alignments = []
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        """Hash of the gene to node mapping, used to key cached tokenizations."""
+        if self._fingerprint is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(self._node_array.tobytes())
+            digest.update("\0".join(map(str, self.genes)).encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    @property
+    def num_nodes(self):
+        """Size of a dense table indexed by node id (largest node id + 1)."""
+        return int(max(self.nodes)) + 1 if len(self.nodes) > 0 else 0
+
+    def encode(self, genes) -> np.ndarray:
+        """
+        Translates gene names to node indices.
+
+        Args:
+            genes (array-like): Gene names.
+
+        Returns:
+            np.ndarray: int32 node index of each gene, -1 for genes not in the vocabulary.
+        """
+        positions = self._gene_index.get_indexer(genes)
+        return np.where(positions >= 0, self._node_array[positions], -1).astype(np.int32)
+
+    def decode(self, nodes) -> np.ndarray:
+        """
+        Translates node indices to gene names.
+
+        Args:
+            nodes (array-like): Node indices, of any shape.
+
+        Returns:
+            np.ndarray: Gene name of each node, with the same shape as `nodes`
+                (None for indices that do not correspond to a gene).
+        """
+        return self._gene_array[np.asarray(nodes)]
+
+    def align(self, var_names, max_cached=8) -> np.ndarray:
+        """
+        Maps the columns of a dataset to node indices.
+
+        The alignment is cached, so that the columns of a dataset are translated once
+        rather than once per cell.
+
+        Args:
+            var_names (array-like): Gene names of the dataset's columns.
+            max_cached (int): Number of alignments to keep in the cache.
+
+        Returns:
+            np.ndarray: int32 node index of each column, -1 for genes not in the vocabulary.
+        """
+        for names, nodes in self._alignments:
+            if names is var_names or (len(names) == len(var_names) and names.equals(pd.Index(var_names))):
+                return nodes
+        names = var_names if isinstance(var_names, pd.Index) else pd.Index(var_names)
+        nodes = self.encode(names)
+        nodes.flags.writeable = False
+        self._alignments = [(names, nodes)] + self._alignments[:max_cached - 1]
+        return nodes
     
     @property
     def cls_node(self):
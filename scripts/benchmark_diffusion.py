@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the graph diffusion backends of `scGraphLLM.graph_op` on random ARACNe-like
+graphs (a few regulators with many targets, made undirected), reporting the time of one
+diffusion layer per backend and the crossover points of the "auto" policy.
+
+The dense backend builds its kernel once per batch and reuses it in every layer, so its time is
+reported both for one layer and amortized over `--layers` layers.
+
+    python scripts/benchmark_diffusion.py --nodes 64 128 256 512 1024 --degrees 4 16 64
+"""
+import time
+from argparse import ArgumentParser
+
+import torch
+from torch_geometric.utils import to_undirected
+
+from scGraphLLM.graph_op import \
+    GraphOperatorContext, _chebyshev_diffusion_batched, _dense_diffusion, _expm_multiply_diffusion
+
+
+def aracne_like_graph(num_nodes, degree, regulator_fraction=0.1, generator=None):
+    num_regulators = max(2, int(regulator_fraction * num_nodes))
+    num_edges = num_nodes * degree // 2
+    regulators = torch.randperm(num_nodes, generator=generator)[:num_regulators]
+    src = regulators[torch.randint(0, num_regulators, (num_edges,), generator=generator)]
+    dst = torch.randint(0, num_nodes, (num_edges,), generator=generator)
+    return to_undirected(torch.stack([src, dst]))
+
+
+def timeit(fn, repeats):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    generator = torch.Generator().manual_seed(args.seed)
+    dim = args.heads * args.head_dim
+
+    print(f"batch={args.batch_size}, H*d={dim}, k={args.k}, beta={args.beta}, layers={args.layers}, threads={torch.get_num_threads()}")
+    print(f"{'nodes':>6} {'degree':>6} {'density':>8} {'chebyshev':>10} {'dense':>10} {'dense/L':>10} {'expm_mult':>10}  fastest")
+    crossovers = {}
+    for degree in args.degrees:
+        for num_nodes in args.nodes:
+            edge_index_list = [aracne_like_graph(num_nodes, degree, generator=generator) for _ in range(args.batch_size)]
+            num_nodes_list = [num_nodes] * args.batch_size
+            E = torch.randn(args.batch_size, num_nodes, args.heads, args.head_dim, generator=generator).bfloat16()
+            density = edge_index_list[0].shape[1] / num_nodes ** 2
+
+            context = GraphOperatorContext(edge_index_list, num_nodes_list)
+            sparse = context.operator("cpu")
+            chebyshev = timeit(lambda: _chebyshev_diffusion_batched(sparse, E, k=args.k, beta=args.beta), args.repeats)
+            expm = timeit(lambda: _expm_multiply_diffusion(sparse, E, beta=args.beta), args.repeats)
+
+            # dense: build the kernel every time (one layer), or once for all layers
+            def dense_layer():
+                operator = GraphOperatorContext(edge_index_list, num_nodes_list).operator("cpu", dense=True)
+                return _dense_diffusion(operator, E, beta=args.beta)
+            dense = timeit(dense_layer, args.repeats)
+            dense_operator = context.operator("cpu", dense=True)
+            dense_operator.kernel(args.beta)
+            dense_apply = timeit(lambda: _dense_diffusion(dense_operator, E, beta=args.beta), args.repeats)
+            dense_amortized = dense_apply + (dense - dense_apply) / args.layers
+
+            times = {"chebyshev": chebyshev, "dense": dense_amortized, "expm_multiply": expm}
+            fastest = min(times, key=times.get)
+            if fastest == "dense":
+                crossovers[degree] = num_nodes
+            print(
+                f"{num_nodes:>6} {degree:>6} {density:>8.4f} {chebyshev * 1e3:>8.1f}ms {dense * 1e3:>8.1f}ms "
+                f"{dense_amortized * 1e3:>8.1f}ms {expm * 1e3:>8.1f}ms  {fastest}"
+            )
+
+    print("\nLargest graph where dense (amortized) is fastest, by degree:")
+    for degree in args.degrees:
+        print(f"  degree {degree}: {crossovers.get(degree, 'never')}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--nodes", type=int, nargs="+", default=[32, 64, 128, 256, 512, 1024])
+    parser.add_argument("--degrees", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--head_dim", type=int, default=32)
+    parser.add_argument("--k", type=int, default=64)
+    parser.add_argument("--beta", type=float, default=0.1)
+    parser.add_argument("--layers", type=int, default=12)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import anndata as ad
+
+from scGraphLLM.embedding_writer import EmbeddingWriter, RaggedEmbeddingWriter, read_ragged_embeddings
+
+
+class TestEmbeddingWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.obs = pd.DataFrame({"cell_type": ["T", "B", "T", "NK", "B"]}, index=[f"Cell{i}" for i in range(5)])
+        self.x = np.random.default_rng(0).normal(size=(5, 3)).astype(np.float32)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_backed_anndata(self):
+        path = os.path.join(self.dir.name, "emb.h5ad")
+        with EmbeddingWriter(path, self.obs, n_dims=3, chunk_rows=2) as writer:
+            # batches may arrive out of order
+            writer.write(self.x[[3, 1]], [3, 1])
+            writer.write(self.x[[0]], [0])
+            writer.write(self.x[[2, 4]], [2, 4])
+            self.assertEqual(5, writer.n_written)
+            with self.assertRaises(IndexError):
+                writer.write(self.x[[0]], [5])
+
+        adata = ad.read_h5ad(path, backed="r")
+        self.assertEqual((5, 3), adata.shape)
+        self.assertTrue(np.allclose(self.x, adata.X[:]))
+        self.assertEqual(list(self.obs.index), list(adata.obs_names))
+        self.assertEqual(list(self.obs["cell_type"]), list(adata.obs["cell_type"]))
+        adata.file.close()
+
+    def test_duplicate_obs_names(self):
+        path = os.path.join(self.dir.name, "emb.h5ad")
+        obs = self.obs.set_axis(["Cell0", "Cell1", "Cell0", "Cell1", "Cell0"])
+        with EmbeddingWriter(path, obs, n_dims=3) as writer:
+            # batches in order are appended
+            writer.write(self.x[:2])
+            writer.write(self.x[2:])
+
+        adata = ad.read_h5ad(path)
+        self.assertTrue(np.allclose(self.x, adata.X))
+        self.assertEqual(list(obs.index), list(adata.obs_names))
+
+    def test_ragged(self):
+        path = os.path.join(self.dir.name, "emb.h5")
+        x = np.random.default_rng(0).normal(size=(3, 4, 2))
+        gene_ids = np.arange(12).reshape(3, 4)
+        with RaggedEmbeddingWriter(path, n_dims=2) as writer:
+            writer.write(x[:2], gene_ids[:2], [2, 4], ["Cell0", "Cell1"])
+            writer.write(x[2:], gene_ids[2:], [1], ["Cell2"])
+            self.assertEqual(3, writer.n_obs)
+            self.assertEqual(7, writer.n_tokens)
+
+        file, offsets, obs_names = read_ragged_embeddings(path)
+        self.assertTrue(np.array_equal([0, 2, 6, 7], offsets))
+        self.assertEqual(["Cell0", "Cell1", "Cell2"], list(obs_names))
+        self.assertTrue(np.allclose(x[1], file["x"][offsets[1]:offsets[2]]))
+        self.assertTrue(np.array_equal([8], file["gene_ids"][offsets[2]:offsets[3]]))
+        file.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import unittest
+import torch
+from torch_geometric.utils import to_undirected
+
+from scGraphLLM.graph_op import \
+    _chebyshev_diffusion, _chebyshev_diffusion_looped, _exp_kernel_coeff, _adaptive_order, _chebyshev_coeff, _exp_kernel, \
+    _diffusion, GraphOperatorContext, GraphOperatorCache, DIFFUSION_BACKENDS, laplacian_csr
+
+
+class TestChebyshevDiffusion(unittest.TestCase):
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        self.num_nodes_list = [12, 7, 3, 12]
+        self.edge_index_list = [
+            torch.randint(0, 12, (2, 40), generator=generator),
+            torch.randint(0, 7, (2, 15), generator=generator),
+            torch.zeros(2, 0, dtype=torch.long),  # no edges, falls back to self loops
+            torch.tensor([[0, 1, 1, 5], [1, 0, 1, 6]])  # with a self loop
+        ]
+        self.E = torch.randn(4, 12, 2, 4, generator=generator).bfloat16()
+
+    def test_batched_matches_looped(self):
+        expected = _chebyshev_diffusion_looped(self.edge_index_list, self.num_nodes_list, self.E, k=16, beta=0.5)
+        result = _chebyshev_diffusion(self.edge_index_list, self.num_nodes_list, self.E, k=16, beta=0.5)
+        self.assertEqual(expected.shape, result.shape)
+        self.assertEqual(expected.dtype, result.dtype)
+        torch.testing.assert_close(result.float(), expected.float(), rtol=1e-2, atol=1e-2)
+
+        # padding stays zero
+        self.assertTrue((result[1, 7:] == 0).all())
+        self.assertTrue((result[2, 3:] == 0).all())
+
+    def test_shared_operator(self):
+        context = GraphOperatorContext(self.edge_index_list, self.num_nodes_list)
+        first = _chebyshev_diffusion(self.edge_index_list, self.num_nodes_list, self.E, k=16, graph_context=context)
+        operator = context.operator(self.E.device)
+        second = _chebyshev_diffusion(self.edge_index_list, self.num_nodes_list, self.E, k=16, graph_context=context)
+        self.assertIs(operator, context.operator(self.E.device))
+        self.assertTrue(torch.equal(first, second))
+        self.assertEqual(sum(self.num_nodes_list), operator.degree.numel())
+
+        # coefficients only depend on (K, beta)
+        self.assertIs(_exp_kernel_coeff(16, 0.5), _exp_kernel_coeff(16, 0.5))
+        expected = _chebyshev_coeff(operator.L_rescaled, 16, lambda x: _exp_kernel(x, 0.5))
+        self.assertTrue(torch.equal(expected, _exp_kernel_coeff(16, 0.5)))
+
+    def test_operator_cache(self):
+        cache = GraphOperatorCache(max_items=1)
+        operator = GraphOperatorContext(self.edge_index_list, self.num_nodes_list, cache=cache).operator("cpu")
+        self.assertIs(operator, GraphOperatorContext(self.edge_index_list, self.num_nodes_list, cache=cache).operator("cpu"))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        # other graphs evict the least recently used operator
+        GraphOperatorContext(self.edge_index_list[:2], self.num_nodes_list[:2], cache=cache).operator("cpu")
+        self.assertEqual(1, len(cache))
+        self.assertIsNot(operator, GraphOperatorContext(self.edge_index_list, self.num_nodes_list, cache=cache).operator("cpu"))
+        self.assertEqual(3, cache.misses)
+
+    def test_adaptive_order(self):
+        orders = [_adaptive_order(64, 0.1, tol) for tol in [1e-2, 1e-4, 1e-8]]
+        self.assertEqual(sorted(orders), orders)
+        self.assertLess(orders[-1], 64)
+        self.assertEqual(64, _adaptive_order(64, 0.1, 0.0))
+
+        # on undirected graphs, the truncated series stays within the tolerance of the full one (up to bf16 rounding)
+        edge_index_list = [to_undirected(edge_index) for edge_index in self.edge_index_list]
+        full = _chebyshev_diffusion(edge_index_list, self.num_nodes_list, self.E, k=64, beta=0.1)
+        truncated = _chebyshev_diffusion(edge_index_list, self.num_nodes_list, self.E, k=64, beta=0.1, tol=1e-6)
+        torch.testing.assert_close(truncated.float(), full.float(), rtol=1e-2, atol=1e-2)
+
+    def test_precomputed_laplacian(self):
+        laplacian = laplacian_csr(self.edge_index_list, self.num_nodes_list)
+        self.assertEqual(torch.float32, laplacian["values"].dtype)
+        context = GraphOperatorContext(self.edge_index_list, self.num_nodes_list, laplacian=laplacian)
+        expected = GraphOperatorContext(self.edge_index_list, self.num_nodes_list).operator("cpu")
+        operator = context.operator("cpu")
+        self.assertTrue(torch.equal(expected.L_rescaled.to_dense(), operator.L_rescaled.to_dense()))
+        self.assertTrue(torch.equal(expected.degree, operator.degree))
+        self.assertTrue(torch.equal(
+            _chebyshev_diffusion(self.edge_index_list, self.num_nodes_list, self.E, k=16),
+            _chebyshev_diffusion(self.edge_index_list, self.num_nodes_list, self.E, k=16, graph_context=context)
+        ))
+
+        # edges are validated when the Laplacian is built
+        with self.assertRaises(ValueError):
+            laplacian_csr([torch.tensor([[0, 1], [1, 7]])], [7])
+
+
+def aracne_like_graph(num_nodes, degree, generator, regulator_fraction=0.1):
+    """Random graph where a few regulators carry all edges, like ARACNe networks."""
+    num_regulators = max(2, int(regulator_fraction * num_nodes))
+    regulators = torch.randperm(num_nodes, generator=generator)[:num_regulators]
+    src = regulators[torch.randint(0, num_regulators, (num_nodes * degree // 2,), generator=generator)]
+    dst = torch.randint(0, num_nodes, (num_nodes * degree // 2,), generator=generator)
+    return torch.stack([src, dst])
+
+
+class TestDiffusionBackends(unittest.TestCase):
+    def setUp(self):
+        generator = torch.Generator().manual_seed(1)
+        self.num_nodes_list = [300, 40, 120, 5, 700]
+        self.edge_index_list = [
+            aracne_like_graph(n, degree, generator) for n, degree in zip(self.num_nodes_list, [8, 4, 16, 2, 4])
+        ]
+        self.E = torch.randn(5, 700, 2, 4, generator=generator).bfloat16()
+
+    def assert_close(self, actual, expected):
+        # bf16 outputs: compare up to a couple of ulps
+        torch.testing.assert_close(actual.float(), expected.float(), rtol=2e-2, atol=2e-2)
+
+    def test_backends_agree_on_undirected_graphs(self):
+        edge_index_list = [to_undirected(edge_index) for edge_index in self.edge_index_list]
+        context = GraphOperatorContext(edge_index_list, self.num_nodes_list)
+        results = {
+            backend: _diffusion(edge_index_list, self.num_nodes_list, self.E, k=64, beta=0.1, graph_context=context, backend=backend)
+            for backend in DIFFUSION_BACKENDS
+        }
+        for backend in DIFFUSION_BACKENDS:
+            self.assertEqual(self.E.shape, results[backend].shape)
+            self.assert_close(results[backend], results["chebyshev"])
+            self.assertTrue((results[backend][1, 40:] == 0).all())
+
+        # auto mixes backends by size, with the adaptive Chebyshev order for large graphs if requested
+        self.assertEqual({"dense": (0, 1, 2, 3), "expm_multiply": (4,)}, context.backends())
+        auto = _diffusion(edge_index_list, self.num_nodes_list, self.E, k=64, beta=0.1, graph_context=context, tol=1e-8, backend="auto")
+        self.assertEqual({"dense": (0, 1, 2, 3), "chebyshev": (4,)}, context.backends(sparse_backend="chebyshev"))
+        self.assert_close(auto, results["chebyshev"])
+
+    def test_exact_backends_agree_on_directed_graphs(self):
+        dense = _diffusion(self.edge_index_list, self.num_nodes_list, self.E, beta=0.1, backend="dense")
+        expm = _diffusion(self.edge_index_list, self.num_nodes_list, self.E, beta=0.1, backend="expm_multiply")
+        self.assert_close(expm, dense)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            _diffusion(self.edge_index_list, self.num_nodes_list, self.E, backend="lanczos")
+
+
+if __name__ == "__main__":
+    unittest.main()
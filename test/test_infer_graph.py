@@ -74,6 +74,49 @@ class TestGraphIntegration(unittest.TestCase):
         self.assertEqual((total_edges, total_classes), E.shape)
         self.assertEqual((total_edges, total_classes), MI.shape)
 
+    def test_sparse_edge_matrix(self):
+        default_alpha = (0.05 + 1.)/2
+        E, MI, all_edges = build_class_edge_matrix(self.class_networks, self.classes, default_alpha=default_alpha)
+        E_sparse, MI_sparse, sparse_edges = build_class_edge_matrix(self.class_networks, self.classes, default_alpha=default_alpha, sparse=True)
+        self.assertTrue(np.array_equal(all_edges, sparse_edges))
+        self.assertEqual(sorted(self.all_edges), [tuple(e) for e in all_edges])
+
+        # missing entries are implied by default alpha and NaN
+        self.assertTrue(np.array_equal(E, np.where(E_sparse.toarray() == 0, default_alpha, E_sparse.toarray())))
+        self.assertEqual(sum(len(net) for net in self.class_networks.values()), MI_sparse.nnz)
+
+        for probs in [[0.07, 0.0, 0.9, 0.03, 0.0], [0.0, 0.05, 0.0, 0.30, 0.65], [0.2] * 5]:
+            edge_ids, pvals, mis = infer_cell_edges_(probs, E, MI, alpha=0.25)
+            sparse_edge_ids, sparse_pvals, sparse_mis = infer_cell_edges_(probs, E_sparse, MI_sparse, alpha=0.25, default_alpha=default_alpha)
+            self.assertTrue(np.array_equal(edge_ids, sparse_edge_ids))
+            self.assertTrue(np.allclose(pvals, sparse_pvals))
+            self.assertTrue(np.allclose(mis, sparse_mis))
+
+    def test_class_edge_ids(self):
+        _, _, all_edges = build_class_edge_matrix(self.class_networks, self.classes, default_alpha=0.5)
+        class_edge_ids = build_class_edge_ids(self.class_networks, all_edges)
+        for c, network in self.class_networks.items():
+            self.assertEqual(network.edges, [tuple(e) for e in all_edges[class_edge_ids[c]]])
+
+    def test_infer_cells_edges(self):
+        default_alpha = (0.05 + 1.)/2
+        probs = np.array([
+            [0.07, 0.0, 0.9, 0.03, 0.0], 
+            [0.0, 0.0, 0.0, 0.0, 0.0], 
+            [0.0, 0.05, 0.0, 0.30, 0.65], 
+            [0.2, 0.2, 0.2, 0.2, 0.2]
+        ])
+        for sparse in [False, True]:
+            E, MI, _ = build_class_edge_matrix(self.class_networks, self.classes, default_alpha=default_alpha, sparse=sparse)
+            indptr, edge_ids, pvals, mis = infer_cells_edges(probs, E, MI, alpha=0.25, chunk_size=3, default_alpha=default_alpha)
+            self.assertEqual(len(probs) + 1, len(indptr))
+            self.assertEqual(0, indptr[2] - indptr[1])
+            for i, probs_i in enumerate(probs):
+                expected_ids, expected_pvals, expected_mis = infer_cell_edges_(probs_i, E, MI, alpha=0.25, default_alpha=default_alpha)
+                self.assertTrue(np.array_equal(expected_ids, edge_ids[indptr[i]:indptr[i + 1]]))
+                self.assertTrue(np.allclose(expected_pvals, pvals[indptr[i]:indptr[i + 1]]))
+                self.assertTrue(np.allclose(expected_mis, mis[indptr[i]:indptr[i + 1]]))
+
     def test_implicit_hard_assignment(self):
         E, MI, all_edges = build_class_edge_matrix(self.class_networks, self.classes, default_alpha=(0.05 + 1.)/2)
         for i, c in enumerate(self.classes):
@@ -1,12 +1,17 @@
+import os
+import tempfile
 import unittest
 import pandas as pd
 import numpy as np
+import torch
+from torch.utils.data import DataLoader
 
-from scGraphLLM._globals import CLS_GENE, MASK_GENE
+from scGraphLLM._globals import CLS_GENE, MASK_GENE, PAD_GENE
 from scGraphLLM.tokenizer import GraphTokenizer
 from scGraphLLM.vocab import GeneVocab
 from scGraphLLM.network import RegulatoryNetwork
-from scGraphLLM.inference import InferenceDataset, VariableNetworksInferenceDataset
+from scGraphLLM.samplers import LengthBucketSampler
+from scGraphLLM.inference import InferenceDataset, VariableNetworksInferenceDataset, CellEmbeddingAccumulator, GeneEmbeddingAccumulator
 
 
 class TestInferenceDatasets(unittest.TestCase):
@@ -54,6 +59,28 @@ class TestInferenceDatasets(unittest.TestCase):
         self.assertEqual(3, item["num_nodes"])
         self.assertEqual("Cell2", item["obs_name"])
 
+    def test_inference_dataset_getitems(self):
+        dataset = InferenceDataset(expression=self.expression, tokenizer=self.tokenizer)
+        items = dataset.__getitems__([1, 0])
+        for idx, item in zip([1, 0], items):
+            expected = dataset[idx]
+            self.assertTrue(np.array_equal(expected["orig_gene_id"].numpy(), item["orig_gene_id"].numpy()))
+            self.assertTrue(np.array_equal(expected["orig_rank_indices"].numpy(), item["orig_rank_indices"].numpy()))
+            self.assertTrue(np.array_equal(expected["edge_index"].numpy(), item["edge_index"].numpy()))
+            self.assertEqual(expected["num_nodes"], item["num_nodes"])
+            self.assertEqual(expected["obs_name"], item["obs_name"])
+
+    def test_inference_dataset_compact(self):
+        tokenizer = GraphTokenizer(vocab=self.vocab, network=self.network, only_expressed_plus_neighbors=True, compact=True)
+        dataset = InferenceDataset(expression=self.expression, tokenizer=self.tokenizer)
+        compact_dataset = InferenceDataset(expression=self.expression, tokenizer=tokenizer)
+        for idx in range(len(dataset)):
+            expected, item = dataset[idx], compact_dataset[idx]
+            for key in ["orig_gene_id", "orig_rank_indices", "edge_index"]:
+                self.assertEqual(torch.long, item[key].dtype)
+                self.assertTrue(np.array_equal(expected[key].numpy(), item[key].numpy()))
+            self.assertEqual(expected["num_nodes"], item["num_nodes"])
+
     def test_variable_networks_inference_dataset(self):
         all_edges = np.array([["A", "C"], ["E", "B"], ["B", "D"], ["E", "A"]])
         edge_ids_list = [np.array([0, 2]), np.array([0, 2, 3])]
@@ -83,6 +110,114 @@ class TestInferenceDatasets(unittest.TestCase):
         self.assertEqual("Cell2", item["obs_name"])
 
 
+    def test_undirected_networks(self):
+        all_edges = np.array([["A", "C"], ["C", "A"], ["B", "D"], ["E", "B"]])
+        edge_ids_list = [np.array([0, 1, 2]), np.array([0, 1, 2, 3])]
+        expected = {
+            None: [{("A", "C"), ("C", "A"), ("B", "D")}, {("A", "C"), ("C", "A"), ("B", "D"), ("E", "B")}],
+            False: [{("A", "C"), ("C", "A"), ("B", "D"), ("D", "B")}, {("A", "C"), ("C", "A"), ("B", "D"), ("D", "B"), ("E", "B"), ("B", "E")}],
+            True: [{("A", "C"), ("C", "A")}, {("A", "C"), ("C", "A")}]
+        }
+        for drop_unpaired, edges in expected.items():
+            dataset = VariableNetworksInferenceDataset(
+                expression=self.expression,
+                tokenizer=self.tokenizer,
+                edge_ids_list=edge_ids_list,
+                all_edges=all_edges,
+                drop_unpaired=drop_unpaired
+            )
+            for idx in range(len(dataset)):
+                self.assertEqual(edges[idx], set(dataset.cell_network(idx).edges), drop_unpaired)
+
+    def test_shared_networks(self):
+        expression = pd.concat([self.expression, self.expression.rename(lambda name: name + "_copy")])
+        all_edges = np.array([["A", "C"], ["E", "B"], ["B", "D"], ["E", "A"]])
+        # separately built but equal arrays, shared through the network ids
+        edge_ids_list = [np.array([0, 2, 3]), np.array([0, 2]), np.array([0, 2, 3]), np.array([0, 2, 3])]
+        weights_list = [np.array([1.2, 0.7, 1.5]), np.array([0.9, 0.8]), np.array([1.2, 0.7, 1.5]), np.array([1.2, 0.7, 1.5])]
+
+        dataset = VariableNetworksInferenceDataset(
+            expression=expression,
+            tokenizer=self.tokenizer,
+            edge_ids_list=edge_ids_list,
+            all_edges=all_edges,
+            weights_list=weights_list,
+            drop_unpaired=False,
+            network_ids=[2, -1, 2, 2]
+        )
+        self.assertTrue(np.array_equal([0, 1, 0, 0], dataset.cell_rows))
+        self.assertTrue(np.array_equal([True, False], dataset.shared_rows))
+        self.assertIs(dataset.cell_network(0), dataset.cell_network(3))
+        self.assertIsNot(dataset.cell_network(0), dataset.cell_network(1))
+
+        # without network ids, every cell has its own network
+        unshared = VariableNetworksInferenceDataset(
+            expression=expression,
+            tokenizer=self.tokenizer,
+            edge_ids_list=edge_ids_list,
+            all_edges=all_edges,
+            weights_list=weights_list,
+            drop_unpaired=False
+        )
+        self.assertTrue(np.array_equal([0, 1, 2, 3], unshared.cell_rows))
+        self.assertFalse(unshared.shared_rows.any())
+        with self.assertRaises(ValueError):
+            VariableNetworksInferenceDataset(
+                expression=expression, tokenizer=self.tokenizer, edge_ids_list=edge_ids_list, all_edges=all_edges, network_ids=[0, 0]
+            )
+
+        indices = [3, 1, 0, 2]
+        for idx, item in zip(indices, dataset.__getitems__(indices)):
+            expected = dataset[idx]
+            self.assertEqual(expected["obs_name"], item["obs_name"])
+            for key in ["orig_gene_id", "orig_rank_indices", "edge_index"]:
+                self.assertTrue(np.array_equal(expected[key].numpy(), item[key].numpy()))
+
+    def test_sequence_lengths(self):
+        expression = pd.concat([self.expression, self.expression.rename(lambda name: name + "_copy")])
+        vocab = GeneVocab(
+            genes=["A", "B", "C", "D", "E", CLS_GENE, MASK_GENE, PAD_GENE],
+            nodes=[0, 1, 2, 3, 4, 17936, 903, 904],
+            require_special_tokens=False
+        )
+        tokenizer = GraphTokenizer(vocab=vocab, network=self.network, only_expressed_plus_neighbors=True)
+        all_edges = np.array([["A", "C"], ["E", "B"], ["B", "D"], ["E", "A"]])
+        shared_ids = np.array([0, 2, 3])
+        datasets = [
+            InferenceDataset(expression=expression, tokenizer=tokenizer),
+            VariableNetworksInferenceDataset(
+                expression=expression,
+                tokenizer=tokenizer,
+                edge_ids_list=[shared_ids, np.array([0, 2]), shared_ids, np.array([1])],
+                all_edges=all_edges,
+                network_ids=[0, -1, 0, -1]
+            )
+        ]
+        for dataset in datasets:
+            lengths = dataset.sequence_lengths()
+            self.assertTrue(np.array_equal([dataset[idx]["num_nodes"] for idx in range(len(dataset))], lengths))
+            lengths, num_edges = dataset.sequence_lengths(with_edges=True)
+            self.assertTrue(np.array_equal([dataset[idx]["edge_index"].shape[1] for idx in range(len(dataset))], num_edges))
+
+            # batches of similar length come back in sampler order, carrying their observation names
+            sampler = LengthBucketSampler(lengths, batch_size=3)
+            dataloader = DataLoader(dataset, batch_sampler=sampler, collate_fn=dataset.collate_fn)
+            batches = list(dataloader)
+            obs_names = np.concatenate([batch["obs_name"] for batch in batches])
+            self.assertEqual(list(dataset.obs_names[np.concatenate(list(sampler))]), list(obs_names))
+            self.assertEqual(np.concatenate(list(sampler)).tolist(), sum([batch["obs_index"] for batch in batches], []))
+
+            # the token budget counts the CLS token prepended to each cell
+            max_tokens = 2 * lengths.max() + 1
+            sampler = LengthBucketSampler(lengths, max_tokens=max_tokens, extra_tokens=1)
+            for batch in DataLoader(dataset, batch_sampler=sampler, collate_fn=dataset.collate_fn):
+                self.assertLessEqual(batch["orig_gene_id"].shape[0] * batch["orig_gene_id"].shape[1], max_tokens)
+
+            # batches can carry their graph Laplacian, built by the collate function
+            dataset.precompute_laplacian = True
+            batch = next(iter(DataLoader(dataset, batch_size=3, collate_fn=dataset.collate_fn)))
+            self.assertEqual(sum(batch["num_nodes"]) + 1, len(batch["laplacian"]["crow_indices"]))
+
     def test_network_pruning(self):
         all_edges = np.array([["B", "A"], ["B", "C"], ["B", "D"], ["B", "E"], ["E", "B"]])
         edge_ids_list = [np.array([0, 1, 2]), np.array([0,1,2,3,4])]
@@ -105,5 +240,115 @@ class TestInferenceDatasets(unittest.TestCase):
         self.assertEqual("Cell2", item["obs_name"])
 
 
+class TestEmbeddingAccumulators(unittest.TestCase):
+    def setUp(self):
+        self.vocab = GeneVocab(
+            genes=["A", "B", "C", "D", CLS_GENE, MASK_GENE],
+            nodes=[0, 1, 2, 3, 6, 5],
+            require_special_tokens=False
+        )
+        rng = np.random.default_rng(0)
+        self.obs_names = [f"Cell{i}" for i in range(6)]
+        self.seq_lengths = [3, 4, 2, 4, 2, 3]
+        self.gene_ids = torch.tensor([[6, *rng.permutation([0, 1, 3])] for _ in self.obs_names])  # CLS first
+        self.x = torch.tensor(rng.normal(size=(6, 4, 3)), dtype=torch.float32)
+
+        # expected statistics from the flattened (non-padding) tokens
+        self.tokens = pd.DataFrame(
+            np.concatenate([self.x[i, :n].numpy() for i, n in enumerate(self.seq_lengths)]),
+            index=[self.vocab.node_to_gene[int(g)] for i, n in enumerate(self.seq_lengths) for g in self.gene_ids[i, :n]]
+        )
+        self.tokens["cell"] = np.repeat(self.obs_names, self.seq_lengths)
+
+    def accumulate(self, accumulator):
+        for batch in [slice(0, 2), slice(2, 5), slice(5, 6)]:
+            accumulator.update(self.x[batch], self.gene_ids[batch], self.seq_lengths[batch], self.obs_names[batch])
+
+    def test_mean_and_variance(self):
+        accumulator = GeneEmbeddingAccumulator(self.vocab, with_variance=True)
+        self.accumulate(accumulator)
+        means, variances = accumulator.result()
+
+        tokens = self.tokens.drop(index=CLS_GENE, errors="ignore").drop(columns="cell").groupby(level=0)
+        self.assertEqual(sorted(tokens.groups), sorted(means.index))
+        self.assertTrue(np.allclose(tokens.mean().loc[means.index], means, atol=1e-5))
+        self.assertTrue(np.allclose(tokens.var().loc[variances.index], variances, atol=1e-5, equal_nan=True))
+
+        accumulator = GeneEmbeddingAccumulator(self.vocab)
+        self.accumulate(accumulator)
+        self.assertTrue(np.allclose(means, accumulator.result().loc[means.index], atol=1e-5))
+
+        accumulator = GeneEmbeddingAccumulator(self.vocab, include_cls=True)
+        self.accumulate(accumulator)
+        self.assertIn(CLS_GENE, accumulator.result().index)
+
+    def test_cell_embeddings(self):
+        tokens = self.tokens.set_index("cell", append=True)
+        expected = {
+            "include": tokens.groupby(level="cell").mean(),
+            "exclude": tokens.drop(index=CLS_GENE, level=0).groupby(level="cell").mean(),
+            "only": tokens.xs(CLS_GENE, level=0)
+        }
+        for cls_policy, x_cell in expected.items():
+            accumulator = CellEmbeddingAccumulator(cls_policy, vocab=self.vocab)
+            self.accumulate(accumulator)
+            result = accumulator.result()
+            self.assertEqual(self.obs_names, list(result.index))
+            self.assertTrue(np.allclose(x_cell.loc[result.index].to_numpy(), result, atol=1e-5), cls_policy)
+
+        with self.assertRaises(ValueError):
+            CellEmbeddingAccumulator("only")
+
+    def test_bucketed_duplicate_obs_names(self):
+        accumulator = CellEmbeddingAccumulator()
+        self.accumulate(accumulator)
+        expected = accumulator.result()
+
+        # batches out of dataset order, as from a LengthBucketSampler, with repeated names
+        obs_names = np.array(["Cell0", "Cell1", "Cell0", "Cell2", "Cell1", "Cell0"])
+        accumulator = CellEmbeddingAccumulator()
+        for batch in [[3, 1], [5, 0, 4], [2]]:
+            accumulator.update(self.x[batch], self.gene_ids[batch], np.take(self.seq_lengths, batch), obs_names[batch], batch)
+        result = accumulator.result()
+        self.assertEqual(list(obs_names), list(result.index))
+        self.assertTrue(np.allclose(expected.to_numpy(), result))
+
+    def test_streamed_cell_embeddings(self):
+        accumulator = CellEmbeddingAccumulator()
+        self.accumulate(accumulator)
+        expected = accumulator.result()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "emb_cell_with_cls.h5ad")
+            accumulator = CellEmbeddingAccumulator(path=path, obs=pd.Index(self.obs_names))
+            self.accumulate(accumulator)
+            adata = accumulator.result()
+            self.assertEqual(self.obs_names, list(adata.obs_names))
+            self.assertTrue(np.allclose(expected.to_numpy(), adata.X[:]))
+            adata.file.close()
+
+            # bucketed batches with repeated names are placed by dataset position
+            obs_names = ["Cell0", "Cell1", "Cell0", "Cell2", "Cell1", "Cell0"]
+            accumulator = CellEmbeddingAccumulator(path=path, obs=pd.Index(obs_names))
+            for batch in [[3, 1], [5, 0, 4], [2]]:
+                accumulator.update(self.x[batch], self.gene_ids[batch], np.take(self.seq_lengths, batch), np.take(obs_names, batch), batch)
+            adata = accumulator.result()
+            self.assertEqual(obs_names, list(adata.obs_names))
+            self.assertTrue(np.allclose(expected.to_numpy(), adata.X[:]))
+            adata.file.close()
+
+    def test_groups(self):
+        groups = pd.Series(["T", "B", "T", None, "B", "T"], index=self.obs_names)
+        accumulator = GeneEmbeddingAccumulator(self.vocab, groups=groups)
+        self.accumulate(accumulator)
+        means = accumulator.result()
+
+        tokens = self.tokens.drop(index=CLS_GENE, errors="ignore")
+        tokens = tokens.assign(group=groups.loc[tokens["cell"]].to_numpy()).dropna(subset="group")
+        expected = tokens.drop(columns="cell").set_index("group", append=True).swaplevel().groupby(level=[0, 1]).mean()
+        self.assertEqual(sorted(expected.index), sorted(means.index))
+        self.assertTrue(np.allclose(expected.loc[means.index], means, atol=1e-5))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,215 @@
+import os
+import pickle
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from scGraphLLM.vocab import GeneVocab
+from scGraphLLM.network import RegulatoryNetwork, convert_aracne_outputs
+
+
+class TestRegulatoryNetwork(unittest.TestCase):
+    def setUp(self):
+        self.network = RegulatoryNetwork(
+            regulators=['A', 'B', 'A', 'C', 'A'],
+            targets=   ['B', 'C', 'C', 'A', 'D'],
+            weights=   [0.9, 0.8, 0.2, 0.6, 1.1],
+            likelihoods=[-3.2, -2.5, -1.8, -1.1, -2.4]
+        )
+
+    def test_columns(self):
+        self.assertEqual({'A', 'B', 'C', 'D'}, self.network.genes)
+        self.assertEqual([('A', 'B'), ('B', 'C'), ('A', 'C'), ('C', 'A'), ('A', 'D')], self.network.edges)
+        self.assertEqual(np.float32, self.network.weights.dtype)
+        self.assertEqual({'A': 4, 'B': 2, 'C': 3, 'D': 1}, self.network.degree.to_dict())
+        self.assertEqual(['B', 'C', 'D'], self.network.targets_of('A'))
+        self.assertEqual([], self.network.targets_of('D'))
+
+    def test_derived_networks_share_dictionary(self):
+        pruned = self.network.prune(limit_regulon=1)
+        self.assertIs(self.network._gene_names, pruned._gene_names)
+        self.assertEqual([('A', 'D'), ('B', 'C'), ('C', 'A')], pruned.edges)
+        self.assertEqual({'A', 'B', 'C', 'D'}, pruned.genes)
+
+        retained = self.network.retain(self.network.weights > 0.5, inplace=False)
+        self.assertEqual([('A', 'B'), ('B', 'C'), ('C', 'A'), ('A', 'D')], retained.edges)
+        self.assertEqual({'A': 3, 'B': 2, 'C': 2, 'D': 1}, retained.degree.to_dict())
+
+        # cached structures are rebuilt when edges change
+        self.network.filter(self.network.weights < 0.85, inplace=True)
+        self.assertEqual([('A', 'B'), ('A', 'D')], self.network.edges)
+        self.assertEqual({'A', 'B', 'D'}, self.network.genes)
+
+    def test_take(self):
+        taken = self.network.take(np.array([3, 0]), weights=[0.1, 0.2])
+        self.assertIs(self.network._gene_names, taken._gene_names)
+        self.assertEqual([('C', 'A'), ('A', 'B')], taken.edges)
+        self.assertTrue(np.allclose([0.1, 0.2], taken.weights))
+        self.assertTrue(np.allclose(self.network.likelihoods[[3, 0]], taken.likelihoods))
+
+    def test_make_undirected(self):
+        network = RegulatoryNetwork(
+            regulators=['A', 'B', 'C', 'C', 'D'],
+            targets=   ['B', 'A', 'D', 'D', 'D'],
+            weights=   [0.9, 0.8, 0.2, 0.3, 1.1],
+            likelihoods=[-3.2, -2.5, -1.8, -1.1, -2.4]
+        )
+        paired = network.make_undirected(drop_unpaired=True)
+        self.assertEqual([('A', 'B'), ('B', 'A'), ('D', 'D')], paired.edges)
+
+        # reverse edges inherit the weight of the edge they mirror
+        network.make_undirected(inplace=True)
+        self.assertEqual([('A', 'B'), ('B', 'A'), ('C', 'D'), ('C', 'D'), ('D', 'D'), ('D', 'C'), ('D', 'C')], network.edges)
+        self.assertTrue(np.allclose([0.2, 0.3], network.weights.to_numpy()[-2:]))
+
+    def test_eq(self):
+        reordered = RegulatoryNetwork(
+            regulators=['A', 'A', 'C', 'B', 'A'],
+            targets=   ['D', 'C', 'A', 'C', 'B'],
+            weights=   [1.0, 1.0, 1.0, 1.0, 1.0],
+            likelihoods=None
+        )
+        self.assertEqual(self.network, reordered)
+        self.assertNotEqual(self.network, reordered.prune(limit_graph=4))
+        self.assertEqual(self.network.prune(limit_graph=3), self.network.prune(limit_graph=3))
+
+
+class TestNetworkFiles(unittest.TestCase):
+    def setUp(self):
+        self.network = RegulatoryNetwork(
+            regulators=['A', 'B', 'A', 'C'],
+            targets=   ['B', 'C', 'C', 'A'],
+            weights=   [0.9, 0.8, 0.2, 0.6],
+            likelihoods=[-3.2, -2.5, -1.8, -1.1]
+        )
+
+    def assertSameNetwork(self, expected, network):
+        self.assertEqual(expected.edges, network.edges)
+        self.assertTrue(np.array_equal(expected.weights, network.weights))
+        self.assertTrue(np.array_equal(expected.likelihoods, network.likelihoods))
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.network.save(f"{tmp}/net")
+            for mmap in [True, False]:
+                network = RegulatoryNetwork.load(f"{tmp}/net", mmap=mmap)
+                self.assertSameNetwork(self.network, network)
+                self.assertEqual(mmap, isinstance(network._weights, np.memmap))
+
+            # memory-mapped networks are pickled by path, others by value
+            network = RegulatoryNetwork.load(f"{tmp}/net")
+            self.assertLess(len(pickle.dumps(network)), len(pickle.dumps(self.network)))
+            self.assertSameNetwork(self.network, pickle.loads(pickle.dumps(network)))
+            self.assertSameNetwork(self.network, pickle.loads(pickle.dumps(self.network)))
+
+            # derived networks are held in memory
+            pruned = network.prune(limit_graph=2)
+            self.assertSameNetwork(self.network.prune(limit_graph=2), pickle.loads(pickle.dumps(pruned)))
+
+    def test_from_csv_pruned(self):
+        rng = np.random.default_rng(0)
+        genes = [f"G{i}" for i in range(12)]
+        df = pd.DataFrame({
+            "regulator.values": rng.choice(genes, 200),
+            "target.values": rng.choice(genes, 200),
+            "mi.values": rng.choice([0.1, 0.2, 0.5, 1.5], 200),
+            "log.p.values": rng.normal(size=200)
+        })
+        with tempfile.TemporaryDirectory() as tmp:
+            df.to_csv(f"{tmp}/network.tsv", sep="\t", index=False)
+            for limit_regulon, limit_graph in [(3, None), (None, 25), (2, 10)]:
+                expected = RegulatoryNetwork.from_csv(f"{tmp}/network.tsv", sep="\t")\
+                    .prune(limit_regulon=limit_regulon, limit_graph=limit_graph)
+                network = RegulatoryNetwork.from_csv_pruned(
+                    f"{tmp}/network.tsv", limit_regulon=limit_regulon, limit_graph=limit_graph, chunksize=17, sep="\t"
+                )
+                self.assertSameNetwork(expected, network)
+
+    def test_convert_aracne_outputs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(f"{tmp}/aracne")
+            pd.DataFrame({
+                "regulator.values": self.network.regulators,
+                "target.values": self.network.targets,
+                "mi.values": self.network.weights,
+                "log.p.values": self.network.likelihoods
+            }).to_csv(f"{tmp}/aracne/consolidated-net_defaultid.tsv", sep="\t", index=False)
+
+            path = f"{tmp}/aracne/consolidated-net_defaultid.tsv"
+            self.assertSameNetwork(self.network, RegulatoryNetwork.from_aracne(path))
+            converted = convert_aracne_outputs([f"{tmp}/aracne"])
+            self.assertEqual([f"{tmp}/aracne/consolidated-net_defaultid.network"], converted)
+            network = RegulatoryNetwork.from_aracne(path)
+            self.assertIsInstance(network._weights, np.memmap)
+            self.assertSameNetwork(self.network, network)
+
+
+class TestNetworkAdjacency(unittest.TestCase):
+    def setUp(self):
+        self.vocab = GeneVocab(
+            genes=['A', 'B', 'C', 'D', 'E', 'G', 'H'],
+            nodes=[3, 0, 5, 1, 8, 2, 4],
+            require_special_tokens=False
+        )
+
+        # (F, C) involves a gene outside of the vocabulary
+        self.network = RegulatoryNetwork(
+            regulators=['A', 'B', 'C', 'G', 'G', 'H', 'H', 'F'],
+            targets=   ['C', 'D', 'E', 'H', 'A', 'E', 'C', 'C'],
+            weights=   [0.9, 0.8, 0.7, 0.6, 1.1, 0.2, 0.6, 0.5],
+            likelihoods=[-3.2, -2.5, -1.8, -1.1, -2.4, -1.3, -1.9, -1.0]
+        )
+
+    def test_adjacency_is_cached(self):
+        adjacency = self.network.adjacency(self.vocab)
+        self.assertIs(adjacency, self.network.adjacency(self.vocab))
+        self.assertEqual(7, len(adjacency))
+
+        # modifying the edges invalidates the index
+        self.network.prune(limit_graph=3, inplace=True)
+        self.assertEqual(3, len(self.network.adjacency(self.vocab)))
+
+    def test_subgraph(self):
+        adjacency = self.network.adjacency(self.vocab)
+        genes = ['H', 'E', 'A', 'C']
+        nodes = np.array([self.vocab.gene_to_node[g] for g in genes])
+        src, dst, edge_ids = adjacency.subgraph(nodes)
+
+        # (A,C), (C,E), (H,E), (H,C) in network order
+        self.assertTrue(np.array_equal([0, 2, 5, 6], edge_ids))
+        self.assertTrue(np.array_equal([[2, 3, 0, 0], [3, 1, 1, 3]], [src, dst]))
+
+    def test_subgraphs(self):
+        adjacency = self.network.adjacency(self.vocab)
+        cells = [['A', 'G'], [], ['B', 'D', 'C', 'E']]
+        nodes = np.array([self.vocab.gene_to_node[g] for cell in cells for g in cell])
+        offsets = np.cumsum([0] + [len(cell) for cell in cells])
+        subgraph, src, dst, edge_ids = adjacency.subgraphs(nodes, offsets)
+
+        self.assertTrue(np.array_equal([0, 2, 2], subgraph))
+        self.assertTrue(np.array_equal([1, 0, 2], src))
+        self.assertTrue(np.array_equal([0, 1, 3], dst))
+        self.assertTrue(np.array_equal([4, 1, 2], edge_ids))
+
+    def test_neighbors(self):
+        adjacency = self.network.adjacency(self.vocab)
+        cells = [['A'], ['D'], []]
+        rows = [i for i, cell in enumerate(cells) for _ in cell]
+        cols = [self.vocab.gene_to_node[g] for cell in cells for g in cell]
+        indicator = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(cells), adjacency.num_nodes))
+        neighbors = adjacency.neighbors(indicator)
+
+        # regulators and targets of the genes are both neighbors
+        found = [{self.vocab.node_to_gene[n] for n in neighbors[i].indices} for i in range(len(cells))]
+        self.assertEqual([{'C', 'G'}, {'B'}, set()], found)
+
+    def test_in_network(self):
+        adjacency = self.network.adjacency(self.vocab)
+        in_network = {g for g, n in self.vocab.gene_to_node.items() if adjacency.in_network[n]}
+        self.assertEqual({'A', 'B', 'C', 'D', 'E', 'G', 'H'}, in_network)
+
+
+if __name__ == '__main__':
+    unittest.main()
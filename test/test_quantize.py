@@ -1,9 +1,32 @@
 # test_math_utils.py
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 import unittest
 
-from scGraphLLM.tokenizer import quantize_cells
+from scGraphLLM.tokenizer import quantize_cells, quantize_sparse, tokenize_expr
+
+
+def reference_tokenize_expr(expr: pd.Series, n_bins: int = 5, method: str = "quantile") -> pd.Series:
+    # original per-cell implementation of `tokenize_expr`, kept as the reference for the vectorized binning
+    non_zero_idx = expr.to_numpy(dtype=float).nonzero()[0]
+    binned = np.zeros_like(expr, dtype=np.int16)
+
+    if len(non_zero_idx) == 0:
+        return pd.Series(binned, index=expr.index)
+    
+    non_zero_expr = expr.iloc[non_zero_idx]
+    if np.unique(non_zero_expr).shape[0] > 1:
+        if method == "quantile":
+            bins = np.quantile(non_zero_expr, np.linspace(0, 1, n_bins))[1:-1]
+        else:
+            bins = np.linspace(min(non_zero_expr), max(non_zero_expr), n_bins)
+        binned[non_zero_idx] = np.digitize(non_zero_expr, bins, right=True) + 1
+    else:
+        binned[non_zero_idx] = round(n_bins / 2)
+
+    return pd.Series(binned, index=expr.index)
+
 
 class TestQuantization(unittest.TestCase):
 
@@ -225,6 +248,44 @@ class TestQuantization(unittest.TestCase):
         print(f"\nFinished testing decimal expression")
         self.expression = original_expr
 
+    # Check that sparse quantization matches the dense path and preserves the sparsity pattern
+    def test_quantize_sparse(self):
+        for n_bins in [2, self.n_bins, 100]:
+            for method in ["quantile", "uniform"]:
+                X = sp.csr_matrix(self.expression.to_numpy(dtype=float))
+                bins = quantize_sparse(X, n_bins=n_bins, method=method, dtype=np.uint8)
+                expected = quantize_cells(self.expression, n_bins=n_bins, method=method)
+                self.assertEqual(np.uint8, bins.dtype)
+                self.assertTrue(np.array_equal(X.indices, bins.indices))
+                self.assertTrue(np.array_equal(X.indptr, bins.indptr))
+                self.assertTrue(np.array_equal(expected.to_numpy(), bins.toarray()))
+                for i in range(self.expression.shape[0]):
+                    cell_bins = tokenize_expr(self.expression.iloc[i], n_bins=n_bins, method=method)
+                    self.assertTrue(np.array_equal(cell_bins.to_numpy(), bins[i].toarray().ravel()))
+
+    # Check the vectorized binning against the original per-cell implementation, for integer and
+    # floating point data of either precision
+    def test_matches_reference(self):
+        rng = np.random.default_rng(0)
+        X = rng.random((200, 40)) * rng.integers(1, 1000, size=(200, 1)) * (rng.random((200, 40)) < 0.6)
+        for n_bins in [5, 255]:
+            # float32 values on the (double precision) uniform bin edges of their row
+            low = rng.random((50, 1)).astype(np.float32)
+            high = (low + rng.random((50, 1)) * 1000).astype(np.float32)
+            on_edges = np.linspace(low.astype(np.float64), high.astype(np.float64), n_bins, axis=1)[..., 0].astype(np.float32)
+            for data in [X.astype(np.int64), X, X.astype(np.float32), on_edges]:
+                expression = pd.DataFrame(data)
+                for method in ["quantile", "uniform"]:
+                    message = f"{data.dtype}, n_bins={n_bins}, {method}"
+                    expected = np.stack([
+                        reference_tokenize_expr(expression.iloc[i], n_bins=n_bins, method=method).to_numpy()
+                        for i in range(len(expression))
+                    ])
+                    self.assertTrue(np.array_equal(expected, quantize_cells(expression, n_bins=n_bins, method=method).to_numpy()), message)
+                    self.assertTrue(np.array_equal(expected, quantize_sparse(sp.csr_matrix(data), n_bins=n_bins, method=method).toarray()), message)
+                    for i in range(0, len(expression), 17):
+                        self.assertTrue(np.array_equal(expected[i], tokenize_expr(expression.iloc[i], n_bins=n_bins, method=method).to_numpy()), message)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from scGraphLLM._globals import CLS_GENE, MASK_GENE, PAD_GENE
+from scGraphLLM.data import GraphTransformerDataset
+from scGraphLLM.samplers import LengthBucketSampler, DistributedLengthBucketSampler
+from scGraphLLM.tokenizer import TokenizedCell
+from scGraphLLM.vocab import GeneVocab
+
+
+class TestLengthBucketSampler(unittest.TestCase):
+    def setUp(self):
+        self.lengths = np.random.default_rng(0).integers(1, 4096, size=1000)
+
+    def test_deterministic(self):
+        sampler = LengthBucketSampler(self.lengths, batch_size=64)
+        batches = list(sampler)
+        self.assertEqual(len(sampler), len(batches))
+        self.assertEqual(batches, list(sampler))
+
+        # every cell exactly once, batches of decreasing length
+        indices = np.concatenate(batches)
+        self.assertTrue(np.array_equal(np.arange(len(self.lengths)), np.sort(indices)))
+        self.assertTrue(np.all(np.diff(self.lengths[indices]) <= 0))
+
+    def test_shuffle(self):
+        sampler = LengthBucketSampler(self.lengths, batch_size=10, bucket_size=100, shuffle=True, seed=1)
+        batches = list(sampler)
+        self.assertTrue(np.array_equal(np.arange(len(self.lengths)), np.sort(np.concatenate(batches))))
+        self.assertEqual(batches, list(sampler))
+
+        # new epoch, new order
+        sampler.set_epoch(1)
+        self.assertNotEqual(batches, list(sampler))
+
+        # padding within batches is much lower than with random batches
+        padding = lambda batches: sum(self.lengths[b].max() * len(b) - self.lengths[b].sum() for b in batches)
+        random_batches = np.array_split(np.random.default_rng(0).permutation(len(self.lengths)), len(batches))
+        self.assertLess(padding(batches), padding(random_batches) / 5)
+
+    def test_drop_last(self):
+        sampler = LengthBucketSampler(self.lengths, batch_size=64, drop_last=True)
+        self.assertTrue(all(len(batch) == 64 for batch in sampler))
+        self.assertEqual(len(self.lengths) // 64, len(sampler))
+
+    def test_token_budget(self):
+        num_edges = np.random.default_rng(1).integers(0, 20_000, size=len(self.lengths))
+        sampler = LengthBucketSampler(self.lengths, max_tokens=16_384, num_edges=num_edges, max_edges=100_000)
+        batches = list(sampler)
+        self.assertTrue(np.array_equal(np.arange(len(self.lengths)), np.sort(np.concatenate(batches))))
+
+        # padded tokens and edges stay within budget, short cells are packed in larger batches
+        for batch in batches:
+            self.assertLessEqual(self.lengths[batch].max() * len(batch), 16_384)
+            self.assertLessEqual(num_edges[batch].sum(), 100_000)
+        self.assertGreater(len(batches[-1]), len(batches[0]))
+
+        # a cell over budget gets a batch of its own, the cell count can still be capped
+        self.assertEqual([[1], [2, 0]], list(LengthBucketSampler([2, 10, 3], max_tokens=8)))
+        self.assertEqual([[1], [2], [0]], list(LengthBucketSampler([2, 10, 3], batch_size=1, max_tokens=8)))
+        with self.assertRaises(ValueError):
+            LengthBucketSampler(self.lengths, max_edges=100)
+
+    def test_distributed(self):
+        samplers = [
+            DistributedLengthBucketSampler(self.lengths, batch_size=30, num_replicas=3, rank=rank, seed=2)
+            for rank in range(3)
+        ]
+        batches = [list(sampler) for sampler in samplers]
+        self.assertEqual(1, len({len(b) for b in batches}))
+
+        # ranks see disjoint batches that together cover every cell
+        indices = np.concatenate([np.concatenate(b) for b in batches])
+        self.assertEqual(set(range(len(self.lengths))), set(indices))
+        self.assertEqual(len(LengthBucketSampler(self.lengths, batch_size=30)), 34)
+        self.assertEqual(36, sum(len(b) for b in batches))
+
+
+
+class TestCachedSequenceLengths(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.vocab = GeneVocab(genes=["A", "B", "C", CLS_GENE, MASK_GENE, PAD_GENE], nodes=[0, 1, 2, 3, 4, 5], require_special_tokens=False)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def save_cell(self, name, num_genes, num_edges):
+        edge_index = np.zeros((2, num_edges), dtype=np.int16)
+        TokenizedCell(genes=np.arange(num_genes), bins=np.ones(num_genes), edge_index=edge_index).save(os.path.join(self.dir.name, name))
+
+    def test_index_follows_cached_files(self):
+        self.save_cell("cell0.npz", 3, 1)
+        self.save_cell("cell1.npz", 1, 0)
+        lengths, num_edges = GraphTransformerDataset(self.dir.name, self.vocab).sequence_lengths(with_edges=True)
+        self.assertEqual(([3, 1], [1, 0]), (lengths.tolist(), num_edges.tolist()))
+        self.assertTrue(os.path.exists(os.path.join(self.dir.name, "seq_lengths.npy")))
+
+        # replacing a cell with the same number of cells invalidates the index
+        self.save_cell("cell1.npz", 2, 2)
+        os.utime(os.path.join(self.dir.name, "cell1.npz"), ns=(0, 0))
+        lengths, num_edges = GraphTransformerDataset(self.dir.name, self.vocab).sequence_lengths(with_edges=True)
+        self.assertEqual(([3, 2], [1, 2]), (lengths.tolist(), num_edges.tolist()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+import tempfile
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+from scGraphLLM.tokenizer import GraphTokenizer
+from scGraphLLM.token_cache import TokenizationCache
+from scGraphLLM.vocab import GeneVocab
+from scGraphLLM.network import RegulatoryNetwork
+
+
+class TestTokenizationCache(unittest.TestCase):
+    def setUp(self):
+        self.expression = pd.DataFrame(
+            [[1, 0, 3, 0, 0], [0, 2, 0, 4, 1], [5, 1, 0, 0, 2]],
+            index=["Cell1", "Cell2", "Cell3"],
+            columns=["A", "B", "C", "D", "E"]
+        )
+
+        self.vocab = GeneVocab(
+            genes=["A", "B", "C", "D", "E"],
+            nodes=[0, 1, 2, 3, 4],
+            require_special_tokens=False
+        )
+
+        self.network = RegulatoryNetwork(
+            regulators=["A", "B", "E"],
+            targets=["C", "D", "B"],
+            weights=[1.0, 0.5, 0.2],
+            likelihoods=[-2.4, -1.8, -2.0]
+        )
+
+    def assertSameTokenization(self, expected, data):
+        self.assertTrue(np.array_equal(expected.x.numpy(), data.x.numpy()))
+        self.assertTrue(np.array_equal(expected.edge_index.numpy(), data.edge_index.numpy()))
+
+    def test_hits_and_misses(self):
+        cache = TokenizationCache()
+        tokenizer = GraphTokenizer(vocab=self.vocab, network=self.network, n_bins=3, cache=cache)
+        uncached = GraphTokenizer(vocab=self.vocab, network=self.network, n_bins=3)
+
+        first = tokenizer.tokenize_batch(self.expression.to_numpy(), self.expression.columns)
+        self.assertEqual((0, 3), (cache.hits, cache.misses))
+
+        # per-cell and sparse inputs map to the same keys
+        second = tokenizer.tokenize_batch(sp.csr_matrix(self.expression.to_numpy()), self.expression.columns)
+        data = tokenizer(self.expression.iloc[1])
+        self.assertEqual((4, 3), (cache.hits, cache.misses))
+        self.assertIs(first[1], data)
+
+        for i in range(len(self.expression)):
+            self.assertIs(first[i], second[i])
+            self.assertSameTokenization(uncached(self.expression.iloc[i]), first[i])
+
+    def test_keys_depend_on_inputs(self):
+        cache = TokenizationCache()
+        tokenizer = GraphTokenizer(vocab=self.vocab, network=self.network, n_bins=3, cache=cache)
+        tokenizer(self.expression.iloc[0])
+
+        # different expression, tokenizer configuration and network
+        cell = self.expression.iloc[0].copy()
+        cell["D"] = 1
+        tokenizer(cell)
+        tokenizer.n_bins = 4
+        tokenizer(self.expression.iloc[0])
+        network = RegulatoryNetwork(regulators=["A"], targets=["C"], weights=[1.0], likelihoods=[-2.4])
+        tokenizer(self.expression.iloc[0], override_network=network)
+        self.assertEqual((0, 4), (cache.hits, cache.misses))
+
+    def test_lru_eviction_and_disk_tier(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for compact in [False, True]:
+                cache = TokenizationCache(max_items=2, cache_dir=f"{tmp}/{compact}")
+                tokenizer = GraphTokenizer(vocab=self.vocab, network=self.network, n_bins=3, compact=compact, cache=cache)
+                tokenizer.tokenize_batch(self.expression.to_numpy(), self.expression.columns)
+                self.assertEqual(2, len(cache))
+
+                # first cell was evicted from memory but is read back from disk
+                data = tokenizer(self.expression.iloc[0])
+                self.assertEqual((1, 1, 3), (cache.hits, cache.disk_hits, cache.misses))
+
+                # a fresh cache on the same directory skips tokenization entirely
+                cache = TokenizationCache(cache_dir=f"{tmp}/{compact}")
+                tokenizer.cache = cache
+                batch = tokenizer.tokenize_batch(self.expression.to_numpy(), self.expression.columns)
+                self.assertEqual((3, 3, 0), (cache.hits, cache.disk_hits, cache.misses))
+                if compact:
+                    self.assertTrue(np.array_equal(data.genes, batch[0].genes))
+                else:
+                    self.assertSameTokenization(data, batch[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
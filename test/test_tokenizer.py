@@ -1,13 +1,18 @@
 import unittest
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 import torch
+import tempfile
+import os
+from unittest import mock
 
 from torch_geometric.data import Data as torchGeomData
 
-from scGraphLLM.tokenizer import GraphTokenizer
+from scGraphLLM.tokenizer import GraphTokenizer, TokenizedCell
 from scGraphLLM.vocab import GeneVocab
 from scGraphLLM.network import RegulatoryNetwork
+from test_quantize import reference_tokenize_expr
 
 
 class TestGraphTokenizer(unittest.TestCase):
@@ -265,6 +270,92 @@ class TestGraphTokenizer(unittest.TestCase):
         self.assertTrue(hasattr(data, 'edge_index'))
         self.assertTrue(hasattr(data, 'edge_weight'))
 
+    def test_tokenize_batch_matches_per_cell(self):
+        configs = [
+            dict(max_seq_length=5, only_expressed_genes=True, n_bins=3),
+            dict(max_seq_length=6, only_expressed_plus_neighbors=True, n_bins=10),
+            dict(max_seq_length=5, only_expressed_genes=False, n_bins=10),
+            dict(max_seq_length=5, only_network_genes=False, n_bins=10),
+            dict(max_seq_length=None, only_expressed_genes=False, n_bins=4, method="uniform"),
+        ]
+        expression = pd.concat([self.expression, pd.DataFrame([[0]*8], index=['Cell4'], columns=self.expression.columns)])
+        decimal = (expression / 7).astype(np.float32)
+        for config in configs:
+            tokenizer = GraphTokenizer(vocab=self.vocab, network=self.network, with_edge_weights=True, **config)
+            for X in [expression.to_numpy(), sp.csr_matrix(expression.to_numpy()), decimal.to_numpy(), sp.csr_matrix(decimal.to_numpy())]:
+                cells = expression if X.dtype != np.float32 else decimal
+                batch = tokenizer.tokenize_batch(X, expression.columns)
+                self.assertEqual(len(expression), len(batch))
+                for i in range(len(expression)):
+                    # cells tokenized one at a time, binned by the original per-cell implementation
+                    with mock.patch("scGraphLLM.tokenizer.tokenize_expr", reference_tokenize_expr):
+                        data = tokenizer(cells.iloc[i])
+                    self.assertTrue(np.array_equal(data.x.numpy().reshape(-1, 2), batch[i].x.numpy()))
+                    self.assertTrue(np.array_equal(data.edge_index.numpy(), batch[i].edge_index.numpy()))
+                    self.assertTrue(np.array_equal(data.edge_weight.numpy(), batch[i].edge_weight.numpy()))
+
+                # sequence lengths match the tokenized cells, in blocks of any size
+                lengths = tokenizer.sequence_lengths(X, expression.columns, block_size=2)
+                self.assertTrue(np.array_equal([data.x.shape[0] for data in batch], lengths))
+
+    def test_tokenize_batch_from_counts(self):
+        tokenizer = GraphTokenizer(vocab=self.vocab, network=self.network, max_seq_length=5, n_bins=3)
+        batch = tokenizer.tokenize_batch(self.expression.to_numpy(), self.expression.columns, from_counts=True)
+        for i in range(len(self.expression)):
+            data = tokenizer(self.expression.iloc[i], from_counts=True)
+            self.assertTrue(np.array_equal(data.x.numpy(), batch[i].x.numpy()))
+            self.assertTrue(np.array_equal(data.edge_index.numpy(), batch[i].edge_index.numpy()))
+
+
+    def test_compact_tokenized_cell(self):
+        tokenizer = GraphTokenizer(vocab=self.vocab, network=self.network, max_seq_length=6, only_expressed_plus_neighbors=True, n_bins=10, with_edge_weights=True)
+        compact_tokenizer = GraphTokenizer(vocab=self.vocab, network=self.network, max_seq_length=6, only_expressed_plus_neighbors=True, n_bins=10, with_edge_weights=True, compact=True)
+        batch = compact_tokenizer.tokenize_batch(self.expression.to_numpy(), self.expression.columns)
+        for i in range(len(self.expression)):
+            data = tokenizer(self.expression.iloc[i])
+            for cell in [compact_tokenizer(self.expression.iloc[i]), batch[i]]:
+                self.assertIsInstance(cell, TokenizedCell)
+                self.assertEqual((np.int32, np.uint8, np.int16, np.float32), (cell.genes.dtype, cell.bins.dtype, cell.edge_index.dtype, cell.edge_weight.dtype))
+                converted = cell.to_data()
+                self.assertTrue(np.array_equal(data.x.numpy(), converted.x.numpy()))
+                self.assertTrue(np.array_equal(data.edge_index.numpy(), converted.edge_index.numpy()))
+                self.assertTrue(np.allclose(data.edge_weight.numpy(), converted.edge_weight.numpy()))
+
+        # tensors share memory with the record
+        genes, bins, edge_index, edge_weight = batch[0].to_tensors()
+        self.assertEqual(genes.data_ptr(), batch[0].genes.ctypes.data)
+
+        # round trip through disk
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cell.npz")
+            batch[1].save(path)
+            loaded = TokenizedCell.load(path)
+        self.assertTrue(np.array_equal(batch[1].genes, loaded.genes))
+        self.assertTrue(np.array_equal(batch[1].bins, loaded.bins))
+        self.assertTrue(np.array_equal(batch[1].edge_index, loaded.edge_index))
+        self.assertTrue(np.array_equal(batch[1].edge_weight, loaded.edge_weight))
+
+        with self.assertRaises(ValueError):
+            GraphTokenizer(vocab=self.vocab, network=self.network, n_bins=300, compact=True)
+
+    def test_compact_bin_range(self):
+        # the uniform method assigns bins up to n_bins, which must fit in uint8
+        expression = pd.DataFrame([np.arange(1, 1001)], columns=[f"G{i}" for i in range(1000)])
+        vocab = GeneVocab(genes=list(expression.columns), nodes=list(range(1000)), require_special_tokens=False)
+        network = RegulatoryNetwork(regulators=["G0", "G1"], targets=["G1", "G999"], weights=[1.0, 1.0], likelihoods=[-2.0, -2.0])
+        with self.assertRaises(ValueError):
+            GraphTokenizer(vocab=vocab, network=network, n_bins=256, method="uniform", compact=True, only_network_genes=False)
+        tokenizer = GraphTokenizer(vocab=vocab, network=network, n_bins=255, method="uniform", compact=True, only_network_genes=False, max_seq_length=None)
+        for cell in [tokenizer(expression.iloc[0]), tokenizer.tokenize_batch(expression.to_numpy(), expression.columns)[0]]:
+            self.assertEqual(1000, cell.num_nodes)
+            self.assertEqual((1, 255), (cell.bins.min(), cell.bins.max()))
+
+        # out of range bins are rejected instead of wrapping around
+        TokenizedCell(genes=[0, 1], bins=[0, 255], edge_index=np.zeros((2, 0)))
+        for bins in [[1, 256], [-1, 1]]:
+            with self.assertRaises(ValueError):
+                TokenizedCell(genes=[0, 1], bins=bins, edge_index=np.zeros((2, 0)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from scGraphLLM._globals import CLS_GENE, PAD_GENE, MASK_GENE
+from scGraphLLM.vocab import GeneVocab
+
+
+class TestGeneVocab(unittest.TestCase):
+    def setUp(self):
+        self.vocab = GeneVocab(
+            genes=[PAD_GENE, MASK_GENE, "A", "B", "C", CLS_GENE],
+            nodes=[0, 1, 4, 2, 7, 9]
+        )
+
+    def test_encode(self):
+        nodes = self.vocab.encode(["C", "A", "Z", "B"])
+        self.assertEqual(np.int32, nodes.dtype)
+        self.assertTrue(np.array_equal([7, 4, -1, 2], nodes))
+
+    def test_decode(self):
+        nodes = np.array([[9, 4, 2], [9, 7, 0]])
+        genes = self.vocab.decode(nodes)
+        self.assertEqual(nodes.shape, genes.shape)
+        self.assertTrue(np.array_equal([[CLS_GENE, "A", "B"], [CLS_GENE, "C", PAD_GENE]], genes))
+        self.assertIsNone(self.vocab.decode(3))
+
+    def test_align_is_cached(self):
+        var_names = pd.Index(["B", "Z", "A"])
+        nodes = self.vocab.align(var_names)
+        self.assertTrue(np.array_equal([2, -1, 4], nodes))
+        self.assertIs(nodes, self.vocab.align(var_names))
+        self.assertIs(nodes, self.vocab.align(["B", "Z", "A"]))
+        self.assertTrue(np.array_equal([4, 2], self.vocab.align(["A", "B"])))
+
+
+if __name__ == '__main__':
+    unittest.main()